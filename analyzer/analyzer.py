@@ -21,6 +21,10 @@ import torchvision.transforms as transforms
 # Assuming these are custom modules from the same project
 from .imageprocessor import ImageProcessor
 from .model import FindingClassifier
+from slide.location import LocationTable
+from slide.region import read_patches, read_region_scaled
+from slide.handle import LazySlide
+from sslmodel.data_handler import BatchNormalize, collate_uint8, prepare_uint8_transform
 
 
 class Analyzer:
@@ -41,8 +45,8 @@ class Analyzer:
         self.finding_classifier = FindingClassifier(DEVICE=device)
         self.image_processor = ImageProcessor()
         self.mask: Optional[np.ndarray] = None
-        self.locations_small: Optional[List[Tuple[int, int]]] = None
-        self.locations_large: Optional[List[Tuple[int, int]]] = None
+        self.locations_small: Optional[LocationTable] = None
+        self.locations_large: Optional[LocationTable] = None
         self.result_patch: Optional[pd.DataFrame] = None
         self.result_all: Optional[pd.DataFrame] = None
 
@@ -88,12 +92,12 @@ class Analyzer:
         The process involves:
         1. Identifying tissue regions in the WSI.
         2. Generating locations for small and large patches.
-        3. Creating PyTorch DataLoaders for these patches.
+        3. Creating a dual scale DataLoader (each large patch is read once).
         4. Running classification to get patch-level and slide-level predictions.
 
         Args:
             filein (str): Path to the WSI file.
-            batch_size (int): Batch size for the DataLoader.
+            batch_size (int): Number of small patches per batch.
             patch_size (int): The size of the larger patches to extract.
             model_patch_size (int): The size of the smaller patches (input to the model).
             slice_min_patch (int): Minimum number of tissue pixels for a patch to be included.
@@ -112,30 +116,26 @@ class Analyzer:
             mask=self.mask, patch_size=patch_size, model_patch_size=patch_size
         )
 
-        # 3. Set up data loaders
-        loader_small = prepare_dataset_location(
-            filein=filein,
-            locations=self.locations_small,
-            batch_size=batch_size,
-            patch_size=model_patch_size,
-            num_workers=num_workers,
-        )
-        loader_large = prepare_dataset_location(
+        # 3. Set up the data loader (one read per large patch, both scales)
+        # The number of small patches within a large patch, used for pooling.
+        if model_patch_size == 0:
+            raise ValueError("model_patch_size cannot be zero.")
+        pool_factor = (patch_size // model_patch_size) ** 2
+        data_loader = prepare_dataset_dual(
             filein=filein,
             locations=self.locations_large,
-            batch_size=batch_size,
+            batch_size=max(1, batch_size // pool_factor),
             patch_size=patch_size,
+            model_patch_size=model_patch_size,
             num_workers=num_workers,
+            uint8=True,
         )
-        data_loaders = [loader_small, loader_large]
 
-        # 4. Featurize and classify
-        # The number of small patches within a large patch, used for pooling.
-        if model_patch_size == 0:
-            raise ValueError("model_patch_size cannot be zero.")
-        pool_factor = (patch_size // model_patch_size) ** 2
+        # 4. Featurize and classify (normalized per batch on the device)
         self.result_patch, self.result_all = self.finding_classifier.classify(
-            data_loaders, num_pool=pool_factor
+            data_loader,
+            num_pool=pool_factor,
+            batch_transform=BatchNormalize(DEVICE=self.finding_classifier.DEVICE),
         )
 
 
@@ -151,26 +151,48 @@ class PatchDatasetLocation(torch.utils.data.Dataset):
     def __init__(
         self,
         filein: str,
-        locations: List[Tuple[int, int]],
+        locations: LocationTable,
         transform: Optional[Callable] = None,
         patch_size: int = 224,
+        strip_length: Optional[int] = None,
+        pyramid_size: Optional[int] = None,
+        cache_size: Optional[int] = None,
+        uint8: bool = False,
     ):
         """
         Initializes the dataset.
 
         Args:
             filein (str): Path to the WSI file.
-            locations (List[Tuple[int, int]]): A list of (x, y) coordinates for the top-left
-                                               corner of each patch at level 0.
+            locations (LocationTable): (x, y) coordinates for the top-left
+                                       corner of each patch at level 0.
             transform (Callable, optional): A function/transform to apply to each patch.
             patch_size (int): The size of the square patch to extract.
+            strip_length (int, optional): If set, batches are read as horizontal strips
+                                          of up to strip_length adjacent patches.
+            pyramid_size (int, optional): If set, patches are read from the pyramid level
+                                          matching this output size (level 0 if none).
+            cache_size (int, optional): OpenSlide tile cache (bytes) of each worker's handle.
+            uint8 (bool): The transform returns uint8 HWC arrays (error patches are uint8 zeros).
         """
         self.filein = filein
-        self.wsi = OpenSlide(filein)
+        self.slide = LazySlide(filein, cache_size=cache_size)  # opened in each worker
         self.locations = locations
         self.patch_size = patch_size
+        self.uint8 = uint8
+        self.strip_length = strip_length
+        self.pyramid_size = pyramid_size
         self._transform = transform
 
+    @property
+    def wsi(self) -> OpenSlide:
+        """The OpenSlide handle of the current process (worker)."""
+        return self.slide.image
+
+    def close(self):
+        """Closes the handle of the current process."""
+        self.slide.close()
+
     def __len__(self) -> int:
         """Returns the total number of patches."""
         return len(self.locations)
@@ -190,11 +212,19 @@ class PatchDatasetLocation(torch.utils.data.Dataset):
         location = self.locations[idx]
         try:
             # read_region returns a PIL Image
-            patch_img = self.wsi.read_region(
-                location=location,
-                level=0,
-                size=(self.patch_size, self.patch_size),
-            )
+            if self.pyramid_size:
+                patch_img = read_region_scaled(
+                    self.wsi,
+                    location=location,
+                    size=(self.patch_size, self.patch_size),
+                    out_size=(self.pyramid_size, self.pyramid_size),
+                )
+            else:
+                patch_img = self.wsi.read_region(
+                    location=location,
+                    level=0,
+                    size=(self.patch_size, self.patch_size),
+                )
             # Convert to RGB (handles RGBA) and apply transforms
             patch_img = patch_img.convert("RGB")
             if self._transform:
@@ -203,15 +233,45 @@ class PatchDatasetLocation(torch.utils.data.Dataset):
         except OpenSlideError as e:
             print(f"Error reading region at {location} from {self.filein}: {e}")
             # Return a dummy tensor on error, assuming model input size is 224x224
-            return torch.zeros((3, 224, 224))
+            return _blank(self.uint8)
+
+    def __getitems__(self, indices: List[int]) -> List[torch.Tensor]:
+        """
+        Retrieves a batch of patches (called by the DataLoader).
+
+        With strip_length, adjacent patches of the batch are read with one call per strip.
+        """
+        if not self.strip_length or self.pyramid_size:
+            return [self[idx] for idx in indices]
+        try:
+            patches = read_patches(
+                self.wsi,
+                self.locations[np.asarray(indices)],
+                patch_size=self.patch_size,
+                strip_length=self.strip_length,
+            )
+        except OpenSlideError as e:
+            print(f"Error reading strips from {self.filein}: {e}")
+            return [self[idx] for idx in indices]
+        res = []
+        for patch in patches:
+            patch_img = Image.fromarray(patch)
+            if self._transform:
+                patch_img = self._transform(patch_img)
+            res.append(patch_img)
+        return res
 
 
 def prepare_dataset_location(
     filein: str,
-    locations: List[Tuple[int, int]],
+    locations: LocationTable,
     batch_size: int = 128,
     patch_size: int = 224,
     num_workers: int = 4,
+    strip_length: Optional[int] = None,
+    pyramid: bool = False,
+    cache_size: Optional[int] = None,
+    uint8: bool = False,
 ) -> torch.utils.data.DataLoader:
     """
     Creates a DataLoader for WSI patches.
@@ -221,32 +281,30 @@ def prepare_dataset_location(
 
     Args:
         filein (str): Path to the WSI file.
-        locations (List[Tuple[int, int]]): List of patch coordinates.
+        locations (LocationTable): Patch coordinates.
         batch_size (int): Number of samples per batch.
         patch_size (int): The size of patches to be extracted.
         num_workers (int): Number of subprocesses to use for data loading.
+        strip_length (int, optional): Read adjacent patches of a batch as strips (see PatchDatasetLocation).
+        pyramid (bool): Read patches from the pyramid level matching the 224x224 model input.
+        cache_size (int, optional): OpenSlide tile cache (bytes) of each worker's handle.
+        uint8 (bool): Yield uint8 (batch, 224, 224, 3) batches, normalized later
+                      by BatchNormalize (same values, one op per batch).
 
     Returns:
         torch.utils.data.DataLoader: The configured DataLoader.
     """
-    # Standard normalization for ImageNet-pretrained models
-    normalize = transforms.Normalize(
-        mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
-    )
-    # Note: The model input size is hardcoded to 224x224 here.
-    data_transform = transforms.Compose(
-        [
-            transforms.Resize((224, 224), antialias=True),
-            transforms.ToTensor(),
-            normalize,
-        ]
-    )
+    data_transform = _prepare_transform(uint8)
 
     dataset = PatchDatasetLocation(
         filein=filein,
         locations=locations,
         transform=data_transform,
         patch_size=patch_size,
+        strip_length=strip_length,
+        pyramid_size=224 if pyramid else None,
+        cache_size=cache_size,
+        uint8=uint8,
     )
 
     data_loader = torch.utils.data.DataLoader(
@@ -257,10 +315,179 @@ def prepare_dataset_location(
         pin_memory=True,
         worker_init_fn=_worker_init_fn,
         drop_last=False,
+        collate_fn=collate_uint8 if uint8 else None,
     )
     return data_loader
 
 
+class PatchDatasetDual(torch.utils.data.Dataset):
+    """
+    A PyTorch Dataset yielding both scales of a WSI region from a single read.
+
+    Each sample is (small, large): the sub patches of model_patch_size
+    (ordered by x offset, then y offset, as ImageProcessor.get_locations)
+    and the whole patch_size region, both transformed.
+    """
+
+    def __init__(
+        self,
+        filein: str,
+        locations: LocationTable,
+        transform: Optional[Callable] = None,
+        patch_size: int = 448,
+        model_patch_size: int = 224,
+        cache_size: Optional[int] = None,
+        uint8: bool = False,
+    ):
+        """
+        Initializes the dataset.
+
+        Args:
+            filein (str): Path to the WSI file.
+            locations (LocationTable): (x, y) coordinates of the patch_size regions at level 0.
+            transform (Callable, optional): A function/transform applied to each view.
+            patch_size (int): The size of the region to read.
+            model_patch_size (int): The size of the sub patches.
+            cache_size (int, optional): OpenSlide tile cache (bytes) of each worker's handle.
+            uint8 (bool): The transform returns uint8 HWC arrays (views are stacked as arrays).
+        """
+        self.filein = filein
+        self.slide = LazySlide(filein, cache_size=cache_size)  # opened in each worker
+        self.locations = locations
+        self.patch_size = patch_size
+        self.uint8 = uint8
+        self.model_patch_size = model_patch_size
+        self.factor = patch_size // model_patch_size
+        self._transform = transform if transform else transforms.ToTensor()
+
+    @property
+    def wsi(self) -> OpenSlide:
+        """The OpenSlide handle of the current process (worker)."""
+        return self.slide.image
+
+    def close(self):
+        """Closes the handle of the current process."""
+        self.slide.close()
+
+    def __len__(self) -> int:
+        """Returns the total number of regions."""
+        return len(self.locations)
+
+    def __getitem__(self, idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Reads the region once and returns (small, large).
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: sub patches (factor**2, C, H, W) and region (C, H, W).
+        """
+        location = self.locations[idx]
+        mps = self.model_patch_size
+        try:
+            region = self.wsi.read_region(
+                location=location,
+                level=0,
+                size=(self.patch_size, self.patch_size),
+            ).convert("RGB")
+        except OpenSlideError as e:
+            print(f"Error reading region at {location} from {self.filein}: {e}")
+            large = _blank(self.uint8)
+            return _stack([large] * self.factor ** 2), large
+        small = _stack(
+            [
+                self._transform(region.crop((i * mps, v * mps, (i + 1) * mps, (v + 1) * mps)))
+                for i in range(self.factor)
+                for v in range(self.factor)
+            ]
+        )
+        large = self._transform(region)
+        return small, large
+
+
+def prepare_dataset_dual(
+    filein: str,
+    locations: LocationTable,
+    batch_size: int = 32,
+    patch_size: int = 448,
+    model_patch_size: int = 224,
+    num_workers: int = 4,
+    cache_size: Optional[int] = None,
+    uint8: bool = False,
+) -> torch.utils.data.DataLoader:
+    """
+    Creates a dual scale DataLoader for WSI regions (same transforms as prepare_dataset_location).
+
+    Args:
+        filein (str): Path to the WSI file.
+        locations (LocationTable): Coordinates of the patch_size regions.
+        batch_size (int): Number of regions per batch.
+        patch_size (int): The size of the regions.
+        model_patch_size (int): The size of the sub patches.
+        num_workers (int): Number of subprocesses to use for data loading.
+        cache_size (int, optional): OpenSlide tile cache (bytes) of each worker's handle.
+        uint8 (bool): Yield uint8 views (channels last), normalized later by BatchNormalize.
+
+    Returns:
+        torch.utils.data.DataLoader: yields (small, large) batches.
+    """
+    data_transform = _prepare_transform(uint8)
+    dataset = PatchDatasetDual(
+        filein=filein,
+        locations=locations,
+        transform=data_transform,
+        patch_size=patch_size,
+        model_patch_size=model_patch_size,
+        cache_size=cache_size,
+        uint8=uint8,
+    )
+    data_loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=num_workers,
+        pin_memory=True,
+        worker_init_fn=_worker_init_fn,
+        drop_last=False,
+        collate_fn=collate_uint8 if uint8 else None,
+    )
+    return data_loader
+
+
+def _prepare_transform(uint8: bool = False) -> Callable:
+    """
+    Resize to the 224x224 model input, then ToTensor and the ImageNet normalization.
+
+    With uint8, only the resize runs in the workers (patches stay uint8 HWC arrays).
+    """
+    if uint8:
+        return prepare_uint8_transform(resize=(224, 224))[0]
+    # Standard normalization for ImageNet-pretrained models
+    normalize = transforms.Normalize(
+        mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
+    )
+    # Note: The model input size is hardcoded to 224x224 here.
+    return transforms.Compose(
+        [
+            transforms.Resize((224, 224), antialias=True),
+            transforms.ToTensor(),
+            normalize,
+        ]
+    )
+
+
+def _blank(uint8: bool = False):
+    """Dummy 224x224 patch returned on read errors."""
+    if uint8:
+        return np.zeros((224, 224, 3), dtype=np.uint8)
+    return torch.zeros((3, 224, 224))
+
+
+def _stack(lst_data: list):
+    """Stacks the views of a region (uint8 arrays or tensors)."""
+    if isinstance(lst_data[0], np.ndarray):
+        return np.stack(lst_data)
+    return torch.stack(lst_data)
+
+
 def _worker_init_fn(worker_id: int):
     """
     Ensures that data loading is reproducible across multiple workers.
@@ -49,10 +49,12 @@ class FindingClassifier:
             print("not dict style is not implemented")
         self.style = style
 
-    def classify(self, data_loaders, num_pool=4):
-        """predict all class probability"""
+    def classify(self, data_loaders, num_pool=4, batch_transform=None):
+        """predict all class probability (data_loaders, batch_transform: see _featurize)"""
         print("Featurizing WSI")
-        x = self._featurize(data_loaders, num_pool=num_pool)  # sample x feature
+        x = self._featurize(
+            data_loaders, num_pool=num_pool, batch_transform=batch_transform
+        )  # sample x feature
         print("Finding Classsifying")
         result_patch = self._predict_proba(x, style=self.style)
         result_all = self._predict_proba(
@@ -64,8 +66,19 @@ class FindingClassifier:
         self,
         data_loaders,
         num_pool=4,
+        batch_transform=None,
     ):
-        """small size, large size and layer 4, 5"""
+        """
+        small size, large size and layer 4, 5
+        data_loaders: [loader_small, loader_large] or one dual scale loader (yields (small, large))
+        batch_transform: applied to each batch instead of .to(DEVICE) (e.g. BatchNormalize of uint8 batches)
+        """
+        if batch_transform is None:
+            batch_transform = lambda x: x.to(self.DEVICE)
+        if not isinstance(data_loaders, (list, tuple)):
+            return self._featurize_dual(
+                data_loaders, num_pool=num_pool, batch_transform=batch_transform
+            )
         # featurize
         self.featurize_model = self.featurize_model.to(self.DEVICE)
         lst_out = [[] * 4]
@@ -73,7 +86,7 @@ class FindingClassifier:
             x4_small = []
             x5_small = []
             for data in data_loaders[0]:
-                data = data.to(self.DEVICE)
+                data = batch_transform(data)
                 x4, x5 = self._extraction_layer45(self.featurize_model, data)
                 x4_small.append(x4)
                 x5_small.append(x5)
@@ -86,7 +99,7 @@ class FindingClassifier:
             x4_large = []
             x5_large = []
             for data in data_loaders[1]:
-                data = data.to(self.DEVICE)
+                data = batch_transform(data)
                 x4, x5 = self._extraction_layer45(self.featurize_model, data)
                 x4_large.append(x4)
                 x5_large.append(x5)
@@ -94,6 +107,32 @@ class FindingClassifier:
             x5_large = np.concatenate(x5_large).reshape(-1, 512)
         return np.concatenate([x5_small, x5_large, x4_small, x4_large], axis=1)
 
+    def _featurize_dual(
+        self,
+        data_loader,
+        num_pool=4,
+        batch_transform=None,
+    ):
+        """both sizes from one loader, small: (batch, num_pool, c, h, w), large: (batch, c, h, w)"""
+        if batch_transform is None:
+            batch_transform = lambda x: x.to(self.DEVICE)
+        self.featurize_model = self.featurize_model.to(self.DEVICE)
+        x4_small, x5_small, x4_large, x5_large = [], [], [], []
+        with torch.inference_mode():
+            for small, large in data_loader:
+                small = batch_transform(small).flatten(0, 1)
+                x4, x5 = self._extraction_layer45(self.featurize_model, small)
+                x4_small.append(np.max(x4.reshape(-1, num_pool, 256), axis=1))
+                x5_small.append(np.max(x5.reshape(-1, num_pool, 512), axis=1))
+                large = batch_transform(large)
+                x4, x5 = self._extraction_layer45(self.featurize_model, large)
+                x4_large.append(x4)
+                x5_large.append(x5)
+        return np.concatenate(
+            [np.concatenate(x5_small), np.concatenate(x5_large), np.concatenate(x4_small), np.concatenate(x4_large)],
+            axis=1,
+        )
+
     def _extraction_layer45(self, model, x):
         x = model[0](x)  # conv1
         x = model[1](x)  # bn
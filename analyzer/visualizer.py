@@ -20,6 +20,8 @@ import torch
 from torch import nn
 
 import analyzer
+from slide.location import LocationTable
+from slide.thumbnail import read_thumbnail
 
 
 class Visualizer:
@@ -40,8 +42,8 @@ class Visualizer:
         self.filein: Optional[str] = None
         self.image: Optional[OpenSlide] = None
         self.image_scaled: Optional[np.ndarray] = None
-        self.locations: Optional[List[Tuple[int, int]]] = None
-        self.locations_scaled: Optional[List[Tuple[int, int]]] = None
+        self.locations: Optional[LocationTable] = None
+        self.locations_scaled: Optional[LocationTable] = None
         self.result_patch: Optional[Dict[str, np.ndarray]] = None
         self.result_all: Optional[Dict[str, np.ndarray]] = None
         self.anomaly_proba: Optional[np.ndarray] = None
@@ -96,7 +98,7 @@ class Visualizer:
         )
         self.anomaly_proba = pd.DataFrame(self.result_patch).max(axis=1).values
         self.mask = self.Analyzer.mask
-        self.locations = self.Analyzer.locations[1]
+        self.locations = self.Analyzer.locations_large
         # set parameters
         self.filein = filein
         self.patch_size = patch_size
@@ -118,32 +120,14 @@ class Visualizer:
             print("Analyze before load image")
             return
         
-        # load image
+        # load image (streamed, patch = (scale foctor, scale factor))
         self.image = OpenSlide(self.filein)
-        level = self.image.get_best_level_for_downsample(
-            self.patch_size / scale_factor
+        self.image_scaled = read_thumbnail(
+            self.image, downsample=self.patch_size / scale_factor, channel="rgb"
         )
-        downsample = self.image.level_downsamples[level]
-        ratio = self.patch_size / scale_factor / downsample
-        # patch = (scale foctor, scale factor)
-        image = self.image.read_region(
-            location=(0, 0), level=level, size=self.image.level_dimensions[level]
-        )
-        self.image_scaled = np.array(
-            image.resize((int(image.width / ratio), int(image.height / ratio))),
-            np.uint8,
-        )[
-            :, :, :3
-        ]  # RGB
         # scaled locations
-        if self.locations:
-            self.locations_scaled = [
-                (
-                    int(i[0] / (self.patch_size / scale_factor)),
-                    int(i[1] / (self.patch_size / scale_factor)),
-                )
-                for i in self.locations
-            ]
+        if self.locations is not None:
+            self.locations_scaled = self.locations.scale(self.patch_size / scale_factor)
         # set
         self.scale_factor = scale_factor
 
@@ -164,7 +148,7 @@ class Visualizer:
             print("Image or locations not available.")
             return
         df_proba = pd.DataFrame(
-            {"proba": proba, "locate": self.locations_scaled}
+            {"proba": proba, "locate": self.locations_scaled.tolist()}
         )
         if df_proba[df_proba["proba"] > self.PROB_MID_THRESHOLD].empty:
             print(f"No high probability crops for {title}")
@@ -217,7 +201,7 @@ class Visualizer:
         df_proba = pd.DataFrame(
             {
                 "proba": self.anomaly_proba,
-                "locate": self.locations,
+                "locate": self.locations.tolist(),
             }
         ).sort_values(by="proba", ascending=False)
 
@@ -253,7 +237,7 @@ class Visualizer:
             return
         
         df_proba_base = pd.DataFrame(self.result_patch)
-        df_proba_base["locate"] = self.locations
+        df_proba_base["locate"] = self.locations.tolist()
 
         for key in self.result_patch.keys():
             if only_highscore and (self.result_all is None or self.result_all[key] <= self.PROB_MID_THRESHOLD):
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+# benchmark: vectorized tissue mask engine vs python flood fill
+
+@author: Katsuhisa MORITA
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from scipy import ndimage
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from slide import mask as mask_engine
+
+parser = argparse.ArgumentParser(description='mask engine benchmark')
+parser.add_argument('--lst_size', type=int, nargs='+', default=[64, 128, 256, 512, 1024])
+parser.add_argument('--slice_min_patch', type=int, default=100)
+parser.add_argument('--repeat', type=int, default=3)
+parser.add_argument('--seed', type=int, default=24771)
+
+def synthetic_mask(size:int=256, seed:int=24771):
+    """blob-like tissue mask (several slices + debris)"""
+    rng = np.random.default_rng(seed)
+    noise = ndimage.gaussian_filter(rng.random((size, int(size*1.5))), sigma=size/32)
+    return noise > np.quantile(noise, 0.6)
+
+def _timeit(fn, repeat:int=3):
+    lst_time = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        lst_time.append(time.perf_counter() - start)
+    return out, min(lst_time)
+
+def main():
+    args = parser.parse_args()
+    print(f"{'grid':>12} {'patches':>9} {'legacy [s]':>11} {'vectorized [s]':>15} {'speedup':>8} {'equal':>6}")
+    for size in args.lst_size:
+        mask = synthetic_mask(size=size, seed=args.seed)
+        legacy, t_legacy = _timeit(
+            lambda: mask_engine._mask_inside_legacy(mask, slice_min_patch=args.slice_min_patch),
+            repeat=1 if size > 512 else args.repeat,
+            )
+        vectorized, t_vectorized = _timeit(
+            lambda: mask_engine.mask_inside(mask, slice_min_patch=args.slice_min_patch),
+            repeat=args.repeat,
+            )
+        equal = np.array_equal(legacy, vectorized)
+        print(f"{str(mask.shape):>12} {int(mask.sum()):>9} {t_legacy:>11.4f} {t_vectorized:>15.4f} {t_legacy/t_vectorized:>7.1f}x {str(equal):>6}")
+        if not equal:
+            raise AssertionError(f"masks differ for grid {mask.shape}")
+
+if __name__ == '__main__':
+    main()
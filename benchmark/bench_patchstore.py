@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+# benchmark: compressed patch store vs raw .npy shard (disk footprint, random access decode throughput)
+
+@author: Katsuhisa MORITA
+"""
+import argparse
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+from openslide import OpenSlide
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sslmodel import patchstore
+from slide.region import read_region_rgb
+from benchmark.synthetic import make_synthetic_slide
+
+parser = argparse.ArgumentParser(description='patch store benchmark')
+parser.add_argument('--filein', type=str, default=None) # raw .npy shard, patches of a synthetic slide if None
+parser.add_argument('--num_patch', type=int, default=1024)
+parser.add_argument('--patch_size', type=int, default=256)
+parser.add_argument('--lst_codec', type=str, nargs='+', default=['png', 'webp', 'jpg'])
+parser.add_argument('--num_threads', type=int, default=4)
+parser.add_argument('--num_read', type=int, default=512)
+parser.add_argument('--seed', type=int, default=24771)
+
+def synthetic_shard(fileout:str="", num_patch:int=1024, patch_size:int=256, seed:int=24771):
+    image = OpenSlide(make_synthetic_slide("/tmp/bench_patchstore_slide.tif"))
+    width, height = image.dimensions
+    rng = np.random.default_rng(seed)
+    x = rng.integers(0, width - patch_size, num_patch)
+    y = rng.integers(0, height - patch_size, num_patch)
+    shard = np.lib.format.open_memmap(fileout, mode="w+", dtype=np.uint8, shape=(num_patch, patch_size, patch_size, 3))
+    for i in range(num_patch):
+        shard[i] = read_region_rgb(image, (x[i], y[i]), (patch_size, patch_size))
+    shard.flush()
+    return fileout
+
+def main():
+    args = parser.parse_args()
+    folder = tempfile.mkdtemp()
+    try:
+        filein = args.filein if args.filein else synthetic_shard(
+            f"{folder}/shard.npy", num_patch=args.num_patch, patch_size=args.patch_size, seed=args.seed,
+            )
+        raw = np.load(filein, mmap_mode="r")
+        rng = np.random.default_rng(args.seed)
+        indices = rng.integers(0, len(raw), args.num_read)
+        # raw: random access on the memory-mapped array
+        start = time.perf_counter()
+        ref = np.stack([np.array(raw[i]) for i in indices])
+        t_raw = time.perf_counter() - start
+        size_raw = os.path.getsize(filein)
+        print(f"{len(raw)} patches {raw.shape[1:]}, {len(indices)} random reads, {args.num_threads} threads")
+        print(f"{'format':>6} {'MB':>9} {'ratio':>6} {'encode [s]':>11} {'patches/s':>10} {'threaded/s':>11} {'max diff':>9}")
+        print(f"{'npy':>6} {size_raw/1e6:>9.1f} {1:>6.2f} {'-':>11} {len(indices)/t_raw:>10.1f} {'-':>11} {'-':>9}")
+        for codec in args.lst_codec:
+            start = time.perf_counter()
+            fileout = patchstore.convert_npy(filein, f"{folder}/shard_{codec}.pstore", codec=codec, num_threads=args.num_threads)
+            t_encode = time.perf_counter() - start
+            store = patchstore.PatchStore(fileout)
+            start = time.perf_counter()
+            res = np.stack([store[int(i)] for i in indices])
+            t_single = time.perf_counter() - start
+            start = time.perf_counter()
+            res_threaded = store.get_batch(indices, num_threads=args.num_threads)
+            t_threaded = time.perf_counter() - start
+            assert np.array_equal(res, res_threaded)
+            diff = np.abs(res.astype(int) - ref).max()
+            size = store.nbytes()
+            print(f"{codec:>6} {size/1e6:>9.1f} {size_raw/size:>6.2f} {t_encode:>11.2f} {len(indices)/t_single:>10.1f} {len(indices)/t_threaded:>11.1f} {diff:>9}")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+# benchmark: ImageProcessor.load_patch, one read per region vs one read per sub patch
+
+@author: Katsuhisa MORITA
+"""
+import argparse
+import os
+import sys
+import time
+from unittest import mock
+
+import numpy as np
+from openslide import OpenSlide
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from analyzer.imageprocessor import ImageProcessor
+
+parser = argparse.ArgumentParser(description='region loader benchmark')
+parser.add_argument('--filein', type=str, help='slide readable by OpenSlide')
+parser.add_argument('--patch_size', type=int, default=448)
+parser.add_argument('--lst_model_patch_size', type=int, nargs='+', default=[224, 112])
+parser.add_argument('--num_patch', type=int, default=200)
+parser.add_argument('--repeat', type=int, default=3)
+
+def load_patch_legacy(filein="", mask=None, patch_size=448, model_patch_size=224,):
+    """previous implementation (read_region per sub patch)"""
+    image = OpenSlide(filein)
+    res = []
+    lst_number = []
+    ap = res.append
+    for number in np.where(mask.flatten())[0]:
+        v_h, v_w = divmod(number, mask.shape[1])
+        lst_number.append(number)
+        for i in range(int(patch_size/model_patch_size)):
+            for v in range(int(patch_size/model_patch_size)):
+                patch_image=image.read_region(
+                    location=(
+                        int(v_w*patch_size + i*model_patch_size),
+                        int(v_h*patch_size + v*model_patch_size)
+                    ),
+                    level=0,
+                    size=(model_patch_size, model_patch_size))
+                ap(np.array(patch_image, np.uint8)[:,:,:3])
+    res=np.stack(res).astype(np.uint8)
+    return res, lst_number
+
+def _run(fn, repeat:int=3):
+    """(output, best wall time, read_region calls per run)"""
+    read_region = OpenSlide.read_region
+    lst_time = []
+    with mock.patch.object(OpenSlide, "read_region", autospec=True, side_effect=read_region) as counter:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            out = fn()
+            lst_time.append(time.perf_counter() - start)
+        n_call = counter.call_count // repeat
+    return out, min(lst_time), n_call
+
+def main():
+    args = parser.parse_args()
+    width, height = OpenSlide(args.filein).dimensions
+    grid = (height // args.patch_size, width // args.patch_size)
+    mask = np.zeros(grid[0]*grid[1], dtype=bool)
+    mask[:args.num_patch] = True
+    mask = mask.reshape(grid)
+    processor = ImageProcessor()
+    print(f"{int(mask.sum())} regions of {args.patch_size} px")
+    print(f"{'sub patch':>9} {'legacy calls':>13} {'calls':>6} {'legacy [s]':>11} {'single read [s]':>16} {'speedup':>8} {'equal':>6}")
+    for model_patch_size in args.lst_model_patch_size:
+        (legacy, legacy_number), t_legacy, n_legacy = _run(
+            lambda: load_patch_legacy(args.filein, mask, args.patch_size, model_patch_size), repeat=args.repeat,
+            )
+        (res, lst_number), t_new, n_new = _run(
+            lambda: processor.load_patch(args.filein, mask, args.patch_size, model_patch_size), repeat=args.repeat,
+            )
+        equal = np.array_equal(legacy, res) and list(legacy_number) == list(lst_number)
+        print(f"{model_patch_size:>9} {n_legacy:>13} {n_new:>6} {t_legacy:>11.4f} {t_new:>16.4f} {t_legacy/t_new:>7.1f}x {str(equal):>6}")
+        if not equal:
+            raise AssertionError(f"patches differ for model_patch_size {model_patch_size}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+# benchmark: row-coalesced strip reads vs per-patch read_region on a dense grid
+
+@author: Katsuhisa MORITA
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from openslide import OpenSlide
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from slide.location import LocationTable
+from slide.region import read_patches, read_region_rgb
+from benchmark.synthetic import make_synthetic_slide
+
+parser = argparse.ArgumentParser(description='strip reader benchmark')
+parser.add_argument('--filein', type=str, default=None) # synthetic slide if None
+parser.add_argument('--patch_size', type=int, default=224)
+parser.add_argument('--num_patch', type=int, default=512)
+parser.add_argument('--batch_size', type=int, default=128)
+parser.add_argument('--lst_strip_length', type=int, nargs='+', default=[1, 4, 8, 16, 32])
+parser.add_argument('--repeat', type=int, default=3)
+
+def _best(fn, repeat:int=3):
+    lst_time = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        lst_time.append(time.perf_counter() - start)
+    return out, min(lst_time)
+
+def main():
+    args = parser.parse_args()
+    filein = args.filein if args.filein else make_synthetic_slide("/tmp/bench_strip_slide.tif")
+    image = OpenSlide(filein)
+    width, height = image.dimensions
+    mask = np.zeros((height // args.patch_size, width // args.patch_size), dtype=bool)
+    mask.flat[:args.num_patch] = True # dense rows of the grid
+    locations = LocationTable.from_mask(mask, patch_size=args.patch_size)
+    lst_batch = [locations.xy[i:i+args.batch_size] for i in range(0, len(locations), args.batch_size)]
+
+    def per_patch():
+        return np.concatenate([
+            np.stack([read_region_rgb(image, loc, (args.patch_size, args.patch_size)) for loc in batch])
+            for batch in lst_batch
+            ])
+
+    ref, t_ref = _best(per_patch, repeat=args.repeat)
+    print(f"{len(locations)} patches of {args.patch_size} px, batch {args.batch_size}")
+    print(f"{'strip':>6} {'patches/s':>10} {'per-patch/s':>12} {'speedup':>8} {'equal':>6}")
+    for strip_length in args.lst_strip_length:
+        res, t = _best(lambda: np.concatenate([
+            read_patches(image, batch, patch_size=args.patch_size, strip_length=strip_length)
+            for batch in lst_batch
+            ]), repeat=args.repeat)
+        equal = np.array_equal(ref, res)
+        print(f"{strip_length:>6} {len(locations)/t:>10.1f} {len(locations)/t_ref:>12.1f} {t_ref/t:>7.2f}x {str(equal):>6}")
+        if not equal:
+            raise AssertionError(f"patches differ for strip_length {strip_length}")
+
+if __name__ == '__main__':
+    main()
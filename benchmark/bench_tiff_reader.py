@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+# benchmark: lazy tiled TIFF reader (slide.tiff) vs whole-slide imread + slicing (former wsi_masked.py)
+each reader runs in a fresh process to report its peak memory
+
+@author: Katsuhisa MORITA
+"""
+import argparse
+import os
+import sys
+import time
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tifffile
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from slide.tiff import TiffReader
+from benchmark.synthetic import make_synthetic_slide
+
+parser = argparse.ArgumentParser(description='tiff reader benchmark')
+parser.add_argument('--filein', type=str, default=None) # synthetic slide if None
+parser.add_argument('--patch_size', type=int, default=224)
+parser.add_argument('--num_patch', type=int, default=512)
+parser.add_argument('--seed', type=int, default=24771)
+
+def peak_rss():
+    """peak resident memory (MB) of this process (VmHWM, reset by exec unlike ru_maxrss)"""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+def _run(filein:str="", reader:str="lazy", patch_size:int=224, num_patch:int=512, seed:int=24771):
+    """patch digests, elapsed time and peak RSS (MB) of one reader"""
+    start = time.perf_counter()
+    image = TiffReader(filein) if reader == "lazy" else tifffile.imread(filein, key=0)
+    height, width = image.shape[:2]
+    rng = np.random.default_rng(seed)
+    ys = rng.integers(0, height - patch_size, num_patch)
+    xs = rng.integers(0, width - patch_size, num_patch)
+    # digests only, so that the peak memory is the one of the reader
+    res = [hashlib.md5(np.ascontiguousarray(image[y:y+patch_size, x:x+patch_size, :])).hexdigest() for y, x in zip(ys, xs)]
+    elapsed = time.perf_counter() - start
+    return res, elapsed, peak_rss()
+
+def main():
+    args = parser.parse_args()
+    filein = args.filein if args.filein else make_synthetic_slide("/tmp/bench_strip_slide.tif")
+    dict_res = dict()
+    for reader in ["imread", "lazy"]:
+        # fresh (spawned) process: the peak RSS is not inherited from this one
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            dict_res[reader] = executor.submit(
+                _run, filein, reader, args.patch_size, args.num_patch, args.seed,
+                ).result()
+    equal = dict_res["imread"][0] == dict_res["lazy"][0]
+    print(f"{args.num_patch} patches of {args.patch_size} px from {filein}")
+    print(f"{'reader':>7} {'time [s]':>9} {'peak RSS [MB]':>14}")
+    for reader, (_, elapsed, rss) in dict_res.items():
+        print(f"{reader:>7} {elapsed:>9.2f} {rss:>14.1f}")
+    print(f"equal: {equal}")
+    if not equal:
+        raise AssertionError("patches differ")
+
+if __name__ == '__main__':
+    main()
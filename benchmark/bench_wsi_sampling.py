@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+# benchmark: on-the-fly slide sampling (slide.sampling) vs memory-mapped .npy shards (data_handler.ShardDataset)
+
+@author: Katsuhisa MORITA
+"""
+import argparse
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import torchvision.transforms as transforms
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sslmodel import data_handler as dh
+from slide.cache import MaskCache
+import slide.cache as mask_cache
+from slide.sampling import WSIPatchDataset
+from tggate.utils import make_patch
+from benchmark.synthetic import make_synthetic_slide
+
+parser = argparse.ArgumentParser(description='slide sampling benchmark')
+parser.add_argument('--lst_filein', type=str, nargs='+', default=None) # synthetic slides if None
+parser.add_argument('--num_slide', type=int, default=4)
+parser.add_argument('--patch_size', type=int, default=256)
+parser.add_argument('--num_patch', type=int, default=256) # per slide for the shard
+parser.add_argument('--slice_min_patch', type=int, default=10)
+parser.add_argument('--batch_size', type=int, default=64)
+parser.add_argument('--num_workers', type=int, default=2)
+parser.add_argument('--num_epoch', type=int, default=3)
+parser.add_argument('--lst_reader', type=str, nargs='+', default=['openslide', 'tiff']) # slide readers of the sampling path
+parser.add_argument('--max_open', type=int, default=64)
+
+def _run(loader, num_epoch:int=3):
+    """patches/s of each epoch (the first includes the worker start)"""
+    res = []
+    for epoch in range(num_epoch):
+        loader.set_epoch(epoch)
+        start = time.perf_counter()
+        n = sum(len(batch) for batch in loader)
+        res.append(n / (time.perf_counter() - start))
+    return res
+
+def main():
+    args = parser.parse_args()
+    folder = tempfile.mkdtemp()
+    try:
+        mask_cache._default_cache = MaskCache(f"{folder}/mask")
+        lst_filein = args.lst_filein if args.lst_filein else [
+            make_synthetic_slide(f"{folder}/slide{i}.tif", seed=i) for i in range(args.num_slide)
+            ]
+        transform = transforms.ToTensor()
+        # shard path: patches materialized once
+        shard = np.concatenate([
+            make_patch(filein, patch_size=args.patch_size, num_patch=args.num_patch, random_state=i, inside=False)[0]
+            for i, filein in enumerate(lst_filein)
+            ])
+        np.save(f"{folder}/shard.npy", shard)
+        num_sample = len(shard)
+        del shard
+        loader_npy = dh.prep_shard_dataloader(
+            dh.ShardDataset([f"{folder}/shard.npy"], transform=transform), args.batch_size,
+            num_workers=args.num_workers, pin_memory=False,
+            )
+        # sampling path, one loader per reader
+        lst_loader = [("npy", loader_npy)]
+        for reader in args.lst_reader:
+            dataset = WSIPatchDataset(
+                lst_filein, patch_size=args.patch_size, num_sample=num_sample, transform=transform,
+                slice_min_patch=args.slice_min_patch, max_open=args.max_open, reader=reader,
+                )
+            lst_loader.append((reader, dh.TimedLoader(dh.prep_dataloader(
+                dataset, args.batch_size, shuffle=False, num_workers=args.num_workers, pin_memory=False,
+                persistent_workers=args.num_workers > 0,
+                ))))
+        print(f"{len(lst_filein)} slides, {num_sample} patches / epoch, {args.num_workers} workers")
+        for name, loader in lst_loader:
+            print(f"{name:>9} patches/s per epoch: " + " ".join([f"{v:.1f}" for v in _run(loader, args.num_epoch)]))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+# check: batched ssl augmentation (sslmodel.augment) vs the PIL pipeline (sslmodel.utils.ssl_transform)
+1. random parameters: KS tests against the torchvision get_params, binomial / chi-square tests of the probabilities
+2. each operation against its PIL version on the same parameters
+3. whole pipeline: KS tests of the per-image statistics of the augmented views
+4. time per image
+
+@author: Katsuhisa MORITA
+"""
+import argparse
+import os
+import sys
+import time
+import itertools
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+import torchvision.transforms.functional as TF
+from PIL import Image
+from scipy import stats
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sslmodel import augment
+from sslmodel.utils import ssl_transform
+from slide.tiff import TiffReader
+from benchmark.synthetic import make_synthetic_slide
+
+parser = argparse.ArgumentParser(description='batched augmentation check')
+parser.add_argument('--filein', type=str, default=None) # synthetic slide if None
+parser.add_argument('--patch_size', type=int, default=256)
+parser.add_argument('--num_image', type=int, default=16)
+parser.add_argument('--num_param', type=int, default=20000) # samples of the parameter tests
+parser.add_argument('--num_view', type=int, default=1024) # views of the pipeline test
+parser.add_argument('--alpha', type=float, default=1e-3)
+parser.add_argument('--seed', type=int, default=24771)
+
+def load_patches(filein:str="", patch_size:int=256, num_image:int=16, seed:int=24771):
+    """uint8 patches [num_image, patch_size, patch_size, 3] of the slide (tissue rich ones)"""
+    reader = TiffReader(filein)
+    rng = np.random.default_rng(seed)
+    lst_patch = []
+    while len(lst_patch) < num_image:
+        y, x = rng.integers(0, reader.shape[0] - patch_size), rng.integers(0, reader.shape[1] - patch_size)
+        patch = reader.read(y, y + patch_size, x, x + patch_size)[..., :3]
+        if patch.mean() < 220: # not background
+            lst_patch.append(patch)
+    return np.stack(lst_patch)
+
+class Checker:
+    def __init__(self, alpha:float=1e-3):
+        self.alpha = alpha
+        self.failed = []
+
+    def pvalue(self, name:str="", p:float=1.):
+        ok = p >= self.alpha
+        print(f"{name:>28} p={p:.4f} {'ok' if ok else 'FAILED'}")
+        if not ok:
+            self.failed.append(name)
+
+    def ks(self, name:str="", a=None, b=None):
+        self.pvalue(f"KS {name}", stats.ks_2samp(np.asarray(a), np.asarray(b)).pvalue)
+
+    def rate(self, name:str="", x=None, p:float=0.5):
+        x = np.asarray(x)
+        self.pvalue(f"binomial {name}", stats.binomtest(int(x.sum()), len(x), p).pvalue if 0 < p < 1 else float(x.mean() == p))
+
+    def close(self, name:str="", out=None, lst_ref=list(), tol:float=1., frac:float=0.):
+        ref = torch.stack([torch.from_numpy(np.array(r)).movedim(-1, 0).float() for r in lst_ref])
+        diff = (out - ref).abs()
+        ok = (diff > tol).float().mean().item() <= frac
+        print(f"{name:>28} max |diff| {diff.max().item():.0f}, > {tol:g}: {(diff > tol).float().mean().item():.4f} {'ok' if ok else 'FAILED'}")
+        if not ok:
+            self.failed.append(name)
+
+def check_params(checker, n:int=20000, height:int=256, width:int=256, seed:int=0):
+    aug = augment.BatchAugment(color_plob=0.8, blur_plob=0.4, solar_plob=0.2, generator=torch.Generator().manual_seed(seed))
+    params = aug.sample_params(n, height, width)
+    torch.manual_seed(seed)
+    img = torch.empty(3, height, width)
+    # references: get_params of the PIL pipeline
+    angle = [transforms.RandomRotation.get_params([0, 180]) for _ in range(n)]
+    jitter = [transforms.ColorJitter.get_params((0.6, 1.4), (0.6, 1.4), (0.8, 1.2), (-0.1, 0.1)) for _ in range(n)]
+    sigma = [transforms.GaussianBlur.get_params(1.0, 2.0) for _ in range(n)]
+    crop = np.array([transforms.RandomResizedCrop.get_params(img, (0.08, 1.0), (3 / 4, 4 / 3)) for _ in range(n)])
+    checker.ks("angle", params["angle"], angle)
+    for i, key in enumerate(["brightness", "contrast", "saturation", "hue"]):
+        checker.ks(key, params[key], [v[i + 1] for v in jitter])
+    checker.ks("blur sigma", params["sigma"], sigma)
+    for i, key in enumerate(["top", "left", "height", "width"]):
+        checker.ks(f"crop {key}", params["crop"][:, i], crop[:, i])
+    for key, p in [("flip", 0.5), ("color", 0.8), ("gray", 0.2), ("blur", 0.4), ("solar", 0.2)]:
+        checker.rate(key, params[key], p)
+    # ColorJitter order: 24 permutations, uniform
+    lst_perm = [tuple(v) for v in itertools.permutations(range(4))]
+    count = np.zeros(len(lst_perm))
+    for v in params["order"].tolist():
+        count[lst_perm.index(tuple(v))] += 1
+    checker.pvalue("chi-square jitter order", stats.chisquare(count).pvalue)
+
+def check_operations(checker, patches):
+    """each batched operation vs the PIL one on the same parameters (uint8 rounding: 1)"""
+    n = len(patches)
+    x = torch.from_numpy(patches).movedim(-1, 1).float()
+    lst_pil = [Image.fromarray(v) for v in patches]
+    rng = torch.Generator().manual_seed(0)
+    f = torch.empty(n).uniform_(0.6, 1.4, generator=rng)
+    s = torch.empty(n).uniform_(0.8, 1.2, generator=rng)
+    h = torch.empty(n).uniform_(-0.1, 0.1, generator=rng)
+    sigma = torch.empty(n).uniform_(1.0, 2.0, generator=rng)
+    angle = torch.empty(n).uniform_(0, 180, generator=rng)
+    box = augment.sample_crop(n, x.shape[2], x.shape[3], generator=rng)
+    checker.close("brightness", augment._brightness(x.clone(), f), [TF.adjust_brightness(p, float(v)) for p, v in zip(lst_pil, f)])
+    checker.close("contrast", augment._contrast(x.clone(), f), [TF.adjust_contrast(p, float(v)) for p, v in zip(lst_pil, f)])
+    checker.close("saturation", augment._saturation(x.clone(), s), [TF.adjust_saturation(p, float(v)) for p, v in zip(lst_pil, s)])
+    # PIL converts the hue in 8 bits HSV: reference is the torchvision tensor version
+    checker.close("hue", augment._hue(x.clone(), h), [TF.adjust_hue(t, float(v)).movedim(0, -1).numpy() for t, v in zip(x.to(torch.uint8), h)])
+    checker.close("grayscale", augment._gray(x.clone()).expand(-1, 3, -1, -1), [p.convert("L").convert("RGB") for p in lst_pil])
+    checker.close("gaussian blur", augment._gaussian_blur(x.clone(), sigma), [TF.gaussian_blur(p, [3, 3], [float(v), float(v)]) for p, v in zip(lst_pil, sigma)])
+    # nearest neighbours on the edges of the pixels may differ
+    checker.close("rotation", augment._rotate(x.clone(), angle), [TF.rotate(p, float(v)) for p, v in zip(lst_pil, angle)], frac=0.01)
+    checker.close("resized crop", augment._resized_crop(x.clone(), box, (224, 224)), [TF.resized_crop(p, *box[i].tolist(), [224, 224]) for i, p in enumerate(lst_pil)])
+
+def image_stats(views):
+    """per-image channel means and stds [n, 6]"""
+    return torch.cat([views.mean(dim=(2, 3)), views.std(dim=(2, 3))], dim=1).numpy()
+
+def check_pipeline(checker, patches, num_view:int=1024, seed:int=0):
+    """views of the PIL pipeline and of the batched one from the same images"""
+    kwargs = dict(color_plob=0.8, blur_plob=0.4, solar_plob=0.2)
+    transform = ssl_transform(**kwargs)
+    aug = augment.batch_ssl_transform(**kwargs, generator=torch.Generator().manual_seed(seed))
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    lst_pil = [Image.fromarray(v) for v in patches]
+    idx = np.arange(num_view) % len(patches)
+    start = time.perf_counter()
+    views_pil = torch.stack([transform(lst_pil[i]) for i in idx])
+    time_pil = time.perf_counter() - start
+    batch = torch.from_numpy(patches[idx])
+    start = time.perf_counter()
+    views_batch = torch.cat([aug(v) for v in batch.split(128)])
+    time_batch = time.perf_counter() - start
+    res_pil, res_batch = image_stats(views_pil), image_stats(views_batch)
+    for i, name in enumerate(["mean R", "mean G", "mean B", "std R", "std G", "std B"]):
+        checker.ks(f"views {name}", res_pil[:, i], res_batch[:, i])
+    print(f"PIL {1000*time_pil/num_view:.2f} ms/image, batched {1000*time_batch/num_view:.2f} ms/image (cpu)")
+
+def check_views(patches):
+    """shapes of the multi view transforms"""
+    batch = torch.from_numpy(patches[:4])
+    two = augment.batch_ssl_transform(split=True)(batch)
+    multi = augment.batch_ssl_transform(split=True, multi=True)(batch)
+    weak_strong = augment.batch_weak_strong_transform()(batch)
+    assert len(two) == 2 and all([v.shape == (4, 3, 224, 224) for v in two])
+    # MultiCropsTransform: RandomResizedCrop(crop size) then the base transform (224 output)
+    assert len(multi) == 8 and all([v.shape == (4, 3, 224, 224) for v in multi])
+    assert len(weak_strong) == 2 and all([v.shape == (4, 3, 224, 224) for v in weak_strong])
+    print("views: two crops, multi crops, weak / strong ok")
+
+def main():
+    args = parser.parse_args()
+    filein = args.filein if args.filein else make_synthetic_slide("/tmp/bench_strip_slide.tif")
+    patches = load_patches(filein, args.patch_size, args.num_image, args.seed)
+    checker = Checker(alpha=args.alpha)
+    check_params(checker, n=args.num_param, height=args.patch_size, width=args.patch_size, seed=args.seed)
+    check_operations(checker, patches)
+    check_pipeline(checker, patches, num_view=args.num_view, seed=args.seed)
+    check_views(patches)
+    if checker.failed:
+        raise AssertionError(f"failed: {checker.failed}")
+
+if __name__ == '__main__':
+    main()
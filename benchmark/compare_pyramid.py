@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+# pyramid-aware reads vs level 0 read + Resize((224,224)): numerical difference and time
+
+@author: Katsuhisa MORITA
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from openslide import OpenSlide
+import torchvision.transforms as transforms
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from slide.location import LocationTable
+from slide.region import read_region_scaled
+from benchmark.synthetic import make_synthetic_slide
+
+parser = argparse.ArgumentParser(description='pyramid read comparison')
+parser.add_argument('--filein', type=str, default=None) # synthetic slide (levels 2, 8, 32) if None
+parser.add_argument('--patch_size', type=int, default=448)
+parser.add_argument('--out_size', type=int, default=224)
+parser.add_argument('--num_patch', type=int, default=256)
+parser.add_argument('--seed', type=int, default=24771)
+
+def main():
+    args = parser.parse_args()
+    filein = args.filein if args.filein else make_synthetic_slide(
+        "/tmp/compare_pyramid_slide.tif", lst_downsample=[2, 8, 32],
+        )
+    image = OpenSlide(filein)
+    level = image.get_best_level_for_downsample(args.patch_size / args.out_size)
+    print(f"levels: {image.level_downsamples}, used level: {level} (downsample {image.level_downsamples[level]})")
+    width, height = image.dimensions
+    grid = np.zeros((height // args.patch_size, width // args.patch_size), dtype=bool)
+    rng = np.random.default_rng(args.seed)
+    grid.flat[rng.choice(grid.size, min(args.num_patch, grid.size), replace=False)] = True
+    locations = LocationTable.from_mask(grid, patch_size=args.patch_size)
+    resize = transforms.Resize((args.out_size, args.out_size), antialias=True)
+    size, out_size = (args.patch_size, args.patch_size), (args.out_size, args.out_size)
+
+    start = time.perf_counter()
+    ref = np.stack([
+        np.asarray(resize(image.read_region(location=loc, level=0, size=size).convert("RGB")))
+        for loc in locations
+        ]).astype(np.float64)
+    t_ref = time.perf_counter() - start
+    start = time.perf_counter()
+    res = np.stack([
+        np.asarray(read_region_scaled(image, location=loc, size=size, out_size=out_size))
+        for loc in locations
+        ]).astype(np.float64)
+    t_res = time.perf_counter() - start
+
+    diff = np.abs(res - ref)
+    mse = np.mean((res - ref) ** 2)
+    psnr = 10 * np.log10(255 ** 2 / mse) if mse > 0 else float("inf")
+    print(f"{len(locations)} patches {args.patch_size} px -> {args.out_size} px")
+    print(f"mean abs diff: {diff.mean():.4f}, max abs diff: {diff.max():.0f}, PSNR: {psnr:.2f} dB")
+    print(f"pixels with diff > 2: {np.mean(diff.max(axis=3) > 2)*100:.3f} %")
+    print(f"level 0 + Resize: {t_ref:.3f} s, pyramid: {t_res:.3f} s ({t_ref/t_res:.2f}x)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+# stress check: lazy per-worker OpenSlide handles (slide.handle) under fork and spawn
+many workers read random patches of many slides, the result must equal a serial read,
+the parent process must not open any handle and no slide file must stay open
+
+@author: Katsuhisa MORITA
+"""
+import argparse
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from slide.location import LocationTable
+from analyzer.analyzer import PatchDatasetLocation
+from benchmark.synthetic import make_synthetic_slide
+
+parser = argparse.ArgumentParser(description='lazy slide handle stress check')
+parser.add_argument('--num_slide', type=int, default=16)
+parser.add_argument('--slide_size', type=int, default=2048)
+parser.add_argument('--num_patch', type=int, default=64) # per slide
+parser.add_argument('--patch_size', type=int, default=224)
+parser.add_argument('--batch_size', type=int, default=32)
+parser.add_argument('--lst_num_workers', type=int, nargs='+', default=[2, 8])
+parser.add_argument('--lst_method', type=str, nargs='+', default=['fork', 'spawn'])
+parser.add_argument('--cache_size', type=int, default=16 << 20)
+parser.add_argument('--num_epoch', type=int, default=2)
+parser.add_argument('--seed', type=int, default=24771)
+
+def open_files(folder:str=""):
+    """files of folder opened by this process"""
+    res = []
+    for fd in os.listdir("/proc/self/fd"):
+        try:
+            path = os.readlink(f"/proc/self/fd/{fd}")
+        except OSError:
+            continue
+        if path.startswith(folder):
+            res.append(path)
+    return res
+
+def make_dataset(lst_filein=list(), num_patch:int=64, patch_size:int=224, cache_size:int=None, seed:int=24771):
+    rng = np.random.default_rng(seed)
+    lst_dataset = []
+    for filein in lst_filein:
+        size = int(os.path.basename(filein).split("_")[1].split(".")[0])
+        xy = rng.integers(0, size - patch_size, (num_patch, 2))
+        lst_dataset.append(PatchDatasetLocation(
+            filein, LocationTable(xy), transform=transforms.PILToTensor(),
+            patch_size=patch_size, cache_size=cache_size,
+            ))
+    return torch.utils.data.ConcatDataset(lst_dataset)
+
+def run(dataset, batch_size:int=32, num_workers:int=0, method:str=None, seed:int=0):
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+        generator=torch.Generator().manual_seed(seed),
+        multiprocessing_context=method if num_workers > 0 else None,
+        )
+    return torch.cat(list(loader))
+
+def main():
+    args = parser.parse_args()
+    folder = tempfile.mkdtemp()
+    try:
+        lst_filein = [
+            make_synthetic_slide(
+                f"{folder}/slide{i}_{args.slide_size}.tif", width=args.slide_size, height=args.slide_size,
+                lst_downsample=[4], seed=i,
+                ) for i in range(args.num_slide)
+            ]
+        dataset = make_dataset(lst_filein, args.num_patch, args.patch_size, args.cache_size, args.seed)
+        print(f"{args.num_slide} slides, {len(dataset)} patches, cache {args.cache_size} bytes per handle")
+        # reference: serial read in this process, then the handles are closed
+        lst_ref = [run(dataset, args.batch_size, 0, seed=epoch) for epoch in range(args.num_epoch)]
+        for ds in dataset.datasets:
+            ds.close()
+        assert not open_files(folder), "handles left open after close()"
+        for method in args.lst_method:
+            for num_workers in args.lst_num_workers:
+                start = time.perf_counter()
+                for epoch in range(args.num_epoch):
+                    res = run(dataset, args.batch_size, num_workers, method, seed=epoch)
+                    assert torch.equal(res, lst_ref[epoch]), f"patches differ: {method}, {num_workers} workers"
+                elapsed = time.perf_counter() - start
+                assert not any([ds.slide.is_open() for ds in dataset.datasets]), "handle opened in the parent"
+                assert not open_files(folder), "slide files open in the parent"
+                print(f"{method:>6} {num_workers:>3} workers: {args.num_epoch*len(dataset)/elapsed:>8.1f} patches/s, ok")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+# synthetic tiled pyramid slide for benchmarks (readable by OpenSlide as generic tiff)
+
+@author: Katsuhisa MORITA
+"""
+import argparse
+
+import numpy as np
+import cv2
+import tifffile
+
+parser = argparse.ArgumentParser(description='synthetic slide')
+parser.add_argument('--fileout', type=str, default='/tmp/slide.tif')
+parser.add_argument('--width', type=int, default=8192)
+parser.add_argument('--height', type=int, default=6144)
+parser.add_argument('--tile', type=int, default=256)
+parser.add_argument('--seed', type=int, default=24771)
+
+def make_synthetic_slide(fileout:str="/tmp/slide.tif", width:int=8192, height:int=6144, tile:int=256, lst_downsample=[4, 16, 64], seed:int=24771):
+    """
+    tissue-like blobs (pink, saturated) on a white background with pixel noise,
+    level 0 + reduced levels, tiled and zlib compressed
+    """
+    rng = np.random.default_rng(seed)
+    blob = cv2.GaussianBlur(rng.random((height // 64, width // 64)).astype(np.float32), (0, 0), 3)
+    tissue = cv2.resize(blob, (width, height), interpolation=cv2.INTER_LINEAR) > np.quantile(blob, 0.5)
+    image = np.full((height, width, 3), 240, dtype=np.uint8)
+    image[tissue] = (200, 110, 170)
+    image += rng.integers(0, 16, size=(height, width, 1), dtype=np.uint8) # in place, shared over channels
+    with tifffile.TiffWriter(fileout, bigtiff=True) as tif:
+        tif.write(image, tile=(tile, tile), compression="zlib", photometric="rgb")
+        for downsample in lst_downsample:
+            reduced = cv2.resize(image, (width // downsample, height // downsample), interpolation=cv2.INTER_AREA)
+            tif.write(reduced, tile=(tile, tile), compression="zlib", photometric="rgb", subfiletype=1)
+    return fileout
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print(make_synthetic_slide(args.fileout, width=args.width, height=args.height, tile=args.tile, seed=args.seed))
@@ -138,19 +138,14 @@ def prepare_ssl_data(batch_size:int=32, ):
 def prepare_data(batch_size:int=32, ):
     """
     data preparation
-    
+    val / test workers yield uint8 patches, CenterCrop((224,224)) + ToTensor + normalize run once per batch on DEVICE
+    returns train_loader, val_loader, test_loader, batch_transform (of the val / test batches)
     """
     train_transform = utils.ssl_transform(
         split=False, size=(224,224),
         color_plob=args.color_plob, blur_plob=args.blur_plob, solar_plob=args.solar_plob,
     )
-    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                    std=[0.229, 0.224, 0.225])
-    test_transform = transforms.Compose([
-        transforms.CenterCrop((224,224)),
-        transforms.ToTensor(),
-        normalize
-    ])
+    test_transform, batch_transform = dh.prepare_uint8_transform(crop=(224,224), DEVICE=DEVICE)
     train_dataset = ColonDataset(
         split="train",
         transform=train_transform,
@@ -165,9 +160,9 @@ def prepare_data(batch_size:int=32, ):
         )
     # to loader
     train_loader = dh.prep_dataloader(train_dataset, batch_size, shuffle=True, drop_last=True)
-    val_loader = dh.prep_dataloader(val_dataset, batch_size, shuffle=False, drop_last=False)
-    test_loader = dh.prep_dataloader(test_dataset, batch_size, shuffle=False, drop_last=False)
-    return train_loader, val_loader, test_loader
+    val_loader = dh.prep_dataloader(val_dataset, batch_size, shuffle=False, drop_last=False, collate_fn=dh.collate_uint8)
+    test_loader = dh.prep_dataloader(test_dataset, batch_size, shuffle=False, drop_last=False, collate_fn=dh.collate_uint8)
+    return train_loader, val_loader, test_loader, batch_transform
 
 def _load_state_dict_dense(model, weights):
     # '.'s are no longer allowed in module names, but previous _DenseLayer
@@ -298,10 +293,10 @@ def train_epoch_ssl(model, train_loader, criterion, optimizer):
         optimizer.step() # update parameters
     return model, np.mean(train_batch_loss)
 
-def train_epoch(model, train_loader, val_loader, criterion, optimizer):
+def train_epoch(model, train_loader, val_loader, criterion, optimizer, batch_transform=None):
     """
     train for epoch
-    
+    batch_transform: applied to the val batches instead of .to(DEVICE) (BatchNormalize of uint8 batches)
     """
     model.train() # training
     train_batch_loss = []
@@ -317,7 +312,8 @@ def train_epoch(model, train_loader, val_loader, criterion, optimizer):
     val_batch_loss = []
     with torch.inference_mode():
         for data, label in val_loader:
-            data, label = data.to(DEVICE), label.to(DEVICE)
+            data = batch_transform(data) if batch_transform is not None else data.to(DEVICE)
+            label = label.to(DEVICE)
             output = model(data)
             loss = criterion(output, label.squeeze_())
             val_batch_loss.append(loss.item())
@@ -343,13 +339,13 @@ def train_ssl(model, train_loader, criterion, optimizer, scheduler, early_stoppi
             return model, train_loss
     return model, train_loss
 
-def train(model, train_loader, val_loader, criterion, optimizer, scheduler, early_stopping, num_epoch:int=100):
+def train(model, train_loader, val_loader, criterion, optimizer, scheduler, early_stopping, num_epoch:int=100, batch_transform=None):
     """ train main model """
     train_loss = []
     val_loss = []
     for epoch in range(num_epoch):
         model, train_epoch_loss, val_epoch_loss = train_epoch(
-            model, train_loader, val_loader, criterion, optimizer
+            model, train_loader, val_loader, criterion, optimizer, batch_transform=batch_transform
             )
         scheduler.step() # should be removed if not necessary
         train_loss.append(train_epoch_loss)
@@ -365,14 +361,15 @@ def train(model, train_loader, val_loader, criterion, optimizer, scheduler, earl
     return model, train_loss, val_loss
 
 # predict
-def predict(model, dataloader):
-    """prediction"""
+def predict(model, dataloader, batch_transform=None):
+    """prediction, batch_transform: as train_epoch"""
     model.eval()
     y_true = torch.tensor([]).to(DEVICE)
     y_pred = torch.tensor([]).to(DEVICE)
     with torch.inference_mode():
         for data, label in dataloader:
-            data, label = data.to(DEVICE), label.to(DEVICE)
+            data = batch_transform(data) if batch_transform is not None else data.to(DEVICE)
+            label = label.to(DEVICE)
             output = model(data)
             output = output.softmax(dim=-1) # pay attention: softmax function
             y_true = torch.cat((y_true, label), 0)
@@ -442,7 +439,7 @@ def main():
     else:
         model=None
     # 2. Classifier Training
-    train_loader, val_loader, test_loader = prepare_data(batch_size=args.batch_size)
+    train_loader, val_loader, test_loader, batch_transform = prepare_data(batch_size=args.batch_size)
     model, criterion, optimizer, scheduler, early_stopping = prepare_model(
         model, model_name=args.model_name,
         lr=args.lr, num_epoch=args.num_epoch,
@@ -450,7 +447,7 @@ def main():
     model, train_loss, val_loss = train(
         model, train_loader, val_loader, 
         criterion, optimizer, scheduler, early_stopping, 
-        num_epoch=args.num_epoch,
+        num_epoch=args.num_epoch, batch_transform=batch_transform,
         )
     plot.plot_progress(train_loss, val_loss, DIR_NAME)
     sslmodel.utils.summarize_model(
@@ -460,9 +457,9 @@ def main():
     # 3. evaluation
     res1 = predict(model, train_loader)
     LOGGER.logger.info(f'train acc: {res1[1]:.4f}, auc{res1[0].loc["AUROC","Macro Average"]: 4f}')
-    res2 = predict(model, val_loader)
+    res2 = predict(model, val_loader, batch_transform=batch_transform)
     LOGGER.logger.info(f'val acc: {res2[1]:.4f}, auc{res2[0].loc["AUROC","Macro Average"]: 4f}')
-    res3 = predict(model, test_loader)
+    res3 = predict(model, test_loader, batch_transform=batch_transform)
     LOGGER.logger.info(f'test acc: {res3[1]:.4f}, auc{res3[0].loc["AUROC","Macro Average"]: 4f}')
     pd.to_pickle([res1, res2, res3], f"{DIR_NAME}/result.pickle")
 
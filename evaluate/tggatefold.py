@@ -47,7 +47,7 @@ class ClassificationFold:
         layer=0,
         pretrained=False,
         n_fold=5,
-        wsi=False, num_patch=None, strategy="max", random_state=24771,
+        wsi=False, num_patch=None, strategy="max", random_state=24771, store=False,
         convertz=True,
         compression=False, n_components=16,
         pred_method="logistic_regression", params=dict(),
@@ -104,6 +104,7 @@ class ClassificationFold:
                         num_patch=num_patch, strategy=strategy, random_state=random_state,
                         convertz=convertz,
                         compression=compression, n_components=n_components,
+                        store=store,
                     )
                 else:
                     arr_x_train, arr_x_test = utils.load_array_fold(
@@ -14,6 +14,7 @@ from sklearn.manifold import TSNE, MDS
 from sklearn.metrics import pairwise_distances
 from scipy import stats
 from mil.Pooling import PoolingMIL
+from tggate.featurestore import FeatureStore, store_path
 
 import settings
 # file name
@@ -97,30 +98,41 @@ def load_array_fold(
         arr_x_train, arr_x_test = standardize(arr_x_train, arr_x_test)
     return arr_x_train, arr_x_test
 
+def _load_feature(filein):
+    """features of a slide: .npy file path or array (feature store slice)"""
+    if isinstance(filein, str):
+        return np.load(filein).astype(np.float32)
+    return filein
+
 def load_array_fold_wsi(
     df_info, fold:int=10, layer:int=10, 
     folder="", name="layer", pretrained=False,
     num_patch=256, strategy="max", random_state=24771,
     convertz=True,
     compression=False, n_components=2, 
+    store=False,
     ):
+    """store: read the feature store {folder}/{pretrained|fold{fold}}.fstore (tggate.featurestore) instead of .npy files"""
     # load info
     random.seed(random_state)
     ind_train=df_info[df_info["FOLD"]!=fold]["INDEX"].tolist()
     ind_test=df_info[df_info["FOLD"]==fold]["INDEX"].tolist()
-    if pretrained:
-        lst_train=[f"{folder}/pretrained_{i}_{name}{layer}.npy" for i in ind_train]
-        lst_test=[f"{folder}/pretrained_{i}_{name}{layer}.npy" for i in ind_test]
+    prefix="pretrained_" if pretrained else f"fold{fold}_"
+    if store:
+        # memory-mapped slices of the slides (no copy)
+        fstore=FeatureStore(store_path(folder, prefix))
+        lst_train=[fstore.get(f"{prefix}{i}", f"{name}{layer}") for i in ind_train]
+        lst_test=[fstore.get(f"{prefix}{i}", f"{name}{layer}") for i in ind_test]
     else:
-        lst_train=[f"{folder}/fold{fold}_{i}_{name}{layer}.npy" for i in ind_train]
-        lst_test=[f"{folder}/fold{fold}_{i}_{name}{layer}.npy" for i in ind_test]
+        lst_train=[f"{folder}/{prefix}{i}_{name}{layer}.npy" for i in ind_train]
+        lst_test=[f"{folder}/{prefix}{i}_{name}{layer}.npy" for i in ind_test]
     # load
     dat=PoolingMIL(strategy=strategy, random_state=random_state)
     for filein in lst_train:
-        dat.pooling_data(np.load(filein).astype(np.float32), num_patch=num_patch)
+        dat.pooling_data(_load_feature(filein), num_patch=num_patch)
     dat.set_train_data()
     for filein in lst_test:
-        dat.pooling_data(np.load(filein).astype(np.float32), num_patch=num_patch)
+        dat.pooling_data(_load_feature(filein), num_patch=num_patch)
     dat.set_test_data()
     arr_x_train=dat.train_data
     arr_x_test=dat.test_data
@@ -17,21 +17,19 @@ import datetime
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
-import cv2
-from openslide import OpenSlide
 
 sys.path.append(f"{root}/src/SelfSupervisedLearningPathology")
-from tggate.utils import get_mask_inside
+from slide.cache import get_mask_inside_multi, save_locations
 
-def save_mask(filein, fileout, patch_size:int=None, slice_min_patch:int=None,):
-    # mask
-    wsi = OpenSlide(filein)
-    mask_inside=get_mask_inside(wsi, patch_size=patch_size, slice_min_patch=slice_min_patch)
-    lst_number=np.array(range(len(mask_inside.flatten())))[mask_inside.flatten()]
-    if len(lst_number)==0:
-        print(fileout)
-    lst_location=[[int(patch_size*v) for v in divmod(number, mask_inside.shape[1])] for number in lst_number]
-    pd.to_pickle(lst_location, fileout)
+def save_mask(filein, lst_fileout, lst_patch_size=[224, 448], lst_slice_min_patch=[1000, 100],):
+    # one slide read for all patch sizes
+    # mask (cached) / locations: int32 [n_patch, (x, y)]
+    dict_res=get_mask_inside_multi(filein, lst_patch_size=lst_patch_size, lst_slice_min_patch=lst_slice_min_patch)
+    for patch_size, fileout in zip(lst_patch_size, lst_fileout):
+        _, locations=dict_res[patch_size]
+        if len(locations)==0:
+            print(fileout)
+        save_locations(locations, fileout)
 
 if __name__=="__main__":
     # settings
@@ -41,13 +39,12 @@ if __name__=="__main__":
     # load
     df_info=pd.read_csv(f"{root}/data/tggate_info_ext.csv")
     lst_filein=df_info["DIR_temp"].tolist()
-    for i in range(2):
-        lst_fileout=[f"{folder_out}/{lst_patch_size[i]}/{v}_location.pickle" for v in list(range(df_info.shape[0]))]
+    for v, filein in tqdm(enumerate(lst_filein)):
+        lst_fileout=[f"{folder_out}/{patch_size}/{v}_location.npy" for patch_size in lst_patch_size]
         # masked patch
-        for filein, fileout in tqdm(zip(lst_filein, lst_fileout)):
-            if not os.path.isfile(fileout):
-                save_mask(
-                    filein, fileout,
-                    patch_size=lst_patch_size[i],
-                    slice_min_patch=lst_min[i],
-                    )
\ No newline at end of file
+        if not all([os.path.isfile(fileout) for fileout in lst_fileout]):
+            save_mask(
+                filein, lst_fileout,
+                lst_patch_size=lst_patch_size,
+                lst_slice_min_patch=lst_min,
+                )
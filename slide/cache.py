@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+# tissue mask / patch location cache
+keyed by slide content and mask parameters
+
+layout: {folder}/{key}/mask.npy (bool grid), location.npy (int32 [n_patch, (x, y)]), meta.json
+both arrays are plain .npy files and are loaded with mmap_mode="r"
+opt-in: the module level functions cache only under MASK_CACHE_DIR (or an explicit MaskCache),
+masks are computed without cache when it is not set
+
+@author: Katsuhisa MORITA
+"""
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+
+from slide import mask as mask_engine
+from slide.location import LocationTable
+
+# bump when the mask computation changes so that stale entries are not reused
+# (2 held the area-resampled thumbnails, back to the masks of version 1)
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.environ.get("MASK_CACHE_DIR", "") # no default cache if empty
+
+def slide_fingerprint(filein:str="", chunk_size:int=1 << 20):
+    """content hash of the slide file (size + head + tail chunks)"""
+    size = os.path.getsize(filein)
+    sha = hashlib.sha1(str(size).encode())
+    with open(filein, "rb") as f:
+        sha.update(f.read(chunk_size))
+        if size > chunk_size:
+            f.seek(max(chunk_size, size - chunk_size))
+            sha.update(f.read(chunk_size))
+    return sha.hexdigest()
+
+class MaskCache:
+    """persistent cache of inside masks and patch locations (folder: MASK_CACHE_DIR if None)"""
+    def __init__(self, folder:str=None):
+        self.folder = folder if folder else DEFAULT_CACHE_DIR
+        if not self.folder:
+            raise ValueError("no cache folder: give folder or set MASK_CACHE_DIR")
+        self._fingerprint = dict()
+
+    def fingerprint(self, filein:str=""):
+        stat = os.stat(filein)
+        key = (os.path.abspath(filein), stat.st_size, stat.st_mtime_ns)
+        if key not in self._fingerprint:
+            self._fingerprint[key] = slide_fingerprint(filein)
+        return self._fingerprint[key]
+
+    def key(
+        self,
+        filein:str="",
+        patch_size:int=224,
+        slice_min_patch:int=1000,
+        adjacent_cells_slice=mask_engine.ADJACENT_CELLS_SLICE,
+        adjacent_cells_inside=mask_engine.ADJACENT_CELLS_INSIDE,
+        base_patch_size:int=None,
+        ):
+        params = {
+            "version": CACHE_VERSION,
+            "slide": self.fingerprint(filein),
+            "patch_size": int(patch_size),
+            "slice_min_patch": int(slice_min_patch),
+            "adjacent_cells_slice": [list(map(int, adj)) for adj in adjacent_cells_slice],
+            "adjacent_cells_inside": [list(map(int, adj)) for adj in adjacent_cells_inside],
+        }
+        if base_patch_size is not None and int(base_patch_size) != int(patch_size):
+            # mask derived from the saturation grid of a finer patch size
+            params["base_patch_size"] = int(base_patch_size)
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def load(self, key:str=""):
+        """return (mask, locations) or None"""
+        folder = os.path.join(self.folder, key)
+        try:
+            mask = np.load(f"{folder}/mask.npy", mmap_mode="r")
+            locations = np.load(f"{folder}/location.npy", mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return None
+        return mask, LocationTable(locations)
+
+    def save(self, key:str="", mask=None, locations=None, meta=None):
+        """atomic save (written to a temporary folder and renamed)"""
+        meta = dict() if meta is None else meta
+        folder = os.path.join(self.folder, key)
+        tmp = f"{folder}.tmp{os.getpid()}"
+        os.makedirs(tmp, exist_ok=True)
+        np.save(f"{tmp}/mask.npy", np.ascontiguousarray(mask, dtype=bool))
+        np.save(f"{tmp}/location.npy", np.ascontiguousarray(np.asarray(locations), dtype=np.int32))
+        with open(f"{tmp}/meta.json", "w") as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp, folder)
+        except OSError:
+            # saved by another process in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def get_mask_inside(
+        self,
+        filein:str="",
+        patch_size:int=224,
+        slice_min_patch:int=1000,
+        adjacent_cells_slice=mask_engine.ADJACENT_CELLS_SLICE,
+        adjacent_cells_inside=mask_engine.ADJACENT_CELLS_INSIDE,
+        image=None,
+        ):
+        """
+        cached inside mask and locations of the slide
+        Parameters
+        ----------
+        filein: path of the slide
+        image: OpenSlide object of filein, opened only when the cache is missed if None
+        Returns
+        -------
+        mask: np.array(bool)[grid_height, grid_width]
+        locations: LocationTable, level 0 (x, y)
+        """
+        key = self.key(
+            filein, patch_size=patch_size, slice_min_patch=slice_min_patch,
+            adjacent_cells_slice=adjacent_cells_slice, adjacent_cells_inside=adjacent_cells_inside,
+        )
+        res = self.load(key)
+        if res is not None:
+            return res
+        if image is None:
+            from openslide import OpenSlide
+            image = OpenSlide(filein)
+        mask = mask_engine.get_mask_inside(
+            image, patch_size=patch_size, slice_min_patch=slice_min_patch,
+            adjacent_cells_slice=adjacent_cells_slice, adjacent_cells_inside=adjacent_cells_inside,
+        )
+        locations = LocationTable.from_mask(mask, patch_size=patch_size)
+        self.save(key, mask, locations, meta={
+            "filein": os.path.abspath(filein), "patch_size": int(patch_size),
+            "slice_min_patch": int(slice_min_patch),
+            })
+        return mask, locations
+
+    def get_mask_inside_multi(
+        self,
+        filein:str="",
+        lst_patch_size=[224, 448],
+        lst_slice_min_patch=[1000, 100],
+        adjacent_cells_slice=mask_engine.ADJACENT_CELLS_SLICE,
+        adjacent_cells_inside=mask_engine.ADJACENT_CELLS_INSIDE,
+        image=None,
+        ):
+        """
+        cached inside masks and locations for several patch sizes,
+        the missed sizes are computed from one read at the finest patch size
+        Returns
+        -------
+        dict_res: {patch_size: (mask, locations)}
+        """
+        base = min(lst_patch_size)
+        dict_key = {
+            patch_size: self.key(
+                filein, patch_size=patch_size, slice_min_patch=slice_min_patch,
+                adjacent_cells_slice=adjacent_cells_slice, adjacent_cells_inside=adjacent_cells_inside,
+                base_patch_size=base,
+            )
+            for patch_size, slice_min_patch in zip(lst_patch_size, lst_slice_min_patch)
+        }
+        dict_res = {patch_size: self.load(key) for patch_size, key in dict_key.items()}
+        lst_missed = [patch_size for patch_size, res in dict_res.items() if res is None]
+        if len(lst_missed) == 0:
+            return dict_res
+        if image is None:
+            from openslide import OpenSlide
+            image = OpenSlide(filein)
+        dict_min = dict(zip(lst_patch_size, lst_slice_min_patch))
+        # the finest size is always read so that derived grids do not depend on which sizes were missed
+        lst_compute = sorted(set(lst_missed) | {base})
+        dict_mask = mask_engine.get_mask_inside_multi(
+            image, lst_patch_size=lst_compute,
+            lst_slice_min_patch=[dict_min[patch_size] for patch_size in lst_compute],
+            adjacent_cells_slice=adjacent_cells_slice, adjacent_cells_inside=adjacent_cells_inside,
+        )
+        for patch_size in lst_missed:
+            mask = dict_mask[patch_size]
+            locations = LocationTable.from_mask(mask, patch_size=patch_size)
+            self.save(dict_key[patch_size], mask, locations, meta={
+                "filein": os.path.abspath(filein), "patch_size": int(patch_size),
+                "slice_min_patch": int(dict_min[patch_size]), "base_patch_size": int(base),
+                })
+            dict_res[patch_size] = (mask, locations)
+        return dict_res
+
+_default_cache = None
+
+def get_default_cache():
+    """module level MaskCache (MASK_CACHE_DIR or set by the caller), None when MASK_CACHE_DIR is not set (no cache)"""
+    global _default_cache
+    if _default_cache is None and DEFAULT_CACHE_DIR:
+        _default_cache = MaskCache(DEFAULT_CACHE_DIR)
+    return _default_cache
+
+def get_mask_inside(
+    image,
+    patch_size:int=224,
+    slice_min_patch:int=1000,
+    adjacent_cells_slice=mask_engine.ADJACENT_CELLS_SLICE,
+    adjacent_cells_inside=mask_engine.ADJACENT_CELLS_INSIDE,
+    cache=None,
+    ):
+    """
+    inside mask and locations through the mask cache
+    Parameters
+    ----------
+    image: path of the slide or OpenSlide object
+    cache: MaskCache, the default cache if None
+    Returns
+    -------
+    mask, locations (see MaskCache.get_mask_inside)
+    """
+    if isinstance(image, str):
+        filein, image = image, None
+    else:
+        filein = getattr(image, "_filename", None)
+    cache = cache if cache is not None else get_default_cache()
+    if (cache is None) or (filein is None):
+        if image is None:
+            from openslide import OpenSlide
+            image = OpenSlide(filein)
+        mask = mask_engine.get_mask_inside(
+            image, patch_size=patch_size, slice_min_patch=slice_min_patch,
+            adjacent_cells_slice=adjacent_cells_slice, adjacent_cells_inside=adjacent_cells_inside,
+        )
+        return mask, LocationTable.from_mask(mask, patch_size=patch_size)
+    return cache.get_mask_inside(
+        filein, patch_size=patch_size, slice_min_patch=slice_min_patch,
+        adjacent_cells_slice=adjacent_cells_slice, adjacent_cells_inside=adjacent_cells_inside,
+        image=image,
+    )
+
+def get_mask_inside_multi(
+    image,
+    lst_patch_size=[224, 448],
+    lst_slice_min_patch=[1000, 100],
+    adjacent_cells_slice=mask_engine.ADJACENT_CELLS_SLICE,
+    adjacent_cells_inside=mask_engine.ADJACENT_CELLS_INSIDE,
+    cache=None,
+    ):
+    """
+    inside masks and locations for several patch sizes through the mask cache
+    Parameters
+    ----------
+    image: path of the slide or OpenSlide object
+    lst_patch_size: list of patch sizes
+    lst_slice_min_patch: minimum size of patch group, for each patch size
+    cache: MaskCache, the default cache if None
+    Returns
+    -------
+    dict_res: {patch_size: (mask, locations)}
+    """
+    if len(lst_patch_size) != len(lst_slice_min_patch):
+        raise ValueError("lst_patch_size and lst_slice_min_patch must have the same length")
+    if isinstance(image, str):
+        filein, image = image, None
+    else:
+        filein = getattr(image, "_filename", None)
+    cache = cache if cache is not None else get_default_cache()
+    if (cache is None) or (filein is None):
+        if image is None:
+            from openslide import OpenSlide
+            image = OpenSlide(filein)
+        dict_mask = mask_engine.get_mask_inside_multi(
+            image, lst_patch_size=lst_patch_size, lst_slice_min_patch=lst_slice_min_patch,
+            adjacent_cells_slice=adjacent_cells_slice, adjacent_cells_inside=adjacent_cells_inside,
+        )
+        return {
+            patch_size: (mask, LocationTable.from_mask(mask, patch_size=patch_size))
+            for patch_size, mask in dict_mask.items()
+        }
+    return cache.get_mask_inside_multi(
+        filein, lst_patch_size=lst_patch_size, lst_slice_min_patch=lst_slice_min_patch,
+        adjacent_cells_slice=adjacent_cells_slice, adjacent_cells_inside=adjacent_cells_inside,
+        image=image,
+    )
+
+def save_locations(locations, fileout:str=""):
+    """atomic save of locations (LocationTable or int32 [n_patch, (x, y)]) as .npy"""
+    if not isinstance(locations, LocationTable):
+        locations = LocationTable(locations)
+    locations.save(fileout)
+
+def load_locations(filein:str=""):
+    """
+    load patch locations saved as .npy (memory-mapped)
+    or as the former pickled list of [y, x]
+    Returns
+    -------
+    LocationTable
+    """
+    return LocationTable.load(filein)
+
+def find_locations(fileroot:str=""):
+    """
+    file of the patch locations {fileroot}_location.npy,
+    or the former {fileroot}_location.pickle if only that one exists
+    """
+    fileout = f"{fileroot}_location.npy"
+    if not os.path.isfile(fileout) and os.path.isfile(f"{fileroot}_location.pickle"):
+        fileout = f"{fileroot}_location.pickle"
+    return fileout
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+# lazy OpenSlide handles for DataLoader workers
+the handle is opened on first use in each process (never inherited through fork, never pickled for spawn),
+with its own tile cache, and closed by close(), garbage collection or process exit
+
+@author: Katsuhisa MORITA
+"""
+import os
+from multiprocessing import util
+
+def open_slide(filein:str="", cache_size:int=None, cache=None):
+    """
+    OpenSlide with a tile cache of cache_size bytes (default cache of OpenSlide if None,
+    or if the OpenSlide / openslide-python versions have no cache API (< 4.0.0 / 1.3.0))
+    cache: OpenSlideCache shared with other handles (shared_cache), used instead of cache_size
+    """
+    from openslide import OpenSlide
+    image = OpenSlide(filein)
+    if cache is not None:
+        image.set_cache(cache)
+    elif cache_size is not None:
+        try:
+            from openslide import OpenSlideCache
+        except ImportError:
+            return image
+        image.set_cache(OpenSlideCache(int(cache_size)))
+    return image
+
+def shared_cache(cache_size:int=None):
+    """OpenSlideCache of cache_size bytes for several handles (open_slide(cache=)), None if not supported"""
+    if cache_size is None:
+        return None
+    try:
+        from openslide import OpenSlideCache
+    except ImportError:
+        return None
+    return OpenSlideCache(int(cache_size))
+
+class LazySlide:
+    """
+    per-process OpenSlide handle
+    Parameters
+    ----------
+    filein: path of the slide
+    cache_size: tile cache (bytes) of the handle, default cache of OpenSlide if None
+    """
+    def __init__(self, filein:str="", cache_size:int=None):
+        self.filein = filein
+        self.cache_size = cache_size
+        self._image = None
+        self._pid = None
+        self._finalizer = None
+
+    @property
+    def image(self):
+        """the handle of this process, opened if needed"""
+        if self._image is None or self._pid != os.getpid():
+            # a handle inherited through fork is not used (its finalizer is dropped by multiprocessing)
+            self._image = open_slide(self.filein, cache_size=self.cache_size)
+            self._pid = os.getpid()
+            self._finalizer = util.Finalize(self, self._image.close, exitpriority=10)
+        return self._image
+
+    def is_open(self):
+        return self._image is not None and self._pid == os.getpid()
+
+    def close(self):
+        if self._finalizer is not None:
+            self._finalizer() # closes once, only in the process that opened the handle
+        self._image, self._pid, self._finalizer = None, None, None
+
+    def __getstate__(self):
+        return {"filein": self.filein, "cache_size": self.cache_size, "_image": None, "_pid": None, "_finalizer": None}
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+# patch location table
+level 0 pixel locations backed by an int32 [n_patch, (x, y)] array,
+with optional slice id / tissue fraction columns
+
+saved as .npy: plain int32 [n_patch, 2] without optional columns,
+structured array (x, y, slice_id, fraction) otherwise; both are loaded with mmap_mode="r"
+
+@author: Katsuhisa MORITA
+"""
+import os
+
+import numpy as np
+import pandas as pd
+from numpy.lib import recfunctions
+
+class LocationTable:
+    """
+    patch locations (level 0 pixels, top-left corner)
+    Parameters
+    ----------
+    xy: array-like [n_patch, (x, y)]
+    slice_id: array-like(int) [n_patch] or None
+    fraction: array-like(float) [n_patch] or None
+    """
+    def __init__(self, xy=None, slice_id=None, fraction=None):
+        if xy is None:
+            xy = np.zeros((0, 2), dtype=np.int32)
+        # no copy for int32 arrays (memmap)
+        self.xy = np.asarray(xy, dtype=np.int32).reshape(-1, 2)
+        self.slice_id = None if slice_id is None else np.asarray(slice_id, dtype=np.int32)
+        self.fraction = None if fraction is None else np.asarray(fraction, dtype=np.float32)
+
+    def __len__(self):
+        return self.xy.shape[0]
+
+    def __getitem__(self, idx):
+        """(x, y) for an integer index, LocationTable for a slice / index array / bool mask"""
+        if isinstance(idx, (int, np.integer)):
+            x, y = self.xy[idx]
+            return int(x), int(y)
+        return self.take(idx)
+
+    def __iter__(self):
+        for x, y in self.xy.tolist():
+            yield x, y
+
+    def __array__(self, dtype=None, copy=None):
+        return self.xy if dtype is None else self.xy.astype(dtype)
+
+    def __repr__(self):
+        columns = ["x", "y"] + [k for k in ("slice_id", "fraction") if getattr(self, k) is not None]
+        return f"LocationTable(n_patch={len(self)}, columns={columns})"
+
+    @property
+    def x(self):
+        return self.xy[:, 0]
+
+    @property
+    def y(self):
+        return self.xy[:, 1]
+
+    def yx(self):
+        """[n_patch, (y, x)] view"""
+        return self.xy[:, ::-1]
+
+    def tolist(self):
+        """list of (x, y) tuples"""
+        return [(x, y) for x, y in self.xy.tolist()]
+
+    def take(self, idx):
+        """subset / reordering by index (all columns)"""
+        return LocationTable(
+            self.xy[idx],
+            slice_id=None if self.slice_id is None else self.slice_id[idx],
+            fraction=None if self.fraction is None else self.fraction[idx],
+        )
+
+    def _repeat(self, factor:int=1):
+        return (
+            None if self.slice_id is None else np.repeat(self.slice_id, factor),
+            None if self.fraction is None else np.repeat(self.fraction, factor),
+        )
+
+    @classmethod
+    def from_mask(cls, mask, patch_size:int=224, slice_id=None, fraction=None):
+        """
+        grid cells of the mask to level 0 pixels (order of mask.flatten())
+        Parameters
+        ----------
+        mask: np.array(bool)[grid_height, grid_width]
+        patch_size: int
+        slice_id: np.array(int)[grid_height, grid_width] or None (e.g. slide.mask.label_slices)
+        fraction: np.array(float)[grid_height, grid_width] or None
+        """
+        mask = np.asarray(mask, dtype=bool)
+        rows, cols = np.nonzero(mask)
+        return cls(
+            np.stack([cols, rows], axis=1) * patch_size,
+            slice_id=None if slice_id is None else np.asarray(slice_id)[rows, cols],
+            fraction=None if fraction is None else np.asarray(fraction)[rows, cols],
+        )
+
+    def subdivide(self, patch_size:int=448, model_patch_size:int=224):
+        """
+        split each patch into (patch_size / model_patch_size)^2 sub patches
+        order: patches, then x offset, then y offset (same as ImageProcessor.load_patch)
+        """
+        factor = int(patch_size / model_patch_size)
+        offset = np.arange(factor) * model_patch_size
+        offset_x, offset_y = np.meshgrid(offset, offset, indexing="ij")
+        offset = np.stack([offset_x.ravel(), offset_y.ravel()], axis=1)
+        xy = (self.xy[:, None, :] + offset[None, :, :]).reshape(-1, 2)
+        slice_id, fraction = self._repeat(factor * factor)
+        return LocationTable(xy, slice_id=slice_id, fraction=fraction)
+
+    def scale(self, downsample:float=1):
+        """locations divided by downsample (truncated), e.g. on a thumbnail"""
+        return LocationTable(
+            (self.xy / downsample).astype(np.int32),
+            slice_id=self.slice_id, fraction=self.fraction,
+        )
+
+    def to_grid(self, patch_size:int=224):
+        """[n_patch, (row, col)] grid cell indices"""
+        return self.xy[:, ::-1] // patch_size
+
+    def to_records(self):
+        """structured array (x, y[, slice_id][, fraction])"""
+        dtype = [("x", np.int32), ("y", np.int32)]
+        if self.slice_id is not None:
+            dtype.append(("slice_id", np.int32))
+        if self.fraction is not None:
+            dtype.append(("fraction", np.float32))
+        res = np.zeros(len(self), dtype=dtype)
+        res["x"], res["y"] = self.x, self.y
+        if self.slice_id is not None:
+            res["slice_id"] = self.slice_id
+        if self.fraction is not None:
+            res["fraction"] = self.fraction
+        return res
+
+    def save(self, fileout:str=""):
+        """atomic save as .npy"""
+        if self.slice_id is None and self.fraction is None:
+            arr = np.ascontiguousarray(self.xy, dtype=np.int32)
+        else:
+            arr = self.to_records()
+        tmp = f"{fileout}.tmp{os.getpid()}.npy"
+        np.save(tmp, arr)
+        os.replace(tmp, fileout)
+
+    @classmethod
+    def load(cls, filein:str="", mmap_mode:str="r"):
+        """
+        load .npy (memory-mapped) or the former pickled list of [y, x]
+        """
+        if filein.endswith(".pickle"):
+            lst_location = pd.read_pickle(filein)
+            return cls(np.array(lst_location, dtype=np.int32).reshape(-1, 2)[:, ::-1])
+        arr = np.load(filein, mmap_mode=mmap_mode)
+        if arr.dtype.names is None:
+            return cls(arr)
+        # view of the x, y fields (no copy of the mapped file)
+        return cls(
+            recfunctions.structured_to_unstructured(arr[["x", "y"]], copy=False),
+            slice_id=arr["slice_id"] if "slice_id" in arr.dtype.names else None,
+            fraction=arr["fraction"] if "fraction" in arr.dtype.names else None,
+        )
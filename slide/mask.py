@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+# tissue mask engine
+shared by tggate.utils and analyzer.imageprocessor
+
+@author: Katsuhisa MORITA
+"""
+from typing import Sequence, Tuple
+
+import numpy as np
+from scipy import ndimage
+import cv2
+
+from slide.thumbnail import read_thumbnail
+
+ADJACENT_CELLS_SLICE=((-1,0),(1,0),(0,-1),(0,1),)
+ADJACENT_CELLS_INSIDE=((-1,0),(1,0),(0,-1),(0,1),(1,1),(1,-1),(-1,1),(-1,-1))
+
+def read_saturation(image, patch_size:int=224, tile_size:int=4096):
+    """
+    saturation channel of the whole slide on the patch grid
+    (streamed, see slide.thumbnail)
+    Parameters
+    ----------
+    image: openslide.OpenSlide
+    patch_size: int
+    tile_size: int
+        size of one read at the chosen level (plus the filter support)
+    Returns
+    -------
+    saturation: np.array(uint8)[grid_height, grid_width]
+    """
+    return read_thumbnail(image, downsample=patch_size, channel="saturation", tile_size=tile_size)
+
+def otsu_mask(saturation, threshold=None):
+    """tissue mask with the given threshold (None: OTSU)"""
+    if threshold is None:
+        threshold, _ = cv2.threshold(saturation, 0, 255, cv2.THRESH_OTSU)
+    return saturation > threshold
+
+def _structure(adjacent_cells:Sequence[Tuple[int,int]]):
+    """3x3 connection structure, None if not expressible for ndimage.label"""
+    structure = np.zeros((3,3), dtype=bool)
+    structure[1,1] = True
+    for adj_i, adj_j in adjacent_cells:
+        if max(abs(adj_i), abs(adj_j)) > 1:
+            return None
+        structure[1+adj_i, 1+adj_j] = True
+    if not (structure == structure[::-1, ::-1]).all():
+        # one-way connections depend on the scan order of the flood fill
+        return None
+    return structure
+
+def label_slices(mask, adjacent_cells_slice=ADJACENT_CELLS_SLICE):
+    """
+    connected component labeling of the mask
+    Returns
+    -------
+    slice_idx: np.array(int)[height, width], -1 for background
+    n_slice: int
+    """
+    structure = _structure(adjacent_cells_slice)
+    if structure is None:
+        return _label_slices_legacy(mask, adjacent_cells_slice=adjacent_cells_slice)
+    labels, n_slice = ndimage.label(mask, structure=structure)
+    return labels.astype(int) - 1, n_slice
+
+def filter_slices(mask, slice_min_patch:int=1000, adjacent_cells_slice=ADJACENT_CELLS_SLICE):
+    """remove slices (connected patch groups) smaller than slice_min_patch"""
+    slice_idx, n_slice = label_slices(mask, adjacent_cells_slice=adjacent_cells_slice)
+    if n_slice == 0:
+        return np.zeros(mask.shape, dtype=bool)
+    slice_size = np.bincount(slice_idx[slice_idx > -1], minlength=n_slice)
+    keep = np.append(slice_size >= slice_min_patch, False) # index -1: background
+    return keep[slice_idx]
+
+def erode_inside(mask, adjacent_cells_inside=ADJACENT_CELLS_INSIDE):
+    """patches whose adjacent cells are all in the mask (edges of the grid are excluded)"""
+    mask_inside = np.zeros(mask.shape, dtype=bool)
+    height, width = mask.shape
+    if height < 3 or width < 3:
+        return mask_inside
+    pad = max([1] + [max(abs(adj_i), abs(adj_j)) for adj_i, adj_j in adjacent_cells_inside])
+    padded = np.pad(mask, pad, mode="constant", constant_values=False)
+    inside = mask[1:-1, 1:-1].copy()
+    for adj_i, adj_j in adjacent_cells_inside:
+        inside &= padded[
+            pad+1+adj_i:pad+height-1+adj_i,
+            pad+1+adj_j:pad+width-1+adj_j,
+            ]
+    mask_inside[1:-1, 1:-1] = inside
+    return mask_inside
+
+def mask_inside(
+    mask,
+    slice_min_patch:int=1000,
+    adjacent_cells_slice=ADJACENT_CELLS_SLICE,
+    adjacent_cells_inside=ADJACENT_CELLS_INSIDE,
+    ):
+    """
+    inside mask from the tissue mask grid
+    Parameters
+    ----------
+    mask: np.array(bool)[grid_height, grid_width]
+    slice_min_patch: minimum size of patch group
+    adjacent_cells_slice: definition of connections
+    adjacent_cells_inside: definition of not outside condition
+    """
+    mask = filter_slices(mask, slice_min_patch=slice_min_patch, adjacent_cells_slice=adjacent_cells_slice)
+    return erode_inside(mask, adjacent_cells_inside=adjacent_cells_inside)
+
+def get_mask_inside(
+    image,
+    patch_size:int=224,
+    slice_min_patch:int=1000,
+    adjacent_cells_slice=ADJACENT_CELLS_SLICE,
+    adjacent_cells_inside=ADJACENT_CELLS_INSIDE,
+    ):
+    """
+    image: OpenSlide object
+    patch_size: int
+    slice_min_patch: minimum size of patch group
+    adjacent_cells_slice: definition of connections
+    adjacent_cells_inside: definition of not outside condition
+    """
+    mask = otsu_mask(read_saturation(image, patch_size=patch_size))
+    return mask_inside(
+        mask,
+        slice_min_patch=slice_min_patch,
+        adjacent_cells_slice=adjacent_cells_slice,
+        adjacent_cells_inside=adjacent_cells_inside,
+    )
+
+def reduce_grid(grid, factor:float=2):
+    """
+    coarser grid of block means (grid cell = factor x factor cells)
+    integer factors drop the remainder rows / columns,
+    other factors are area-resized to int(shape / factor)
+    """
+    height, width = int(grid.shape[0] // factor), int(grid.shape[1] // factor)
+    if factor == int(factor):
+        factor = int(factor)
+        blocks = grid[:height*factor, :width*factor].reshape(height, factor, width, factor)
+        reduced = blocks.mean(axis=(1, 3))
+    else:
+        reduced = cv2.resize(grid.astype(np.float32), (width, height), interpolation=cv2.INTER_AREA)
+    return np.round(reduced).astype(grid.dtype)
+
+def read_saturation_multi(image, lst_patch_size=[224, 448], tile_size:int=4096):
+    """
+    saturation grids for several patch sizes from one read at the finest size
+    Returns
+    -------
+    dict_saturation: {patch_size: np.array(uint8)[grid_height, grid_width]}
+    """
+    base = min(lst_patch_size)
+    saturation = read_saturation(image, patch_size=base, tile_size=tile_size)
+    return {
+        patch_size: saturation if patch_size == base else reduce_grid(saturation, factor=patch_size / base)
+        for patch_size in lst_patch_size
+        }
+
+def get_mask_inside_multi(
+    image,
+    lst_patch_size=[224, 448],
+    lst_slice_min_patch=[1000, 100],
+    adjacent_cells_slice=ADJACENT_CELLS_SLICE,
+    adjacent_cells_inside=ADJACENT_CELLS_INSIDE,
+    ):
+    """
+    inside masks for several patch sizes with a single slide read
+    Parameters
+    ----------
+    image: OpenSlide object
+    lst_patch_size: list of patch sizes
+    lst_slice_min_patch: minimum size of patch group, for each patch size
+    adjacent_cells_slice: definition of connections
+    adjacent_cells_inside: definition of not outside condition
+    Returns
+    -------
+    dict_mask: {patch_size: np.array(bool)[grid_height, grid_width]}
+    """
+    if len(lst_patch_size) != len(lst_slice_min_patch):
+        raise ValueError("lst_patch_size and lst_slice_min_patch must have the same length")
+    dict_saturation = read_saturation_multi(image, lst_patch_size=lst_patch_size)
+    return {
+        patch_size: mask_inside(
+            otsu_mask(dict_saturation[patch_size]),
+            slice_min_patch=slice_min_patch,
+            adjacent_cells_slice=adjacent_cells_slice,
+            adjacent_cells_inside=adjacent_cells_inside,
+            )
+        for patch_size, slice_min_patch in zip(lst_patch_size, lst_slice_min_patch)
+        }
+
+# reference implementations (python flood fill, _mask_inside_legacy is the former get_mask_inside verbatim), kept for benchmark
+def _label_slices_legacy(mask, adjacent_cells_slice=ADJACENT_CELLS_SLICE):
+    left_mask = np.full((mask.shape[0]+1, mask.shape[1]+1), fill_value=False, dtype=bool)
+    left_mask[:-1, :-1] = mask
+    n_left_mask = np.sum(left_mask)
+    slice_idx = np.full_like(mask, fill_value=-1, dtype=int)
+    i_slice = 0
+    while n_left_mask > 0:
+        mask_i = np.where(left_mask)
+        slice_left_indices = [(mask_i[0][0], mask_i[1][0])]
+        while len(slice_left_indices) > 0:
+            i, j = slice_left_indices.pop()
+            if left_mask[i, j]:
+                slice_idx[i, j] = i_slice
+                for adj_i, adj_j in adjacent_cells_slice:
+                    if left_mask[i+adj_i, j+adj_j]:
+                        slice_left_indices.append((i+adj_i, j+adj_j))
+                left_mask[i, j] = False
+                n_left_mask -= 1
+        i_slice += 1
+    return slice_idx, i_slice
+
+def _mask_inside_legacy(
+    mask,
+    slice_min_patch:int=1000,
+    adjacent_cells_slice=ADJACENT_CELLS_SLICE,
+    adjacent_cells_inside=ADJACENT_CELLS_INSIDE,
+    ):
+    # get slices > slice_min_patch
+    left_mask = np.full((mask.shape[0]+1, mask.shape[1]+1), fill_value=False, dtype=bool)
+    left_mask[:-1, :-1] = mask
+    n_left_mask = np.sum(left_mask)
+    slice_idx = np.full_like(mask, fill_value=-1, dtype=int)
+    i_slice = 0
+    while n_left_mask > 0:
+        mask_i = np.where(left_mask)
+        slice_left_indices = [(mask_i[0][0], mask_i[1][0])]
+        while len(slice_left_indices) > 0:
+            i, j = slice_left_indices.pop()
+            if left_mask[i, j]:
+                slice_idx[i, j] = i_slice
+                for adj_i, adj_j in adjacent_cells_slice:
+                    if left_mask[i+adj_i, j+adj_j]:
+                        slice_left_indices.append((i+adj_i, j+adj_j))
+                left_mask[i, j] = False
+                n_left_mask -= 1
+        slice_mask = slice_idx == i_slice
+        if np.sum(slice_mask) < slice_min_patch:
+            slice_idx[slice_mask] = -1
+        else:
+            i_slice += 1
+    # re-difinition mask
+    mask=slice_idx>-1
+    # get inside mask
+    mask_inside=np.zeros(mask.shape, dtype=bool)
+    for i in range(1,mask.shape[0]-1):
+        for v in range(1,mask.shape[1]-1):
+            tf = mask[i][v]
+            if tf:
+                for adj in adjacent_cells_inside:
+                    tf&=mask[i+adj[0]][v+adj[1]]
+            mask_inside[i][v]=tf
+    return mask_inside
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+# region reader
+one read_region call per large region (or per strip of adjacent patches),
+sub patches are views of the region buffer
+
+@author: Katsuhisa MORITA
+"""
+import numpy as np
+from PIL import Image
+
+def read_region_rgb(image, location=(0, 0), size=(448, 448), level:int=0):
+    """
+    read_region as np.array(uint8)[height, width, 3] (view of the RGBA buffer)
+    Parameters
+    ----------
+    image: openslide.OpenSlide
+    location: (x, y) level 0 pixels
+    size: (width, height) at the level
+    """
+    region = image.read_region(location=(int(location[0]), int(location[1])), level=level, size=size)
+    return np.asarray(region, dtype=np.uint8)[:, :, :3]
+
+def read_region_scaled(image, location=(0, 0), size=(448, 448), out_size=(224, 224)):
+    """
+    level 0 region resized to out_size, read from the pyramid level closest to
+    (not coarser than) the required downsample, with a small residual resize
+    falls back to level 0 when the slide has no such level
+    Parameters
+    ----------
+    image: openslide.OpenSlide
+    location: (x, y) level 0 pixels
+    size: (width, height) of the region at level 0
+    out_size: (width, height) of the output
+    Returns
+    -------
+    PIL.Image (RGB, out_size)
+    """
+    downsample = min(size[0] / out_size[0], size[1] / out_size[1])
+    level = image.get_best_level_for_downsample(downsample) if downsample > 1 else 0
+    level_downsample = image.level_downsamples[level]
+    level_size = (int(round(size[0] / level_downsample)), int(round(size[1] / level_downsample)))
+    region = image.read_region(
+        location=(int(location[0]), int(location[1])), level=level, size=level_size,
+        ).convert("RGB")
+    if region.size != tuple(out_size):
+        region = region.resize(tuple(out_size), Image.BILINEAR)
+    return region
+
+def split_region(region, model_patch_size:int=224):
+    """
+    sub patches of a region without copy
+    Parameters
+    ----------
+    region: np.array[factor*model_patch_size, factor*model_patch_size, channel]
+    model_patch_size: int
+    Returns
+    -------
+    view: np.array[factor (x), factor (y), model_patch_size, model_patch_size, channel]
+        view[i, v] is the sub patch at (x + i*model_patch_size, y + v*model_patch_size)
+    """
+    height, width, channel = region.shape
+    factor_y, factor_x = height // model_patch_size, width // model_patch_size
+    region = region[:factor_y*model_patch_size, :factor_x*model_patch_size]
+    return region.reshape(
+        factor_y, model_patch_size, factor_x, model_patch_size, channel
+        ).transpose(2, 0, 1, 3, 4)
+
+def group_strips(locations, patch_size:int=224, strip_length:int=8):
+    """
+    group horizontally adjacent patches (same y, x step of patch_size) into strips
+    Parameters
+    ----------
+    locations: np.array(int)[n_patch, (x, y)]
+    patch_size: int
+    strip_length: maximum number of patches per strip
+    Returns
+    -------
+    lst_strip: list of np.array(int) indices into locations, each strip ordered by x
+    """
+    locations = np.asarray(locations).reshape(-1, 2)
+    if len(locations) == 0:
+        return []
+    order = np.lexsort((locations[:, 0], locations[:, 1])) # y, then x
+    x, y = locations[order, 0], locations[order, 1]
+    # a new strip starts where the row changes or the next cell is not adjacent
+    start = np.ones(len(order), dtype=bool)
+    start[1:] = (y[1:] != y[:-1]) | (x[1:] - x[:-1] != patch_size)
+    lst_strip = []
+    for run in np.split(order, np.nonzero(start)[0][1:]):
+        lst_strip.extend(np.split(run, range(strip_length, len(run), strip_length)))
+    return lst_strip
+
+def read_patches(image, locations, patch_size:int=224, strip_length:int=8, max_bytes:int=64 << 20):
+    """
+    read level 0 patches with one read_region call per strip of adjacent patches
+    Parameters
+    ----------
+    image: openslide.OpenSlide
+    locations: LocationTable or np.array(int)[n_patch, (x, y)]
+    patch_size: int
+    strip_length: maximum number of patches per read
+    max_bytes: upper bound of the RGBA buffer of one read (limits strip_length)
+    Returns
+    -------
+    patches: np.array(uint8)[n_patch, patch_size, patch_size, 3], in the order of locations
+    """
+    locations = np.asarray(locations).reshape(-1, 2)
+    strip_length = max(1, min(strip_length, max_bytes // (patch_size * patch_size * 4)))
+    res = np.empty((len(locations), patch_size, patch_size, 3), dtype=np.uint8)
+    for strip in group_strips(locations, patch_size=patch_size, strip_length=strip_length):
+        region = read_region_rgb(
+            image, location=locations[strip[0]], size=(patch_size * len(strip), patch_size),
+        )
+        res[strip] = split_region(region, model_patch_size=patch_size)[:, 0]
+    return res
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+# on-the-fly patch sampling from slides
+random tissue patches are read directly from the slides (no pre-materialized batch),
+locations come from the cached inside masks (slide.cache),
+TIFF slides are read by slide.tiff.TiffReader (tiles decoded with tifffile, no ARGB conversion of OpenSlide)
+
+@author: Katsuhisa MORITA
+"""
+import multiprocessing
+from multiprocessing import util
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+import torch
+
+from slide import cache as mask_cache
+from slide.region import read_region_rgb
+from slide.handle import open_slide, shared_cache
+from slide.tiff import TiffReader
+
+TIFF_CACHE_SIZE = 8 << 20 # tile cache of each TiffReader of a pool, if no cache_size
+
+class SlidePool:
+    """
+    LRU pool of open slide handles (one pool per worker)
+    Parameters
+    ----------
+    max_open: max number of slides kept open
+    cache_size: tile cache (bytes) of the pool: one OpenSlide cache shared by its handles,
+        split over its TiffReader handles, default cache of OpenSlide (per handle) / TIFF_CACHE_SIZE if None
+    reader: "openslide", "tiff" (TiffReader of level 0, the compression must be decodable by tifffile)
+        or "auto" (tiff for .tif / .tiff files, openslide otherwise)
+    """
+    def __init__(self, max_open:int=64, cache_size:int=None, reader:str="auto"):
+        if reader not in ("auto", "openslide", "tiff"):
+            raise ValueError(f"reader must be auto, openslide or tiff: {reader}")
+        self.max_open = max_open
+        self.cache_size = cache_size
+        self.reader = reader
+        self._cache = shared_cache(cache_size)
+        self._handles = OrderedDict()
+        util.Finalize(self, SlidePool._close_all, args=(self._handles,), exitpriority=10)
+
+    def _open(self, filein:str=""):
+        if self.reader == "tiff" or (self.reader == "auto" and filein.lower().endswith((".tif", ".tiff"))):
+            return TiffReader(filein, cache_size=self.cache_size // self.max_open if self.cache_size else TIFF_CACHE_SIZE)
+        return open_slide(filein, cache_size=self.cache_size, cache=self._cache)
+
+    def get(self, filein:str=""):
+        if filein in self._handles:
+            self._handles.move_to_end(filein)
+            return self._handles[filein]
+        image = self._open(filein)
+        self._handles[filein] = image
+        while len(self._handles) > self.max_open:
+            _, old = self._handles.popitem(last=False)
+            old.close()
+        return image
+
+    @staticmethod
+    def _close_all(handles):
+        for image in handles.values():
+            image.close()
+        handles.clear()
+
+    def close(self):
+        SlidePool._close_all(self._handles)
+
+    def __len__(self):
+        return len(self._handles)
+
+class WSIPatchDataset(torch.utils.data.IterableDataset):
+    """
+    random tissue patches sampled from slides at each epoch
+    the epoch length is num_sample patches, split over the DataLoader workers
+    Parameters
+    ----------
+    lst_filein: list of slide paths
+    patch_size: int, patch size (level 0 pixels), also the grid of the inside mask
+    num_sample: int, patches per epoch
+    transform: transform or list of transforms applied in order
+    mode: str
+        "round_robin": slides visited in a random order renewed every epoch
+        "weighted": slides drawn at random with probability weights (tissue area if None)
+    weights: list of slide weights for "weighted"
+    patch_per_visit: int, patches read from a slide at each visit (consecutive reads share the open handle)
+    jitter: int, max random offset (pixels) of the patch from its grid cell
+    max_open: int, size of the slide pool of each worker (SlidePool)
+    cache_size: int, tile cache (bytes) of the slide pool of each worker
+    reader: str, slide reader of the pool ("auto", "openslide", "tiff", see SlidePool)
+    lst_label: list of label arrays (one per slide), yields (data, label) if given
+    slice_min_patch: int, passed to the inside mask
+    seed: int
+    """
+    def __init__(
+        self, lst_filein=list(), patch_size:int=256, num_sample:int=65536, transform=None,
+        mode:str="round_robin", weights=None, patch_per_visit:int=4, jitter:int=0,
+        max_open:int=64, cache_size:int=None, reader:str="auto", lst_label=None, slice_min_patch:int=1000, seed:int=0,
+        ):
+        if mode not in ("round_robin", "weighted"):
+            raise ValueError(f"mode must be round_robin or weighted: {mode}")
+        if type(transform)!=list:
+            self._transform = [transform]
+        else:
+            self._transform = transform
+        self.patch_size = patch_size
+        self.num_sample = num_sample
+        self.mode = mode
+        self.patch_per_visit = max(1, patch_per_visit)
+        self.jitter = jitter
+        self.max_open = max_open
+        self.cache_size = cache_size
+        self.reader = reader
+        self.seed = seed
+        # locations from the mask cache, computed once here so that workers only read the cache
+        self.lst_filein, self.lst_locations, self.lst_label, lst_weight = [], [], [], []
+        for i, filein in enumerate(lst_filein):
+            _, locations = mask_cache.get_mask_inside(
+                filein, patch_size=patch_size, slice_min_patch=slice_min_patch,
+            )
+            if len(locations) == 0:
+                print(f"no inside patch, skipped: {filein}")
+                continue
+            self.lst_filein.append(filein)
+            self.lst_locations.append(np.asarray(locations))
+            self.lst_label.append(None if lst_label is None else torch.Tensor(np.asarray(lst_label[i], dtype=np.float32)))
+            lst_weight.append(len(locations) if weights is None else weights[i])
+        if len(self.lst_filein) == 0:
+            raise ValueError("no slide with inside patches")
+        self.weights = np.asarray(lst_weight, dtype=np.float64) / np.sum(lst_weight)
+        self._epoch = multiprocessing.Value("i", 0) # shared with persistent workers
+        self._pool = None
+
+    def set_epoch(self, epoch:int=0):
+        self._epoch.value = epoch
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_pool"] = None # handles are opened in each worker
+        return state
+
+    def __len__(self):
+        return self.num_sample
+
+    def _slide_order(self, rng, worker_id:int=0, num_workers:int=1):
+        """endless slide indices of this worker"""
+        n_slide = len(self.lst_filein)
+        while True:
+            if self.mode == "weighted":
+                yield from rng.choice(n_slide, size=n_slide, p=self.weights).tolist()
+            else:
+                # same permutation in every worker, each worker takes its share of slides
+                order = np.random.default_rng([self.seed, self._epoch.value]).permutation(n_slide)
+                yield from (order[worker_id::num_workers] if num_workers <= n_slide else order).tolist()
+
+    def _read(self, image, xy, rng):
+        x, y = int(xy[0]), int(xy[1])
+        if self.jitter:
+            width, height = (image.shape[1], image.shape[0]) if isinstance(image, TiffReader) else image.dimensions
+            x = int(np.clip(x + rng.integers(-self.jitter, self.jitter + 1), 0, width - self.patch_size))
+            y = int(np.clip(y + rng.integers(-self.jitter, self.jitter + 1), 0, height - self.patch_size))
+        if isinstance(image, TiffReader):
+            return image.read_region((x, y), (self.patch_size, self.patch_size))[:, :, :3]
+        return read_region_rgb(image, (x, y), (self.patch_size, self.patch_size))
+
+    def __iter__(self):
+        info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if info is None else (info.id, info.num_workers)
+        if self._pool is None:
+            self._pool = SlidePool(max_open=self.max_open, cache_size=self.cache_size, reader=self.reader)
+        rng = np.random.default_rng([self.seed, self._epoch.value, worker_id])
+        num_sample = len(range(worker_id, self.num_sample, num_workers))
+        slide_order = self._slide_order(rng, worker_id=worker_id, num_workers=num_workers)
+        count = 0
+        while count < num_sample:
+            i = next(slide_order)
+            image = self._pool.get(self.lst_filein[i])
+            locations = self.lst_locations[i]
+            n = min(self.patch_per_visit, num_sample - count)
+            for xy in locations[rng.integers(0, len(locations), n)]:
+                out_data = Image.fromarray(self._read(image, xy, rng))
+                if self._transform:
+                    for t in self._transform:
+                        out_data = t(out_data)
+                count += 1
+                if self.lst_label[i] is None:
+                    yield out_data
+                else:
+                    yield out_data, self.lst_label[i]
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+# streamed low resolution thumbnail reader
+the chosen pyramid level is read tile by tile and resized to the output grid, so that peak memory depends
+on tile_size only (not on the slide size)
+the resampling is the one of PIL Image.resize (bicubic) of the whole level, as before: coefficients of the
+whole level, fixed point 8-bit passes (horizontal then vertical), the tiles are read with the input window
+of their output cells, so the thumbnail is identical to the former whole-level resize
+
+@author: Katsuhisa MORITA
+"""
+import math
+
+import numpy as np
+
+BICUBIC_SUPPORT = 2 # support of the PIL bicubic filter (input pixels at scale 1)
+PRECISION_BITS = 32 - 8 - 2 # fixed point coefficients of PIL 8-bit resampling
+
+def saturation(rgb):
+    """
+    saturation channel of PIL HSV conversion
+    Parameters
+    ----------
+    rgb: np.array(uint8)[height, width, >=3]
+    Returns
+    -------
+    np.array(uint8)[height, width]
+    """
+    rgb = rgb[:, :, :3]
+    maxc = rgb.max(axis=2).astype(np.float32)
+    minc = rgb.min(axis=2).astype(np.float32)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # float32 ratio then float64 scaling, as in PIL rgb2hsv
+        s = ((maxc - minc) / maxc).astype(np.float64) * 255.0
+    return np.where(maxc > minc, s, 0).astype(np.uint8)
+
+def _bicubic(x):
+    """PIL bicubic filter (a = -0.5), same operation order"""
+    a = -0.5
+    x = np.abs(x)
+    return np.where(
+        x < 1.0, ((a + 2.0) * x - (a + 3.0)) * x * x + 1,
+        np.where(x < 2.0, (((x - 5) * x + 8) * x - 4) * a, 0.0),
+        )
+
+def resample_coeffs(in_size:int=0, out_size:int=0):
+    """
+    PIL bicubic resampling of in_size pixels to out_size pixels (whole image box, precompute_coeffs)
+    Returns
+    -------
+    xmin: np.array(int64)[out_size], first input pixel of each output pixel
+    xmax: np.array(int64)[out_size], number of input pixels of each output pixel
+    kk: np.array(int64)[out_size, ksize], fixed point coefficients (0 after xmax)
+    """
+    if in_size == out_size:
+        # no pass in PIL, identity
+        return np.arange(out_size), np.ones(out_size, dtype=np.int64), np.full((out_size, 1), 1 << PRECISION_BITS, dtype=np.int64)
+    scale = float(in_size) / out_size
+    filterscale = max(scale, 1.0)
+    support = BICUBIC_SUPPORT * filterscale
+    ksize = int(math.ceil(support)) * 2 + 1
+    center = (np.arange(out_size) + 0.5) * scale
+    xmin = np.maximum(np.trunc(center - support + 0.5).astype(np.int64), 0)
+    xmax = np.minimum(np.trunc(center + support + 0.5).astype(np.int64), in_size) - xmin
+    x = np.arange(ksize)
+    w = _bicubic(((x[None, :] + xmin[:, None]).astype(np.float64) - center[:, None] + 0.5) * (1.0 / filterscale))
+    w[x[None, :] >= xmax[:, None]] = 0
+    ww = np.zeros(out_size)
+    for i in range(ksize): # sequential sum, as in C
+        ww += w[:, i]
+    w = np.where(ww[:, None] != 0, w / np.where(ww == 0, 1, ww)[:, None], w)
+    w = w * (1 << PRECISION_BITS)
+    kk = np.where(w < 0, np.trunc(-0.5 + w), np.trunc(0.5 + w)).astype(np.int64)
+    return xmin, xmax, kk
+
+def _resample(data, xmin, kk, axis:int=0):
+    """one fixed point 8-bit pass of uint8 data along axis, xmin relative to data"""
+    shape = [-1 if d == axis else 1 for d in range(data.ndim)]
+    res = np.full(
+        tuple(len(xmin) if d == axis else n for d, n in enumerate(data.shape)),
+        1 << (PRECISION_BITS - 1), dtype=np.int64,
+        )
+    for k in range(kk.shape[1]):
+        idx = np.minimum(xmin + k, data.shape[axis] - 1) # coefficient 0 after the window
+        res += np.take(data, idx, axis=axis).astype(np.int64) * kk[:, k].reshape(shape)
+    return np.clip(res >> PRECISION_BITS, 0, 255).astype(np.uint8)
+
+def _premultiply(rgba):
+    """PIL RGBA to RGBa (resize of RGBA images)"""
+    rgba = rgba.astype(np.int64)
+    tmp = rgba[:, :, :3] * rgba[:, :, 3:] + 128
+    return np.concatenate([((tmp >> 8) + tmp) >> 8, rgba[:, :, 3:]], axis=2).astype(np.uint8)
+
+def _unpremultiply(rgba):
+    """PIL RGBa to RGBA"""
+    alpha = rgba[:, :, 3:].astype(np.int64)
+    rgb = rgba[:, :, :3].astype(np.int64)
+    res = np.where((alpha == 255) | (alpha == 0), rgb, np.clip(255 * rgb // np.maximum(alpha, 1), 0, 255))
+    return np.concatenate([res, alpha], axis=2).astype(np.uint8)
+
+def read_thumbnail(image, downsample:float=224, channel:str="rgb", tile_size:int=4096):
+    """
+    thumbnail of the slide, one output pixel per downsample x downsample level 0 pixels
+    (same pixels as the PIL resize of the whole best level, read tile by tile)
+    Parameters
+    ----------
+    image: openslide.OpenSlide
+    downsample: float
+        level 0 pixels per output pixel (patch_size for patch grids)
+    channel: str
+        "rgb" or "saturation"
+    tile_size: int
+        width/height of the output cells of one read, in level pixels (plus the filter support)
+    Returns
+    -------
+    thumbnail: np.array(uint8)[grid_height, grid_width, 3] (rgb) or [grid_height, grid_width] (saturation)
+    """
+    if channel not in ("rgb", "saturation"):
+        raise ValueError(f"channel must be rgb or saturation: {channel}")
+    level = image.get_best_level_for_downsample(downsample)
+    level_downsample = image.level_downsamples[level]
+    level_width, level_height = image.level_dimensions[level]
+    ratio = downsample / level_downsample
+    out_width, out_height = int(level_width / ratio), int(level_height / ratio)
+    if channel == "rgb":
+        res = np.zeros((out_height, out_width, 3), dtype=np.uint8)
+    else:
+        res = np.zeros((out_height, out_width), dtype=np.uint8)
+    if out_width == 0 or out_height == 0:
+        return res
+    xmin_x, xmax_x, kk_x = resample_coeffs(level_width, out_width)
+    xmin_y, xmax_y, kk_y = resample_coeffs(level_height, out_height)
+    cells_x = max(1, int(tile_size * out_width // level_width)) # output pixels per tile
+    cells_y = max(1, int(tile_size * out_height // level_height))
+    for r0 in range(0, out_height, cells_y):
+        r1 = min(r0 + cells_y, out_height)
+        y0, y1 = int(xmin_y[r0]), int((xmin_y + xmax_y)[r0:r1].max())
+        for c0 in range(0, out_width, cells_x):
+            c1 = min(c0 + cells_x, out_width)
+            x0, x1 = int(xmin_x[c0]), int((xmin_x + xmax_x)[c0:c1].max())
+            # input window of the cells
+            tile = np.asarray(image.read_region(
+                location=(int(x0 * level_downsample), int(y0 * level_downsample)),
+                level=level,
+                size=(x1 - x0, y1 - y0),
+                ), dtype=np.uint8)
+            if channel == "rgb":
+                tile = _premultiply(tile)
+            else:
+                tile = saturation(tile)
+            tile = _resample(tile, xmin_x[c0:c1] - x0, kk_x[c0:c1], axis=1)
+            tile = _resample(tile, xmin_y[r0:r1] - y0, kk_y[r0:r1], axis=0)
+            res[r0:r1, c0:c1] = _unpremultiply(tile)[:, :, :3] if channel == "rgb" else tile
+    return res
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+# tiled lazy TIFF reader
+reads only the tiles / strips of a TIFF page covering the requested region (decoded with tifffile),
+uncompressed contiguous pages are memory-mapped,
+indexed like the array of skimage.io.imread (reader[y0:y1, x0:x1, :]) without loading the slide
+
+@author: Katsuhisa MORITA
+"""
+import os
+from collections import OrderedDict
+from multiprocessing import util
+
+import numpy as np
+import tifffile
+
+class TiffReader:
+    """
+    lazy reader of one TIFF page (level 0 by default), opened on first use in each process
+    Parameters
+    ----------
+    filein: path of the TIFF
+    page: int, index of the page (0: full resolution)
+    cache_size: int, bytes of decoded tiles / strips kept (LRU) by each process
+    """
+    def __init__(self, filein:str="", page:int=0, cache_size:int=64 << 20):
+        self.filein = filein
+        self.page = page
+        self.cache_size = cache_size
+        with tifffile.TiffFile(filein) as tif:
+            tiff_page = tif.pages[page]
+            self.shape = tuple(tiff_page.shape)
+            self.dtype = tiff_page.dtype
+        self._reset()
+
+    def _reset(self):
+        self._tif, self._pid, self._finalizer = None, None, None
+        self._cache, self._cache_bytes = OrderedDict(), 0
+
+    def _open(self):
+        if self._tif is not None and self._pid == os.getpid():
+            return
+        self._reset()
+        self._tif = tifffile.TiffFile(self.filein)
+        self._pid = os.getpid()
+        self._finalizer = util.Finalize(self, self._tif.close, exitpriority=10)
+        page = self._tif.pages[self.page]
+        self._page = page
+        self._memmap = None
+        if page.is_memmappable:
+            self._memmap = tifffile.memmap(self.filein, page=self.page, mode="r")
+        elif page.planarconfig != 1 and page.samplesperpixel > 1:
+            # separate planes are not read by chunks: whole page (as skimage.io.imread)
+            self._memmap = page.asarray()
+        elif page.is_tiled:
+            self._chunk_shape = (page.tilelength, page.tilewidth)
+        else:
+            self._chunk_shape = (page.rowsperstrip, self.shape[1])
+        if self._memmap is None:
+            self._n_across = -(-self.shape[1] // self._chunk_shape[1])
+
+    def close(self):
+        if self._finalizer is not None:
+            self._finalizer()
+        self._reset()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ("_tif", "_pid", "_finalizer", "_page", "_memmap"):
+            state.pop(key, None)
+        state["_cache"], state["_cache_bytes"] = OrderedDict(), 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._tif, self._pid, self._finalizer = None, None, None
+
+    def _chunk(self, index:int):
+        """decoded tile / strip [chunk_height, chunk_width, samples]"""
+        if index in self._cache:
+            self._cache.move_to_end(index)
+            return self._cache[index]
+        page = self._page
+        offset, bytecount = page.dataoffsets[index], page.databytecounts[index]
+        if bytecount == 0:
+            chunk = np.zeros((*self._chunk_shape, *self.shape[2:]), dtype=self.dtype)
+        else:
+            fh = self._tif.filehandle
+            fh.seek(offset)
+            segment, _, _ = page.decode(fh.read(bytecount), index, jpegtables=page.jpegtables)
+            chunk = segment.reshape(segment.shape[1:3] + tuple(self.shape[2:]))
+        self._cache[index] = chunk
+        self._cache_bytes += chunk.nbytes
+        while self._cache_bytes > self.cache_size and len(self._cache) > 1:
+            _, old = self._cache.popitem(last=False)
+            self._cache_bytes -= old.nbytes
+        return chunk
+
+    def read(self, y0:int=0, y1:int=0, x0:int=0, x1:int=0):
+        """np.array [y1-y0, x1-x0, (samples)] of the page, the bounds must be inside the page"""
+        self._open()
+        if self._memmap is not None:
+            return np.array(self._memmap[y0:y1, x0:x1])
+        ch, cw = self._chunk_shape
+        if y0 // ch == (y1 - 1) // ch and x0 // cw == (x1 - 1) // cw:
+            # inside one chunk (e.g. patch on the tile grid): one copy
+            cy, cx = y0 // ch, x0 // cw
+            chunk = self._chunk(cy * self._n_across + cx)
+            return chunk[y0 - cy * ch:y1 - cy * ch, x0 - cx * cw:x1 - cx * cw].copy()
+        out = np.empty((y1 - y0, x1 - x0, *self.shape[2:]), dtype=self.dtype)
+        for cy in range(y0 // ch, -(-y1 // ch)):
+            for cx in range(x0 // cw, -(-x1 // cw)):
+                chunk = self._chunk(cy * self._n_across + cx)
+                # overlap of the chunk and the region, page coordinates
+                ty0, ty1 = max(y0, cy * ch), min(y1, (cy + 1) * ch)
+                tx0, tx1 = max(x0, cx * cw), min(x1, (cx + 1) * cw)
+                out[ty0 - y0:ty1 - y0, tx0 - x0:tx1 - x0] = chunk[ty0 - cy * ch:ty1 - cy * ch, tx0 - cx * cw:tx1 - cx * cw]
+        return out
+
+    def read_region(self, location=(0, 0), size=(224, 224)):
+        """region at (x, y) of (width, height), zeros outside of the page"""
+        x, y = int(location[0]), int(location[1])
+        width, height = int(size[0]), int(size[1])
+        if x >= 0 and y >= 0 and x + width <= self.shape[1] and y + height <= self.shape[0] and width > 0 and height > 0:
+            return self.read(y, y + height, x, x + width)
+        out = np.zeros((height, width, *self.shape[2:]), dtype=self.dtype)
+        y0, y1 = max(y, 0), min(y + height, self.shape[0])
+        x0, x1 = max(x, 0), min(x + width, self.shape[1])
+        if y0 < y1 and x0 < x1:
+            out[y0 - y:y1 - y, x0 - x:x1 - x] = self.read(y0, y1, x0, x1)
+        return out
+
+    def __getitem__(self, key):
+        """basic slicing of the page array, reader[y0:y1, x0:x1, ...]"""
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) < 2 or not all([isinstance(k, slice) and k.step in (None, 1) for k in key[:2]]):
+            raise IndexError("TiffReader supports [y0:y1, x0:x1, ...] slicing")
+        y0, y1, _ = key[0].indices(self.shape[0])
+        x0, x1, _ = key[1].indices(self.shape[1])
+        res = self.read(y0, max(y0, y1), x0, max(x0, x1))
+        return res[(slice(None), slice(None)) + key[2:]]
+
+    def __len__(self):
+        return self.shape[0]
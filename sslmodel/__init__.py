@@ -1 +1 @@
-from . import data_handler, plot, utils, utils_lightly
\ No newline at end of file
+from . import data_handler, augment, patchstore, plot, utils, utils_lightly
\ No newline at end of file
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+# batched ssl augmentation
+the augmentations of sslmodel.utils.ssl_transform / weak_strong_transform applied to a whole uint8 batch at once
+(per-sample random parameters drawn as in torchvision / lightly), e.g. on the GPU after collate_uint8,
+instead of one PIL image at a time in the DataLoader workers
+
+@author: Katsuhisa MORITA
+"""
+import math
+
+import torch
+import torch.nn.functional as F
+
+from sslmodel.data_handler import IMAGENET_MEAN, IMAGENET_STD
+
+# uint8 values of the PIL steps are kept: images are float [batch, 3, height, width] in 0-255
+def _quantize(x):
+    return x.round_().clamp_(0, 255)
+
+def _gray(x):
+    """PIL convert("L"), [n, 1, height, width]"""
+    return _quantize((x[:, 0:1] * 299 + x[:, 1:2] * 587 + x[:, 2:3] * 114) / 1000)
+
+def _blend(x1, x2, factor):
+    """ImageEnhance: x1 + factor * (x2 - x1)"""
+    return _quantize(x1 + factor.view(-1, 1, 1, 1) * (x2 - x1))
+
+def _brightness(x, factor):
+    return _blend(torch.zeros_like(x), x, factor)
+
+def _contrast(x, factor):
+    mean = torch.floor(_gray(x).mean(dim=(1, 2, 3), keepdim=True) + 0.5)
+    return _blend(mean.expand_as(x), x, factor)
+
+def _saturation(x, factor):
+    return _blend(_gray(x).expand_as(x), x, factor)
+
+def _hue(x, factor):
+    """shift of the hue (fraction of the turn), through HSV as torchvision"""
+    r, g, b = x.unbind(1)
+    maxc, minc = torch.max(torch.max(r, g), b), torch.min(torch.min(r, g), b)
+    cr = maxc - minc
+    cr_div = torch.where(cr == 0, torch.ones_like(cr), cr)
+    h = torch.where(maxc == r, (g - b) / cr_div, torch.where(maxc == g, 2.0 + (b - r) / cr_div, 4.0 + (r - g) / cr_div))
+    h = (h + 6 * factor.view(-1, 1, 1)) % 6.0
+    # hsv to rgb: v - v * s * clamp(min(k, 4 - k), 0, 1), k = (n + h) % 6 (n = 5, 3, 1), v * s = max - min
+    lst_out = []
+    for n in (5.0, 3.0, 1.0):
+        k = (h + n) % 6.0
+        lst_out.append(maxc - cr * torch.minimum(k, 4.0 - k).clamp_(0, 1))
+    return _quantize(torch.stack(lst_out, dim=1))
+
+def _gaussian_blur(x, sigma):
+    """3x3 gaussian kernel of sigma per sample, reflect padding (torchvision GaussianBlur((3, 3)))"""
+    n, c, height, width = x.shape
+    kernel = torch.exp(-0.5 * (torch.tensor([-1.0, 0.0, 1.0], device=x.device) / sigma.view(-1, 1)) ** 2)
+    kernel = kernel / kernel.sum(dim=1, keepdim=True)
+    kernel = (kernel.unsqueeze(2) * kernel.unsqueeze(1)).repeat_interleave(c, dim=0)
+    x = F.pad(x, (1, 1, 1, 1), mode="reflect").reshape(1, n * c, height + 2, width + 2)
+    x = F.conv2d(x, kernel.view(-1, 1, 3, 3), groups=n * c)
+    return _quantize(x.reshape(n, c, height, width))
+
+def _rotate(x, angle):
+    """counter-clockwise rotation (degrees) around the center, nearest, zero fill (RandomRotation)"""
+    n, _, height, width = x.shape
+    rad = torch.deg2rad(angle)
+    cos, sin = torch.cos(rad), torch.sin(rad)
+    # output -> input in normalized coordinates (aspect ratio kept)
+    theta = torch.stack([
+        torch.stack([cos, -sin * height / width, torch.zeros_like(cos)], dim=1),
+        torch.stack([sin * width / height, cos, torch.zeros_like(cos)], dim=1),
+    ], dim=1)
+    grid = F.affine_grid(theta, (n, 3, height, width), align_corners=False)
+    return F.grid_sample(x, grid, mode="nearest", padding_mode="zeros", align_corners=False)
+
+def _resized_crop(x, box, size):
+    """crops box [n, 4] (top, left, height, width) resized to size (antialiased bilinear, as PIL)"""
+    out = torch.empty((len(x), x.shape[1], *size), dtype=x.dtype, device=x.device)
+    for i, (top, left, height, width) in enumerate(box.tolist()):
+        out[i] = F.interpolate(
+            x[i:i + 1, :, top:top + height, left:left + width], size=tuple(size),
+            mode="bilinear", antialias=True, align_corners=False,
+            )[0]
+    return _quantize(out)
+
+def sample_crop(n:int=1, height:int=224, width:int=224, scale=(0.08, 1.0), ratio=(3 / 4, 4 / 3), generator=None):
+    """
+    RandomResizedCrop.get_params of n samples: (top, left, crop height, crop width) [n, 4]
+    10 trials, center crop of the clamped ratio if none fits
+    """
+    area = height * width
+    target_area = area * torch.empty(n, 10).uniform_(scale[0], scale[1], generator=generator)
+    log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+    aspect_ratio = torch.exp(torch.empty(n, 10).uniform_(log_ratio[0], log_ratio[1], generator=generator))
+    w = torch.round(torch.sqrt(target_area * aspect_ratio))
+    h = torch.round(torch.sqrt(target_area / aspect_ratio))
+    valid = (w > 0) & (w <= width) & (h > 0) & (h <= height)
+    first = valid.to(torch.int64).argmax(dim=1, keepdim=True)
+    w, h = w.gather(1, first).squeeze(1), h.gather(1, first).squeeze(1)
+    # fallback
+    in_ratio = width / height
+    if in_ratio < min(ratio):
+        w0, h0 = width, round(width / min(ratio))
+    elif in_ratio > max(ratio):
+        w0, h0 = round(height * max(ratio)), height
+    else:
+        w0, h0 = width, height
+    ok = valid.any(dim=1)
+    w, h = torch.where(ok, w, float(w0)), torch.where(ok, h, float(h0))
+    top = torch.where(ok, torch.floor(torch.rand(n, generator=generator) * (height - h + 1)), float((height - h0) // 2))
+    left = torch.where(ok, torch.floor(torch.rand(n, generator=generator) * (width - w + 1)), float((width - w0) // 2))
+    return torch.stack([top, left, h, w], dim=1).to(torch.int64)
+
+class BatchAugment:
+    """
+    batched version of the augmentation of sslmodel.utils.ssl_transform:
+    RandomHorizontalFlip, RandomRotation([0, 180]), RandomApply(ColorJitter(0.4, 0.4, 0.2, 0.1)), RandomGrayscale(0.2),
+    RandomApply(GaussianBlur((3, 3), (1.0, 2.0))), RandomSolarization, RandomResizedCrop(size), ToTensor, Normalize
+    Parameters
+    ----------
+    size: (height, width) of the output
+    color_plob, blur_plob, solar_plob, gray_plob, flip_plob: probabilities of each augmentation
+    mean, std: Normalize parameters
+    DEVICE: device of the output
+    generator: torch.Generator of the random parameters (global RNG if None)
+    chunk_size: int, images augmented together (cache friendly on cpu), whole batch if None
+        default: 4 on cpu, whole batch on gpu
+    """
+    def __init__(
+        self, size=(224, 224), color_plob:float=0.8, blur_plob:float=0.2, solar_plob:float=0.,
+        gray_plob:float=0.2, flip_plob:float=0.5, mean=IMAGENET_MEAN, std=IMAGENET_STD, DEVICE="cpu", generator=None,
+        chunk_size:int=-1,
+        ):
+        self.size = tuple(size)
+        self.color_plob = color_plob
+        self.blur_plob = blur_plob
+        self.solar_plob = solar_plob
+        self.gray_plob = gray_plob
+        self.flip_plob = flip_plob
+        self.DEVICE = DEVICE
+        self.generator = generator
+        if chunk_size == -1:
+            chunk_size = 4 if torch.device(DEVICE).type == "cpu" else None
+        self.chunk_size = chunk_size
+        self.mean = torch.tensor(mean, dtype=torch.float32, device=DEVICE).view(1, -1, 1, 1) * 255
+        self.std = torch.tensor(std, dtype=torch.float32, device=DEVICE).view(1, -1, 1, 1) * 255
+
+    def _uniform(self, n:int, low:float, high:float):
+        return torch.empty(n).uniform_(low, high, generator=self.generator)
+
+    def _bernoulli(self, n:int, p:float):
+        return torch.rand(n, generator=self.generator) < p
+
+    def sample_params(self, n:int=1, height:int=224, width:int=224):
+        """random parameters of n samples (cpu tensors), same distributions as the PIL pipeline"""
+        return dict(
+            flip=self._bernoulli(n, self.flip_plob),
+            angle=self._uniform(n, 0., 180.),
+            color=self._bernoulli(n, self.color_plob),
+            # ColorJitter.get_params: order of the 4 operations and the factors
+            order=torch.argsort(torch.rand(n, 4, generator=self.generator), dim=1),
+            brightness=self._uniform(n, 0.6, 1.4),
+            contrast=self._uniform(n, 0.6, 1.4),
+            saturation=self._uniform(n, 0.8, 1.2),
+            hue=self._uniform(n, -0.1, 0.1),
+            gray=self._bernoulli(n, self.gray_plob),
+            blur=self._bernoulli(n, self.blur_plob),
+            sigma=self._uniform(n, 1.0, 2.0),
+            solar=self._bernoulli(n, self.solar_plob),
+            crop=sample_crop(n, height, width, generator=self.generator),
+            )
+
+    def to_float(self, x):
+        """uint8 batch [batch, height, width, 3] to float [batch, 3, height, width] (0-255) on the device"""
+        return x.to(self.DEVICE, non_blocking=True).movedim(-1, 1).to(torch.float32)
+
+    def augment(self, x, params=None):
+        """float batch (0-255) to the normalized augmented batch [batch, 3, size], x is not modified"""
+        if params is None:
+            params = self.sample_params(len(x), x.shape[2], x.shape[3])
+        params = {k: v.to(x.device) for k, v in params.items()}
+        if not self.chunk_size or self.chunk_size >= len(x):
+            return self._augment(x, params)
+        out = torch.empty((len(x), 3, *self.size), dtype=x.dtype, device=x.device)
+        for start in range(0, len(x), self.chunk_size):
+            sl = slice(start, start + self.chunk_size)
+            out[sl] = self._augment(x[sl], {k: v[sl] for k, v in params.items()})
+        return out
+
+    def _augment(self, x, params):
+        # flip then rotation by angle == rotation by -angle then flip (x of the caller is kept)
+        sel = params["flip"]
+        x = _rotate(x, torch.where(sel, -params["angle"], params["angle"]))
+        if sel.any():
+            x[sel] = x[sel].flip(-1)
+        # ColorJitter, each sample in its own order
+        lst_fn = [(_brightness, "brightness"), (_contrast, "contrast"), (_saturation, "saturation"), (_hue, "hue")]
+        for step in range(4):
+            for fn_id, (fn, key) in enumerate(lst_fn):
+                sel = params["color"] & (params["order"][:, step] == fn_id)
+                if sel.any():
+                    x[sel] = fn(x[sel], params[key][sel])
+        sel = params["gray"]
+        if sel.any():
+            x[sel] = _gray(x[sel]).expand(-1, 3, -1, -1)
+        sel = params["blur"]
+        if sel.any():
+            x[sel] = _gaussian_blur(x[sel], params["sigma"][sel])
+        sel = params["solar"]
+        if sel.any():
+            x[sel] = torch.where(x[sel] >= 128, 255 - x[sel], x[sel])
+        x = _resized_crop(x, params["crop"], self.size)
+        # ToTensor + Normalize (scaled by 255)
+        return x.sub_(self.mean).div_(self.std)
+
+    def __call__(self, x):
+        return self.augment(self.to_float(x))
+
+class BatchTwoCrops:
+    """two views of each image (TwoCropsTransform)"""
+    def __init__(self, base_augment):
+        self.base_augment = base_augment
+
+    def __call__(self, x):
+        x = self.base_augment.to_float(x)
+        return [self.base_augment.augment(x), self.base_augment.augment(x)]
+
+class BatchWeakStrong:
+    """weak and strong views of each image (WeakStrongTwoCropsTransform)"""
+    def __init__(self, weak_augment, strong_augment):
+        self.weak_augment = weak_augment
+        self.strong_augment = strong_augment
+
+    def __call__(self, x):
+        x = self.weak_augment.to_float(x)
+        return [self.weak_augment.augment(x), self.strong_augment.augment(x)]
+
+class BatchMultiCrops:
+    """
+    views of each image (MultiCropsTransform): RandomResizedCrop(crop_size) then the base augmentation,
+    crop_counts views for each of crop_sizes
+    """
+    def __init__(self, base_augment, crop_counts=[2,6], crop_sizes=[224,96]):
+        self.base_augment = base_augment
+        self.crop_counts = crop_counts
+        self.crop_sizes = crop_sizes
+
+    def __call__(self, x):
+        x = self.base_augment.to_float(x)
+        views = []
+        for count, crop_size in zip(self.crop_counts, self.crop_sizes):
+            for _ in range(count):
+                box = sample_crop(len(x), x.shape[2], x.shape[3], generator=self.base_augment.generator)
+                view = _resized_crop(x, box.to(x.device), (crop_size, crop_size))
+                views.append(self.base_augment.augment(view))
+        return views
+
+def batch_ssl_transform(
+    split=False, multi=False,
+    size=(224,224),
+    color_plob=0.8,
+    blur_plob=0.2,
+    solar_plob=0,
+    DEVICE="cpu",
+    generator=None,
+    ):
+    """batched sslmodel.utils.ssl_transform, applied to uint8 batches [batch, height, width, 3]"""
+    augmentation = BatchAugment(
+        size=size, color_plob=color_plob, blur_plob=blur_plob, solar_plob=solar_plob,
+        DEVICE=DEVICE, generator=generator,
+        )
+    if split:
+        if multi:
+            return BatchMultiCrops(augmentation)
+        else:
+            return BatchTwoCrops(augmentation)
+    else:
+        return augmentation
+
+def batch_weak_strong_transform(
+    size=(224,224),
+    color_plob_w=0.2,
+    blur_plob_w=0.1,
+    solar_plob_w=0,
+    color_plob_s=1,
+    blur_plob_s=0.8,
+    solar_plob_s=0.2,
+    DEVICE="cpu",
+    generator=None,
+    ):
+    """batched sslmodel.utils.weak_strong_transform"""
+    weak_augmentation = BatchAugment(
+        size=size, color_plob=color_plob_w, blur_plob=blur_plob_w, solar_plob=solar_plob_w,
+        DEVICE=DEVICE, generator=generator,
+        )
+    strong_augmentation = BatchAugment(
+        size=size, color_plob=color_plob_s, blur_plob=blur_plob_s, solar_plob=solar_plob_s,
+        DEVICE=DEVICE, generator=generator,
+        )
+    return BatchWeakStrong(weak_augmentation, strong_augmentation)
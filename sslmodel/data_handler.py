@@ -7,8 +7,14 @@ prepare dataloader
 @author: Katsuhisa Morita, tadahaya
 """
 import gc
+import os
 import time
+import shutil
+import weakref
+import tempfile
+import threading
 from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor, CancelledError
 
 from tqdm import tqdm
 import numpy as np
@@ -16,13 +22,16 @@ import pandas as pd
 
 import torch
 import torchvision.transforms as transforms
-from torch.utils.data import Dataset, WeightedRandomSampler
+from torch.utils.data import Dataset, WeightedRandomSampler, Sampler
 from PIL import Image
 
+from . import patchstore
+
 # dataset
 def prep_dataloader(
     dataset, batch_size:int, shuffle:bool=True, num_workers:int=4, pin_memory:bool=True, 
     drop_last:bool=True, sampler=None, collate_fn=None,
+    persistent_workers:bool=False, prefetch_factor:int=None,
     ) -> torch.utils.data.DataLoader:
     """
     prepare train and test loader
@@ -45,6 +54,12 @@ def prep_dataloader(
     pin_memory: bool
         determines use of memory pinning
         should be True for fast computing
+
+    persistent_workers: bool
+        keep the workers alive between epochs (requires num_workers > 0)
+
+    prefetch_factor: int
+        batches loaded in advance by each worker (None: default of torch)
     
     """
     loader = torch.utils.data.DataLoader(
@@ -56,10 +71,485 @@ def prep_dataloader(
         worker_init_fn=_worker_init_fn,
         drop_last=drop_last,
         sampler=sampler,
-        collate_fn=collate_fn
+        collate_fn=collate_fn,
+        persistent_workers=persistent_workers,
+        prefetch_factor=prefetch_factor,
         )
     return loader
 
+class ShardDataset(Dataset):
+    """
+    all shard files as one dataset, memory-mapped (.npy) or compressed (.pstore), not loaded in RAM
+    Parameters
+    ----------
+    lst_filein: list of shard paths ({name}.npy, the patch store {name}.pstore is used if it exists)
+    lst_filelabel: list of label paths (.npy, [n_patch, n_label]) or None, returns (data, label) if given
+    transform: transform or list of transforms applied in order
+    """
+    def __init__(self, lst_filein=list(), lst_filelabel=None, transform=None):
+        if type(transform)!=list:
+            self._transform = [transform]
+        else:
+            self._transform = transform
+        self.lst_filein = list(lst_filein)
+        self.lst_filelabel = None if lst_filelabel is None else list(lst_filelabel)
+        self._data = dict() # opened lazily in each worker
+        self._label = dict()
+        lst_size = [len(self._open(i)) for i in range(len(self.lst_filein))]
+        self.cumsum = np.cumsum([0] + lst_size)
+        self.indices = None # subset (resize_dataset)
+        self.datanum = int(self.cumsum[-1])
+        self.buffer_dir = None # decoded patch store shards {shard}.npy (ShardSampler "shard" mode), read instead of the stores
+        self._buffer = dict() # shard: memory map of its decoded rows, last two opened
+
+    def _open(self, i:int):
+        if i not in self._data:
+            folder = patchstore.store_path(self.lst_filein[i])
+            if os.path.isdir(folder):
+                self._data[i] = patchstore.PatchStore(folder)
+            else:
+                self._data[i] = np.load(self.lst_filein[i], mmap_mode="r")
+        return self._data[i]
+
+    def _open_label(self, i:int):
+        # independent of _open: rows of a decoded shard are read without opening the shard
+        if i not in self._label:
+            self._label[i] = np.load(self.lst_filelabel[i], mmap_mode="r")
+        return self._label[i]
+
+    def compressed(self, i:int):
+        """shard i is a patch store (decoded ahead in ShardSampler "shard" mode), else a raw .npy memory map"""
+        return isinstance(self._open(i), patchstore.PatchStore)
+
+    def __getstate__(self):
+        # memory maps are reopened in each worker instead of being pickled
+        state = self.__dict__.copy()
+        state["_data"], state["_label"], state["_buffer"] = dict(), dict(), dict()
+        return state
+
+    def locate(self, idx:int):
+        """(shard, row) of the global index"""
+        if self.indices is not None:
+            idx = int(self.indices[idx])
+        shard = int(np.searchsorted(self.cumsum, idx, side="right")) - 1
+        return shard, idx - int(self.cumsum[shard])
+
+    def shard_sizes(self):
+        return np.bincount(self.shard_index(), minlength=len(self.lst_filein))
+
+    def shard_index(self):
+        """shard of each row of the dataset"""
+        idx = np.arange(int(self.cumsum[-1])) if self.indices is None else np.asarray(self.indices)
+        return np.searchsorted(self.cumsum, idx, side="right") - 1
+
+    def warm(self, i:int, stop=None, chunk_size:int=16<<20):
+        """
+        read the raw .npy shard i once through the page cache (sequential read, the GIL is released while reading),
+        interrupted when the threading.Event stop is set, returns False if interrupted or failed
+        """
+        buf = bytearray(chunk_size)
+        try:
+            with open(self.lst_filein[i], "rb", buffering=0) as f:
+                while f.readinto(buf):
+                    if stop is not None and stop.is_set():
+                        return False
+        except OSError:
+            return False
+        return True
+
+    def decode(self, i:int, fileout:str="", stop=None, chunk_size:int=256):
+        """
+        decode all rows of the patch store shard i to fileout (uint8 .npy, temporary file renamed),
+        interrupted when the threading.Event stop is set, returns False if interrupted or failed (e.g. disk full)
+        """
+        data = self._open(i)
+        tmp = f"{fileout}.tmp{os.getpid()}.npy"
+        try:
+            shape = np.asarray(data[0]).shape
+            with open(tmp, "wb") as f:
+                np.lib.format.write_array_header_1_0(f, {"descr": "|u1", "fortran_order": False, "shape": (len(data),) + shape})
+                for start in range(0, len(data), chunk_size):
+                    if stop is not None and stop.is_set():
+                        raise CancelledError()
+                    f.write(np.ascontiguousarray(np.asarray(data[start:start + chunk_size]), dtype=np.uint8).tobytes())
+            os.replace(tmp, fileout)
+        except (OSError, CancelledError):
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            return False
+        return True
+
+    def _read(self, shard:int, row:int):
+        """row of a shard, from its decoded buffer once written (patch stores)"""
+        if self.buffer_dir is not None and shard not in self._buffer and self.compressed(shard):
+            try:
+                self._buffer[shard] = np.load(f"{self.buffer_dir}/{shard}.npy", mmap_mode="r")
+                if len(self._buffer) > 2:
+                    del self._buffer[next(iter(self._buffer))] # memory of removed buffers is released
+            except (OSError, ValueError):
+                pass # not decoded yet / removed
+        if shard in self._buffer:
+            return np.asarray(self._buffer[shard][row])
+        return np.asarray(self._open(shard)[row])
+
+    def __len__(self):
+        return self.datanum
+
+    def __getitem__(self, idx):
+        shard, row = self.locate(idx)
+        out_data = self._read(shard, row)
+        out_data = Image.fromarray(out_data).convert("RGB")
+        if self._transform:
+            for t in self._transform:
+                out_data = t(out_data)
+        if self.lst_filelabel is None:
+            return out_data
+        out_label = torch.Tensor(np.array(self._open_label(shard)[row]))
+        return out_data, out_label
+
+class ShardSampler(Sampler):
+    """
+    permutation of a ShardDataset, renewed with set_epoch
+    Parameters
+    ----------
+    dataset: ShardDataset (or any sized dataset)
+    mode: str
+        "global": uniform permutation over all patches
+        "block": blocks of block_size consecutive rows are permuted,
+                 then rows are shuffled within windows of window_block blocks (page-cache friendly)
+        "shard": shards in random order, rows shuffled within each shard,
+                 shard k+1 is prefetched by a background thread while shard k is consumed:
+                 raw .npy shards are read once through the page cache (ShardDataset.warm),
+                 patch stores are decoded to buffer_dir (ShardDataset.decode), the workers read the decoded rows
+                 once written (at most the current and next shards are kept)
+    seed: int
+    buffer_dir: folder of the decoded patch stores (a temporary folder, removed by close), needs ~2 decoded shards of space
+    """
+    def __init__(self, dataset, mode:str="global", block_size:int=256, window_block:int=8, seed:int=0, buffer_dir:str=None):
+        if mode not in ("global", "block", "shard"):
+            raise ValueError(f"mode must be global, block or shard: {mode}")
+        self.dataset = dataset
+        self.num_samples = len(dataset)
+        self.mode = mode
+        self.block_size = block_size
+        self.window_block = window_block
+        self.seed = seed
+        self.epoch = 0
+        self._executor = None
+        self._futures = []
+        self._stop = threading.Event()
+        self.buffer_dir = None
+        if mode == "shard" and hasattr(dataset, "decode"):
+            # set before the workers copy the dataset
+            self.buffer_dir = tempfile.mkdtemp(prefix="shard_", dir=buffer_dir)
+            dataset.buffer_dir = self.buffer_dir
+            self._finalizer = weakref.finalize(self, shutil.rmtree, self.buffer_dir, True)
+
+    def set_epoch(self, epoch:int=0):
+        self.epoch = epoch
+
+    def _shard_order(self, rng):
+        """[(shard, rows)] in the order of the epoch"""
+        shard_index = self.dataset.shard_index()
+        return [
+            (shard, rng.permutation(np.flatnonzero(shard_index==shard)))
+            for shard in rng.permutation(np.unique(shard_index))
+            ]
+
+    def permutation(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        if self.mode == "global":
+            return rng.permutation(self.num_samples)
+        if self.mode == "shard":
+            lst_rows = [rows for _, rows in self._shard_order(rng)]
+            return np.concatenate(lst_rows) if lst_rows else np.zeros(0, dtype=int)
+        n_block = -(-self.num_samples // self.block_size)
+        order = rng.permutation(n_block)
+        res = []
+        for start in range(0, n_block, self.window_block):
+            rows = np.concatenate([
+                np.arange(b*self.block_size, min((b+1)*self.block_size, self.num_samples))
+                for b in order[start:start+self.window_block]
+                ])
+            res.append(rng.permutation(rows))
+        return np.concatenate(res) if res else np.zeros(0, dtype=int)
+
+    def _iter_shard(self):
+        # the sampler runs in the main process, ahead of the workers by their prefetch
+        lst_order = self._shard_order(np.random.default_rng(self.seed + self.epoch))
+        try:
+            for k, (shard, rows) in enumerate(lst_order):
+                self._remove_buffer(keep=[shard])
+                if k + 1 < len(lst_order):
+                    self._prefetch(lst_order[k+1][0])
+                yield from rows.tolist()
+        finally:
+            self._cancel() # end of epoch or loader iteration abandoned
+
+    def _prefetch(self, shard:int):
+        """decode (patch store) or read ahead (.npy) shard in the background"""
+        if self.buffer_dir is None:
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1)
+        self._futures = [v for v in self._futures if not v.done()]
+        if self.dataset.compressed(shard):
+            future = self._executor.submit(self.dataset.decode, shard, f"{self.buffer_dir}/{shard}.npy", stop=self._stop)
+        else:
+            future = self._executor.submit(self.dataset.warm, shard, stop=self._stop)
+        self._futures.append(future)
+
+    def _cancel(self):
+        """cancel the pending decodings and wait for the running one"""
+        self._stop.set()
+        for future in self._futures:
+            future.cancel()
+        for future in self._futures:
+            try:
+                future.result()
+            except CancelledError:
+                pass
+        self._futures = []
+        self._stop.clear()
+
+    def _remove_buffer(self, keep=list()):
+        """remove the decoded shards but keep (workers still reading them keep their memory map)"""
+        if self.buffer_dir is None:
+            return
+        for filename in os.listdir(self.buffer_dir):
+            stem = filename.split(".")[0]
+            if filename.endswith(".npy") and ".tmp" not in filename and stem.isdigit() and int(stem) not in keep:
+                os.remove(f"{self.buffer_dir}/{filename}")
+
+    def close(self):
+        """stop the background decoding, shut the thread down and remove buffer_dir"""
+        self._cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self.buffer_dir is not None:
+            self._finalizer()
+
+    def __iter__(self):
+        if self.mode == "shard":
+            return self._iter_shard()
+        return iter(self.permutation().tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+class TimedLoader:
+    """
+    loader wrapper accumulating the time the training loop waited for batches
+    wait / elapsed are reset at each iteration (epoch)
+    """
+    def __init__(self, loader):
+        self.loader = loader
+        self.wait = 0.
+        self.elapsed = 0.
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def set_epoch(self, epoch:int=0):
+        """forwarded to the sampler (ShardSampler) or the dataset (e.g. IterableDataset) if supported"""
+        for obj in (self.loader.sampler, self.loader.dataset):
+            if hasattr(obj, "set_epoch"):
+                obj.set_epoch(epoch)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.wait, self.elapsed = 0., 0.
+        start = time.perf_counter()
+        iterator = iter(self.loader)
+        while True:
+            t = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                break
+            self.wait += time.perf_counter() - t
+            yield batch
+        self.elapsed = time.perf_counter() - start
+
+    def close(self):
+        """release the resources of the sampler (ShardSampler background decoding) if any"""
+        if hasattr(self.loader.sampler, "close"):
+            self.loader.sampler.close()
+
+    def summary(self):
+        ratio = self.wait / self.elapsed if self.elapsed > 0 else 0.
+        return f"data wait: {self.wait:.1f} s / {self.elapsed:.1f} s ({ratio:.1%})"
+
+def prep_shard_dataloader(
+    dataset, batch_size:int, mode:str="global", block_size:int=256, seed:int=0,
+    num_workers:int=4, pin_memory:bool=True, drop_last:bool=True, prefetch_factor:int=4, collate_fn=None,
+    buffer_dir:str=None,
+    ):
+    """
+    DataLoader over a ShardDataset with a ShardSampler (call loader.sampler.set_epoch(epoch) each epoch)
+    workers are kept alive for the whole run, the loader is wrapped in TimedLoader (loader.close() at the end of the run)
+    mode: "global", "block", "shard" or "none" (no shuffle, e.g. validation)
+    collate_fn: e.g. collate_uint8 for uint8 batches
+    buffer_dir: folder of the decoded patch stores of the "shard" mode (system temporary folder if None)
+    """
+    sampler = None if mode == "none" else ShardSampler(dataset, mode=mode, block_size=block_size, seed=seed, buffer_dir=buffer_dir)
+    return TimedLoader(prep_dataloader(
+        dataset, batch_size, shuffle=False, num_workers=num_workers, pin_memory=pin_memory,
+        drop_last=drop_last, sampler=sampler, collate_fn=collate_fn,
+        persistent_workers=num_workers > 0, prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        ))
+
+class MultiSlideDataset(torch.utils.data.IterableDataset):
+    """
+    one stream over the patches of many slides, for a single long-lived DataLoader (batch_size=None)
+    slides are split over the workers (slide i to worker i % num_workers), each worker opens its slides one by one
+    and yields full batches, which may span slide boundaries
+    a slide without patches yields an empty-slide record (data None, slide_len 0, no patch), for its zero-row outputs
+    Parameters
+    ----------
+    dataset_class: map-style dataset of one slide (with lst_location, optionally __getitems__)
+    lst_kwargs: list of kwargs of dataset_class, one per slide (the dataset is built in the worker)
+    batch_size: int
+    lst_skip: list (one per slide) of [start, stop) patch index ranges not read (e.g. featurized before a restart), or None
+    Yields
+    ------
+    data: torch.Tensor [batch, ...]
+    slide_id: torch.LongTensor [batch], index in lst_kwargs
+    patch_idx: torch.LongTensor [batch], index of the patch in its slide
+    slide_len: torch.LongTensor [batch], number of patches of the slide
+    xy: torch.IntTensor [batch, 2], level 0 location of the patch
+    empty-slide record: (None, slide_id [1], patch_idx [0], slide_len [1] (0), xy [0, 2])
+    """
+    def __init__(self, dataset_class=None, lst_kwargs=list(), batch_size:int=128, lst_skip=None):
+        self.dataset_class = dataset_class
+        self.lst_kwargs = lst_kwargs
+        self.batch_size = batch_size
+        self.lst_skip = lst_skip
+
+    def __len__(self):
+        return len(self.lst_kwargs)
+
+    def _collate(self, lst_item):
+        data, slide_id, patch_idx, slide_len, xy = zip(*lst_item)
+        return (
+            stack_uint8(data), torch.tensor(slide_id), torch.tensor(patch_idx),
+            torch.tensor(slide_len), torch.tensor(np.stack(xy), dtype=torch.int32),
+            )
+
+    def _empty(self, slide_id:int=0):
+        return (
+            None, torch.tensor([slide_id]), torch.zeros(0, dtype=torch.int64),
+            torch.tensor([0]), torch.zeros((0, 2), dtype=torch.int32),
+            )
+
+    def __iter__(self):
+        info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if info is None else (info.id, info.num_workers)
+        buffer = []
+        for slide_id in range(worker_id, len(self.lst_kwargs), num_workers):
+            dataset = self.dataset_class(**self.lst_kwargs[slide_id])
+            locations = np.asarray(dataset.lst_location)
+            slide_len = len(dataset)
+            if slide_len == 0:
+                yield self._empty(slide_id)
+            todo = np.ones(slide_len, dtype=bool)
+            if self.lst_skip is not None:
+                for start, stop in self.lst_skip[slide_id]:
+                    todo[start:stop] = False
+            todo = np.flatnonzero(todo)
+            for start in range(0, len(todo), self.batch_size):
+                lst_idx = todo[start:start + self.batch_size].tolist()
+                if hasattr(dataset, "__getitems__"):
+                    lst_data = dataset.__getitems__(lst_idx)
+                else:
+                    lst_data = [dataset[idx] for idx in lst_idx]
+                for idx, data in zip(lst_idx, lst_data):
+                    buffer.append((data, slide_id, idx, slide_len, locations[idx]))
+                    if len(buffer) == self.batch_size:
+                        yield self._collate(buffer)
+                        buffer = []
+            if hasattr(dataset, "close"):
+                dataset.close() # handles of the slide are released before the next one
+            del dataset
+        if buffer:
+            yield self._collate(buffer)
+
+def prep_stream_dataloader(dataset, num_workers:int=4, pin_memory:bool=True, prefetch_factor:int=2):
+    """DataLoader over a MultiSlideDataset (batches are built in the workers)"""
+    return torch.utils.data.DataLoader(
+        dataset, batch_size=None, num_workers=num_workers, pin_memory=pin_memory,
+        worker_init_fn=_worker_init_fn,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        )
+
+# uint8 eval path: workers return uint8 HWC arrays, crop / normalization once per batch on the device
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+class ToUInt8:
+    """PIL image or array to a contiguous uint8 RGB np.array [height, width, 3] (worker side, replaces ToTensor + Normalize)"""
+    def __call__(self, image):
+        if isinstance(image, Image.Image):
+            image = image.convert("RGB")
+        return np.ascontiguousarray(np.asarray(image, dtype=np.uint8)[..., :3])
+
+def stack_uint8(lst_data):
+    """uint8 arrays (or tensors) to one tensor, without float copies"""
+    if isinstance(lst_data[0], np.ndarray):
+        return torch.from_numpy(np.stack(lst_data))
+    return torch.stack(lst_data)
+
+def collate_uint8(batch):
+    """collate_fn stacking uint8 arrays into one uint8 tensor [batch, height, width, 3], other fields as default"""
+    elem = batch[0]
+    if isinstance(elem, np.ndarray):
+        return stack_uint8(batch)
+    if isinstance(elem, (tuple, list)):
+        return [collate_uint8(list(samples)) for samples in zip(*batch)]
+    return torch.utils.data.default_collate(batch)
+
+class BatchNormalize:
+    """
+    uint8 batch [..., height, width, 3] to the normalized float batch [..., 3, height, width] (cropped) on the device
+    same values as CenterCrop (optional) + ToTensor + Normalize applied to each image
+    Parameters
+    ----------
+    crop: (height, width) of the center crop or None
+    mean, std: Normalize parameters
+    DEVICE: device of the output
+    """
+    def __init__(self, crop=None, mean=IMAGENET_MEAN, std=IMAGENET_STD, DEVICE="cpu"):
+        self.crop = crop
+        self.DEVICE = DEVICE
+        self.mean = torch.tensor(mean, dtype=torch.float32, device=DEVICE).view(-1, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32, device=DEVICE).view(-1, 1, 1)
+
+    def __call__(self, x):
+        x = x.to(self.DEVICE, non_blocking=True).movedim(-1, -3) # channels first, uint8
+        if self.crop is not None:
+            x = transforms.functional.center_crop(x, list(self.crop))
+        # same operations (and order) as ToTensor + Normalize, on the whole batch
+        x = x.contiguous().to(torch.float32).div_(255)
+        return x.sub_(self.mean).div_(self.std)
+
+def prepare_uint8_transform(crop=None, resize=None, mean=IMAGENET_MEAN, std=IMAGENET_STD, DEVICE="cpu"):
+    """
+    (worker transform, batch transform) reproducing
+    Compose([CenterCrop(crop) / Resize(resize, antialias=True), ToTensor(), Normalize(mean, std)])
+    resize is applied in the worker (PIL), crop on the batch
+    """
+    lst_transform = [transforms.Resize(resize, antialias=True)] if resize is not None else []
+    worker_transform = transforms.Compose(lst_transform + [ToUInt8()])
+    return worker_transform, BatchNormalize(crop=crop, mean=mean, std=std, DEVICE=DEVICE)
+
 class BalancedSampler(WeightedRandomSampler):
     def __init__(self, dataset, n_frac = None, n_samples = None):
         avg = np.mean(dataset.labels, axis=0)
@@ -89,6 +579,10 @@ def resize_dataset_dir(dataset, size:int=256):
 
 def resize_dataset(dataset, size:int=256):
     """ data resize for small scaling """
+    if isinstance(dataset, ShardDataset):
+        dataset.indices = np.arange(min(size, dataset.datanum))
+        dataset.datanum = len(dataset.indices)
+        return dataset
     dataset.data = dataset.data[:size]
     dataset.datanum = size
     return dataset
\ No newline at end of file
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+# compressed patch store
+per-patch encoded images (png / webp (lossless with quality > 100) / jpg) concatenated in one file,
+with an offset index for O(1) random access
+
+layout: {name}.pstore/data.bin, offset.npy (int64 [n_patch+1]), meta.json
+the raw .npy shards ([n_patch, height, width, 3] uint8, RGB) are converted with convert_npy
+
+@author: Katsuhisa MORITA
+"""
+import os
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import cv2
+
+STORE_SUFFIX = ".pstore"
+DICT_EXT = {"png": ".png", "webp": ".webp", "jpg": ".jpg"}
+
+def _encode_params(codec:str="png", quality:int=None):
+    if codec == "png":
+        return [cv2.IMWRITE_PNG_COMPRESSION, 3 if quality is None else int(quality)]
+    if codec == "webp":
+        return [cv2.IMWRITE_WEBP_QUALITY, 101 if quality is None else int(quality)] # > 100: lossless
+    if codec == "jpg":
+        return [cv2.IMWRITE_JPEG_QUALITY, 95 if quality is None else int(quality)]
+    raise ValueError(f"codec must be one of {list(DICT_EXT)}: {codec}")
+
+def encode_patch(patch, codec:str="png", quality:int=None):
+    """RGB uint8 patch to encoded bytes"""
+    ok, buf = cv2.imencode(
+        DICT_EXT[codec], cv2.cvtColor(np.ascontiguousarray(patch), cv2.COLOR_RGB2BGR), _encode_params(codec, quality),
+        )
+    if not ok:
+        raise ValueError(f"failed to encode a patch as {codec}")
+    return buf.tobytes()
+
+def decode_patch(buf):
+    """encoded bytes to RGB uint8 patch"""
+    image = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_COLOR)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+class _PatchSequence:
+    """indexing shared by stores, subsets and concatenations (int: patch, slice / array: subset)"""
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            if idx < 0:
+                idx += len(self)
+            if not 0 <= idx < len(self):
+                raise IndexError(f"index {idx} is out of range for {len(self)} patches")
+            return self._get(int(idx))
+        if isinstance(idx, slice):
+            return _PatchSubset(self, np.arange(len(self))[idx])
+        return _PatchSubset(self, np.arange(len(self))[np.asarray(idx)])
+
+    def get_batch(self, indices, num_threads:int=4):
+        """decode patches in parallel, np.array(uint8)[len(indices), height, width, 3]"""
+        indices = [int(i) for i in indices]
+        with ThreadPoolExecutor(num_threads) as executor:
+            return np.stack(list(executor.map(self.__getitem__, indices)))
+
+    def __array__(self, dtype=None, copy=None):
+        res = self.get_batch(range(len(self)))
+        return res if dtype is None else res.astype(dtype)
+
+class PatchStore(_PatchSequence):
+    """
+    read-only compressed patch store (memory-mapped, safe to share over forked workers)
+    Parameters
+    ----------
+    folder: path of the {name}.pstore folder
+    """
+    def __init__(self, folder:str=""):
+        self.folder = folder
+        with open(f"{folder}/meta.json") as f:
+            self.meta = json.load(f)
+        self.offset = np.load(f"{folder}/offset.npy", mmap_mode="r")
+        self.data = np.memmap(f"{folder}/data.bin", dtype=np.uint8, mode="r") if self.offset[-1] > 0 else np.zeros(0, dtype=np.uint8)
+        self.shape = (len(self.offset) - 1, *self.meta["patch_shape"])
+
+    def __len__(self):
+        return len(self.offset) - 1
+
+    def _get(self, idx:int):
+        return decode_patch(self.data[self.offset[idx]:self.offset[idx+1]])
+
+    def nbytes(self):
+        """size on disk"""
+        return sum(os.path.getsize(f"{self.folder}/{name}") for name in os.listdir(self.folder))
+
+class _PatchSubset(_PatchSequence):
+    def __init__(self, base, indices):
+        self.base = base
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def _get(self, idx:int):
+        return self.base._get(int(self.indices[idx]))
+
+class PatchConcat(_PatchSequence):
+    """concatenation of patch sequences (PatchStore or np.array) without loading"""
+    def __init__(self, lst_patches=list()):
+        self.lst_patches = lst_patches
+        self.cumsum = np.cumsum([0] + [len(patches) for patches in lst_patches])
+
+    def __len__(self):
+        return int(self.cumsum[-1])
+
+    def _get(self, idx:int):
+        i = int(np.searchsorted(self.cumsum, idx, side="right")) - 1
+        return self.lst_patches[i][idx - int(self.cumsum[i])]
+
+def write_patchstore(fileout:str="", patches=None, codec:str="png", quality:int=None, num_threads:int=4, chunk_size:int=1024):
+    """
+    encode patches (np.array(uint8)[n_patch, height, width, 3] or memmap, RGB) into a store
+    written to a temporary folder and renamed when complete
+    """
+    tmp = f"{fileout}.tmp{os.getpid()}"
+    os.makedirs(tmp, exist_ok=True)
+    offset = np.zeros(len(patches) + 1, dtype=np.int64)
+    try:
+        with open(f"{tmp}/data.bin", "wb") as f, ThreadPoolExecutor(num_threads) as executor:
+            for start in range(0, len(patches), chunk_size):
+                chunk = np.asarray(patches[start:start+chunk_size])
+                for i, buf in enumerate(executor.map(lambda p: encode_patch(p, codec, quality), chunk)):
+                    f.write(buf)
+                    offset[start+i+1] = offset[start+i] + len(buf)
+        np.save(f"{tmp}/offset.npy", offset)
+        with open(f"{tmp}/meta.json", "w") as f:
+            json.dump({
+                "n_patch": int(len(patches)), "patch_shape": list(patches.shape[1:]),
+                "codec": codec, "quality": quality,
+                }, f)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    if os.path.isdir(fileout):
+        shutil.rmtree(fileout)
+    os.rename(tmp, fileout)
+    return fileout
+
+def store_path(filein:str=""):
+    """{name}.pstore for {name}.npy"""
+    root, ext = os.path.splitext(filein)
+    return (root if ext == ".npy" else filein) + STORE_SUFFIX
+
+def convert_npy(filein:str="", fileout:str=None, codec:str="png", quality:int=None, num_threads:int=4, chunk_size:int=1024):
+    """convert a raw .npy shard (read memory-mapped, chunk by chunk) to a patch store"""
+    fileout = fileout if fileout else store_path(filein)
+    return write_patchstore(
+        fileout, np.load(filein, mmap_mode="r"),
+        codec=codec, quality=quality, num_threads=num_threads, chunk_size=chunk_size,
+        )
+
+def load_patches(filein:str=""):
+    """
+    patches of a shard: the patch store ({name}.pstore) if it exists, else the raw .npy (loaded)
+    filein: path of the raw shard ({name}.npy) or of the store
+    """
+    if filein.endswith(STORE_SUFFIX):
+        return PatchStore(filein)
+    folder = store_path(filein)
+    if os.path.isdir(folder):
+        return PatchStore(folder)
+    with open(filein, 'rb') as f:
+        return np.load(f)
+
+def concat_patches(lst_patches=list()):
+    """np.concatenate for raw arrays, PatchConcat otherwise"""
+    if all([isinstance(patches, np.ndarray) for patches in lst_patches]):
+        return np.concatenate(lst_patches, axis=0)
+    return PatchConcat(lst_patches)
+
+if __name__ == '__main__':
+    import argparse
+    from tqdm import tqdm
+    parser = argparse.ArgumentParser(description='convert .npy shards to patch stores')
+    parser.add_argument('lst_filein', type=str, nargs='+')
+    parser.add_argument('--codec', type=str, default='png', choices=list(DICT_EXT))
+    parser.add_argument('--quality', type=int, default=None)
+    parser.add_argument('--num_threads', type=int, default=8)
+    args = parser.parse_args()
+    for filein in tqdm(args.lst_filein):
+        if os.path.isdir(store_path(filein)):
+            continue
+        convert_npy(filein, codec=args.codec, quality=args.quality, num_threads=args.num_threads)
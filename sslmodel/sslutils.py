@@ -11,6 +11,7 @@ import torch.nn as nn
 import torchvision
 
 import sslmodel
+from sslmodel import augment
 from sslmodel.models import barlowtwins, simsiam, byol, swav, linearhead
 
 class BarlowTwins:
@@ -38,6 +39,22 @@ class BarlowTwins:
             )
         return train_transform
 
+    def prepare_batch_transform(
+        self,
+        color_plob=0.8,
+        blur_plob=0.2,
+        solar_plob=0.
+        ):
+        """batched version of prepare_transform, applied to uint8 batches on DEVICE (sslmodel.augment)"""
+        train_transform = augment.batch_ssl_transform(
+            color_plob=color_plob,
+            blur_plob=blur_plob, 
+            solar_plob=solar_plob,
+            split=True, multi=False,
+            DEVICE=self.DEVICE,
+            )
+        return train_transform
+
     def prepare_featurize_model(self, backbone, model_path:str="", head_size:int=512, pred_dim=128, projection_dim=512):
         model = barlowtwins.BarlowTwins(backbone, head_size=[head_size, projection_dim, pred_dim])
         model.load_state_dict(torch.load(model_path))
@@ -85,6 +102,22 @@ class Byol:
             )
         return train_transform
 
+    def prepare_batch_transform(
+        self,
+        color_plob=0.8,
+        blur_plob=0.2,
+        solar_plob=0.
+        ):
+        """batched version of prepare_transform, applied to uint8 batches on DEVICE (sslmodel.augment)"""
+        train_transform = augment.batch_ssl_transform(
+            color_plob=color_plob,
+            blur_plob=blur_plob, 
+            solar_plob=solar_plob,
+            split=True, multi=False,
+            DEVICE=self.DEVICE,
+            )
+        return train_transform
+
     def prepare_featurize_model(self, backbone, model_path:str="", head_size:int=512, projection_hidden_size:int=2048):
         """return backbone model"""
         model = byol.BYOL(
@@ -134,6 +167,22 @@ class SwaV:
             )
         return train_transform
 
+    def prepare_batch_transform(
+        self,
+        color_plob=0.8,
+        blur_plob=0.2,
+        solar_plob=0.
+        ):
+        """batched version of prepare_transform, applied to uint8 batches on DEVICE (sslmodel.augment)"""
+        train_transform = augment.batch_ssl_transform(
+            color_plob=color_plob,
+            blur_plob=blur_plob, 
+            solar_plob=solar_plob,
+            split=True, multi=True,
+            DEVICE=self.DEVICE,
+            )
+        return train_transform
+
     def prepare_featurize_model(self, backbone, model_path:str="", head_size:int=512):
         """return backbone model"""
         model = swav.SwaV(
@@ -183,6 +232,22 @@ class SimSiam:
             )
         return train_transform
 
+    def prepare_batch_transform(
+        self,
+        color_plob=0.8,
+        blur_plob=0.2,
+        solar_plob=0.
+        ):
+        """batched version of prepare_transform, applied to uint8 batches on DEVICE (sslmodel.augment)"""
+        train_transform = augment.batch_ssl_transform(
+            color_plob=color_plob,
+            blur_plob=blur_plob, 
+            solar_plob=solar_plob,
+            split=True, multi=False,
+            DEVICE=self.DEVICE,
+            )
+        return train_transform
+
     def prepare_featurize_model(self, backbone, model_path:str="", head_size:int=512, dim=2048, pred_dim=512,):
         """return backbone model"""
         model= simsiam.SimSiam(
@@ -226,6 +291,22 @@ class WSL:
             )
         return train_transform
 
+    def prepare_batch_transform(
+        self,
+        color_plob=0.8,
+        blur_plob=0.2,
+        solar_plob=0.
+        ):
+        """batched version of prepare_transform, applied to uint8 batches on DEVICE (sslmodel.augment)"""
+        train_transform = augment.batch_ssl_transform(
+            color_plob=color_plob,
+            blur_plob=blur_plob, 
+            solar_plob=solar_plob,
+            split=False, multi=False,
+            DEVICE=self.DEVICE,
+            )
+        return train_transform
+
     def prepare_featurize_model(self, backbone, model_path:str="", head_size:int=512, num_classes=8):
         """return backbone model"""
         model= linearhead.LinearHead(backbone, dim=head_size, num_classes=num_classes)
@@ -255,3 +336,13 @@ class BarlowTwinsWS(BarlowTwins):
         """return transforms for ssl"""
         train_transform = sslmodel.utils.weak_strong_transform()
         return train_transform
+
+    def prepare_batch_transform(
+        self,
+        color_plob=None,
+        blur_plob=None,
+        solar_plob=None,
+        ):
+        """batched version of prepare_transform (sslmodel.augment)"""
+        train_transform = augment.batch_weak_strong_transform(DEVICE=self.DEVICE)
+        return train_transform
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+# running aggregation of patch features
+statistics of groups of consecutive patches updated batch by batch,
+buffers are preallocated from the number of patches (memory: groups x features, not patches x features)
+
+@author: Katsuhisa MORITA
+"""
+import numpy as np
+
+LST_STAT = ["max", "min", "mean", "std", "topk"]
+
+class RunningAggregator:
+    """
+    per-layer statistics of the groups of num_pool_patch consecutive patches (patch i in group i // num_pool_patch)
+    Parameters
+    ----------
+    num_patch: int, number of patches (len(dataset))
+    lst_size: list of feature sizes of the layers
+    num_pool_patch: int, patches per group, all patches in one group if None
+    lst_stat: list of statistics computed in the same pass, in LST_STAT
+        "std": population standard deviation, "topk": mean of the k largest values of each feature
+    k: int, for "topk"
+    """
+    def __init__(self, num_patch:int=0, lst_size=list(), num_pool_patch:int=None, lst_stat=["max"], k:int=10):
+        for stat in lst_stat:
+            if stat not in LST_STAT:
+                raise ValueError(f"unknown statistic: {stat}, choose from {LST_STAT}")
+        self.num_patch = num_patch
+        self.lst_size = lst_size
+        self.num_pool_patch = num_pool_patch if num_pool_patch else max(num_patch, 1)
+        self.lst_stat = lst_stat
+        self.k = k
+        self.num_group = -(-num_patch // self.num_pool_patch)
+        self.reset()
+
+    def reset(self):
+        self._count = 0 # patches received
+        self.counts = np.zeros(self.num_group, dtype=np.int64)
+        self._buffer = dict()
+        for stat in self.lst_stat:
+            if stat == "max":
+                self._buffer[stat] = [np.full((self.num_group, size), -np.inf, dtype=np.float32) for size in self.lst_size]
+            elif stat == "min":
+                self._buffer[stat] = [np.full((self.num_group, size), np.inf, dtype=np.float32) for size in self.lst_size]
+            elif stat == "topk":
+                self._buffer[stat] = [np.full((self.num_group, self.k, size), -np.inf, dtype=np.float32) for size in self.lst_size]
+        if "mean" in self.lst_stat or "std" in self.lst_stat:
+            self._buffer["sum"] = [np.zeros((self.num_group, size), dtype=np.float64) for size in self.lst_size]
+        if "std" in self.lst_stat:
+            self._buffer["sumsq"] = [np.zeros((self.num_group, size), dtype=np.float64) for size in self.lst_size]
+
+    def update(self, outs, patch_idx=None):
+        """
+        outs: list of arrays [batch, size] (one per layer)
+        patch_idx: index of each patch, the next ones in order if None
+        """
+        n = len(outs[0])
+        if patch_idx is None:
+            patch_idx = np.arange(self._count, self._count + n)
+        self._count += n
+        gid = np.asarray(patch_idx) // self.num_pool_patch
+        order = None
+        if np.any(gid[1:] < gid[:-1]):
+            order = np.argsort(gid, kind="stable")
+            gid = gid[order]
+        # one segment per group of the batch
+        starts = np.flatnonzero(np.r_[True, gid[1:] != gid[:-1]])
+        groups = gid[starts]
+        self.counts[groups] += np.diff(np.r_[starts, n])
+        for i, out in enumerate(outs):
+            out = np.asarray(out, dtype=np.float32)
+            if order is not None:
+                out = out[order]
+            if "max" in self._buffer:
+                buf = self._buffer["max"][i]
+                buf[groups] = np.maximum(buf[groups], np.maximum.reduceat(out, starts, axis=0))
+            if "min" in self._buffer:
+                buf = self._buffer["min"][i]
+                buf[groups] = np.minimum(buf[groups], np.minimum.reduceat(out, starts, axis=0))
+            if "sum" in self._buffer:
+                out64 = out.astype(np.float64)
+                self._buffer["sum"][i][groups] += np.add.reduceat(out64, starts, axis=0)
+                if "sumsq" in self._buffer:
+                    self._buffer["sumsq"][i][groups] += np.add.reduceat(out64 ** 2, starts, axis=0)
+            if "topk" in self._buffer:
+                buf = self._buffer["topk"][i]
+                for g, start, end in zip(groups, starts, np.r_[starts[1:], n]):
+                    cand = np.concatenate([buf[g], out[start:end]])
+                    buf[g] = -np.partition(-cand, self.k - 1, axis=0)[:self.k]
+
+    def state_dict(self, groups=None):
+        """
+        dict of arrays of the running state (e.g. saved by tggate.journal to resume a slide)
+        groups: index of the groups whose rows are saved (incremental save), all if None
+        """
+        state = {"count": np.array(self._count)}
+        if groups is not None:
+            groups = np.asarray(groups, dtype=np.int64)
+            state["groups"] = groups
+        state["counts"] = self.counts if groups is None else self.counts[groups]
+        for key, lst_buf in self._buffer.items():
+            for i, buf in enumerate(lst_buf):
+                state[f"{key}{i}"] = buf if groups is None else buf[groups]
+        return state
+
+    def load_state_dict(self, state):
+        """restore a state_dict of an aggregator of the same settings (only its groups if saved with groups)"""
+        groups = state["groups"] if "groups" in state else slice(None)
+        self._count = int(state["count"])
+        self.counts[groups] = state["counts"]
+        for key, lst_buf in self._buffer.items():
+            for i, buf in enumerate(lst_buf):
+                if state[f"{key}{i}"].shape != buf[groups].shape:
+                    raise ValueError(f"{key}{i}: shape {state[f'{key}{i}'].shape}, {buf[groups].shape} expected")
+                buf[groups] = state[f"{key}{i}"]
+
+    def result(self):
+        """dict of statistic: list of arrays [num_group, size] (float32), one per layer"""
+        if self._count != self.num_patch:
+            raise ValueError(f"{self._count} patches received, {self.num_patch} expected")
+        counts = self.counts.reshape(-1, 1)
+        res = dict()
+        for stat in self.lst_stat:
+            if stat in ("max", "min"):
+                res[stat] = [v.copy() for v in self._buffer[stat]]
+            elif stat == "mean":
+                res[stat] = [(v / counts).astype(np.float32) for v in self._buffer["sum"]]
+            elif stat == "std":
+                res[stat] = [
+                    np.sqrt(np.maximum(sq / counts - (s / counts) ** 2, 0)).astype(np.float32)
+                    for s, sq in zip(self._buffer["sum"], self._buffer["sumsq"])
+                    ]
+            elif stat == "topk":
+                # groups smaller than k: mean of their values
+                lst = []
+                for v in self._buffer["topk"]:
+                    top = -np.sort(-v, axis=1)
+                    num = np.minimum(self.counts, self.k).reshape(-1, 1, 1)
+                    top = np.where(np.arange(self.k).reshape(1, -1, 1) < num, top, 0)
+                    lst.append((top.sum(axis=1, dtype=np.float64) / num[:, 0]).astype(np.float32))
+                res[stat] = lst
+        return res
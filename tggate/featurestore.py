@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+# feature store
+features of all slides of one model in one append-only float32 array per layer key
+(layer{i}, layer{i}_{stat}, as the former {name}_layer{i}[_{stat}].npy files),
+with a slide -> row range index and the patch coordinates
+
+layout: {name}.fstore/meta.json (layer sizes, model checkpoint hash, preprocessing),
+    {key}.bin (float32 [n_row, size]), location.bin (int32 [n_patch, (x, y)]), index.jsonl (one line per slide)
+a slide is appended to the arrays (fsync) before its index line: rows after the last indexed slide
+(interrupted append) are dropped when the store is opened again, single writer
+the former directories of .npy files are converted with migrate_folder (python -m tggate.featurestore)
+
+@author: Katsuhisa MORITA
+"""
+import os
+import re
+import json
+import hashlib
+
+import numpy as np
+
+from slide.location import LocationTable
+from slide.cache import find_locations
+
+STORE_SUFFIX = ".fstore"
+VERSION = 1
+
+def file_sha256(filein:str="", chunk_size:int=1 << 20):
+    """sha256 of a file (e.g. model checkpoint), None if filein is empty / missing"""
+    if not filein or not os.path.isfile(filein):
+        return None
+    h = hashlib.sha256()
+    with open(filein, "rb") as f:
+        for buf in iter(lambda: f.read(chunk_size), b""):
+            h.update(buf)
+    return h.hexdigest()
+
+def store_path(folder:str="", prefix:str=""):
+    """{folder}/{prefix}.fstore of the files {folder}/{prefix}{slide}_{key}.npy (e.g. prefix fold0_ -> fold0.fstore)"""
+    return f"{folder}/{prefix.rstrip('_') or 'features'}{STORE_SUFFIX}"
+
+def model_meta(model_name:str="", ssl_name:str="", model_path:str="", pretrained:bool=False):
+    """meta of the model: names and checkpoint hash"""
+    return {
+        "model_name": model_name, "ssl_name": ssl_name, "pretrained": pretrained,
+        "model_path": model_path, "checkpoint_sha256": None if pretrained else file_sha256(model_path),
+        }
+
+def _fsync_append(fileout:str="", buf=b""):
+    with open(fileout, "ab") as f:
+        f.write(buf)
+        f.flush()
+        os.fsync(f.fileno())
+
+class FeatureStore:
+    """
+    feature store of one model
+    Parameters
+    ----------
+    folder: path of the {name}.fstore folder
+    mode: "r" (read only) or "a" (append, created if missing)
+    model: dict, meta of the model (model_meta), checked against the one of an existing store
+    preprocessing: dict, meta of the patches (patch size, pooling, ...), checked as model
+    """
+    def __init__(self, folder:str="", mode:str="r", model=None, preprocessing=None):
+        if mode not in ("r", "a"):
+            raise ValueError(f"mode must be 'r' or 'a': {mode}")
+        self.folder = folder
+        self.mode = mode
+        if not os.path.isfile(f"{folder}/meta.json"):
+            if mode == "r":
+                raise FileNotFoundError(f"no feature store: {folder}")
+            os.makedirs(folder, exist_ok=True)
+            self.meta = {"version": VERSION, "model": model or dict(), "preprocessing": preprocessing or dict(), "layer": dict()}
+            self._save_meta()
+        else:
+            with open(f"{folder}/meta.json") as f:
+                self.meta = json.load(f)
+            for key, value in (("model", model), ("preprocessing", preprocessing)):
+                if value is not None and json.loads(json.dumps(value)) != self.meta[key]:
+                    raise ValueError(f"{key} differs from the one of the store {folder}: {value} != {self.meta[key]}")
+        self.index = dict() # slide: {"row": [start, stop], "location": [start, stop] or None}
+        self._num_row, self._num_location = 0, 0
+        if os.path.isfile(f"{folder}/index.jsonl"):
+            with open(f"{folder}/index.jsonl") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break # interrupted index line
+                    entry = json.loads(line)
+                    self.index[entry["name"]] = entry
+                    self._num_row = entry["row"][1]
+                    if entry["location"] is not None:
+                        self._num_location = entry["location"][1]
+        if mode == "a":
+            self._truncate()
+        self._memmap = dict()
+
+    def _save_meta(self):
+        tmp = f"{self.folder}/meta.json.tmp{os.getpid()}"
+        with open(tmp, "w") as f:
+            json.dump(self.meta, f, indent=1)
+        os.replace(tmp, f"{self.folder}/meta.json")
+
+    def _truncate(self):
+        """drop the rows of an interrupted append"""
+        for key, size in self.meta["layer"].items():
+            filein = f"{self.folder}/{key}.bin"
+            if os.path.isfile(filein) and os.path.getsize(filein) > self._num_row * size * 4:
+                os.truncate(filein, self._num_row * size * 4)
+        filein = f"{self.folder}/location.bin"
+        if os.path.isfile(filein) and os.path.getsize(filein) > self._num_location * 8:
+            os.truncate(filein, self._num_location * 8)
+        if os.path.isfile(f"{self.folder}/index.jsonl"):
+            with open(f"{self.folder}/index.jsonl", "rb+") as f:
+                data = f.read()
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return str(name) in self.index
+
+    def keys(self):
+        """layer keys (layer{i}[_{stat}])"""
+        return list(self.meta["layer"])
+
+    def names(self):
+        """slides in order of append"""
+        return list(self.index)
+
+    def append(self, name:str="", dict_out=dict(), locations=None):
+        """
+        append the features of one slide
+        Parameters
+        ----------
+        name: slide name (unique)
+        dict_out: {key: np.array [n_row, size]}, same keys and row counts for all slides
+        locations: LocationTable or int32 [n_patch, (x, y)], optional
+        """
+        if self.mode != "a":
+            raise ValueError("store opened read only")
+        name = str(name)
+        if name in self.index:
+            raise ValueError(f"slide already in the store: {name}")
+        if not self.meta["layer"]:
+            self.meta["layer"] = {key: int(out.shape[1]) for key, out in dict_out.items()}
+            self._save_meta()
+        if set(dict_out) != set(self.meta["layer"]):
+            raise ValueError(f"keys {sorted(dict_out)} differ from the ones of the store {self.keys()}")
+        num_row = {len(out) for out in dict_out.values()}
+        if len(num_row) != 1:
+            raise ValueError(f"row counts of the keys differ: {num_row}")
+        num_row = num_row.pop()
+        for key, out in dict_out.items():
+            out = np.ascontiguousarray(out, dtype=np.float32)
+            if out.ndim != 2 or out.shape[1] != self.meta["layer"][key]:
+                raise ValueError(f"{key}: shape {out.shape}, size {self.meta['layer'][key]} expected")
+            _fsync_append(f"{self.folder}/{key}.bin", out.tobytes())
+        entry = {"name": name, "row": [self._num_row, self._num_row + num_row], "location": None}
+        if locations is not None:
+            xy = np.ascontiguousarray(np.asarray(locations, dtype=np.int32).reshape(-1, 2))
+            _fsync_append(f"{self.folder}/location.bin", xy.tobytes())
+            entry["location"] = [self._num_location, self._num_location + len(xy)]
+            self._num_location += len(xy)
+        # the slide is in the store once its index line is written
+        _fsync_append(f"{self.folder}/index.jsonl", (json.dumps(entry) + "\n").encode())
+        self.index[name] = entry
+        self._num_row += num_row
+
+    def _map(self, key:str="", num_row:int=0):
+        """memory map of {key}.bin, remapped when it grew"""
+        res = self._memmap.get(key)
+        if res is None or len(res) < num_row:
+            if num_row == 0:
+                return np.zeros((0, self.meta["layer"][key]), dtype=np.float32)
+            res = np.memmap(f"{self.folder}/{key}.bin", dtype=np.float32, mode="r", shape=(self._num_row, self.meta["layer"][key]))
+            self._memmap[key] = res
+        return res
+
+    def get(self, name:str="", key:str=""):
+        """features of a slide, np.memmap [n_row, size] (view of the mapped array, no copy)"""
+        if key not in self.meta["layer"]:
+            raise KeyError(f"{key} not in the store, keys: {self.keys()}")
+        start, stop = self.index[str(name)]["row"]
+        return self._map(key, stop)[start:stop]
+
+    def get_locations(self, name:str=""):
+        """LocationTable of a slide (memory-mapped), None if not saved"""
+        entry = self.index[str(name)]
+        if entry["location"] is None:
+            return None
+        start, stop = entry["location"]
+        xy = np.memmap(f"{self.folder}/location.bin", dtype=np.int32, mode="r", shape=(self._num_location, 2))
+        return LocationTable(xy[start:stop])
+
+    def get_array(self, lst_name=list(), key:str=""):
+        """np.array [len(lst_name), n_row, size] of slides with the same row count (e.g. pooled features)"""
+        return np.stack([self.get(name, key) for name in lst_name])
+
+def open_store(folder:str="", model=None, preprocessing=None):
+    """FeatureStore opened for append (created if missing)"""
+    return FeatureStore(folder, mode="a", model=model, preprocessing=preprocessing)
+
+def migrate_folder(folder:str="", prefix:str="", fileout:str=None, model=None, preprocessing=None, remove:bool=False):
+    """
+    convert the files {folder}/{prefix}{slide}_{key}.npy (and {prefix}{slide}_location.npy / .pickle)
+    of one model to a feature store, slides already in the store are skipped (resumable)
+    slide names in the store: {prefix}{slide}, as the former file names
+    remove: delete the converted .npy files and the location files
+    """
+    fileout = fileout if fileout else store_path(folder, prefix)
+    pattern = re.compile(rf"^{re.escape(prefix)}(.+?)_(layer\d+(?:_[a-z]+)?)\.npy$")
+    dict_file = dict() # slide: {key: file}
+    for filename in sorted(os.listdir(folder)):
+        match = pattern.match(filename)
+        if match:
+            dict_file.setdefault(f"{prefix}{match.group(1)}", dict())[match.group(2)] = f"{folder}/{filename}"
+    store = open_store(fileout, model=model, preprocessing=preprocessing)
+    def _natural(name):
+        return [int(v) if v.isdigit() else v for v in re.split(r"(\d+)", name)]
+    for name in sorted(dict_file, key=_natural):
+        if name in store:
+            continue
+        filelocation = find_locations(f"{folder}/{name}") # .npy, else the former .pickle
+        locations = LocationTable.load(filelocation) if os.path.isfile(filelocation) else None
+        store.append(name, {key: np.load(filein, mmap_mode="r") for key, filein in dict_file[name].items()}, locations=locations)
+        if remove:
+            for filein in list(dict_file[name].values()) + [f"{folder}/{name}_location{ext}" for ext in (".npy", ".pickle")]:
+                if os.path.isfile(filein):
+                    os.remove(filein)
+    return fileout
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='convert folders of per-slide .npy features to feature stores')
+    parser.add_argument('folder', type=str)
+    parser.add_argument('--lst_prefix', type=str, nargs='+', default=['pretrained_']) # one store per prefix (model), e.g. fold0_ fold1_
+    parser.add_argument('--model_name', type=str, default='')
+    parser.add_argument('--ssl_name', type=str, default='')
+    parser.add_argument('--lst_model_path', type=str, nargs='+', default=None) # checkpoint of each prefix (hash)
+    parser.add_argument('--patch_size', type=int, default=None)
+    parser.add_argument('--num_pool_patch', type=int, default=None)
+    parser.add_argument('--remove', action='store_true') # delete the converted .npy and location files
+    args = parser.parse_args()
+    for i, prefix in enumerate(args.lst_prefix):
+        model_path = args.lst_model_path[i] if args.lst_model_path else ""
+        fileout = migrate_folder(
+            args.folder, prefix,
+            model=model_meta(args.model_name, args.ssl_name, model_path, pretrained=prefix.startswith("pretrained")),
+            preprocessing={"patch_size": args.patch_size, "num_pool_patch": args.num_pool_patch, "migrated_from": args.folder},
+            remove=args.remove,
+            )
+        print(f"{prefix}: {len(FeatureStore(fileout))} slides -> {fileout}")
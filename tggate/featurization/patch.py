@@ -27,6 +27,7 @@ sys.path.append(f"{PROJECT_PATH}/src/SelfSupervisedLearningPathology")
 import settings
 import sslmodel
 import tggate.utils as utils
+from tggate.aggregator import RunningAggregator
 
 # argument
 parser = argparse.ArgumentParser(description='CLI inference')
@@ -34,6 +35,8 @@ parser.add_argument('--note', type=str, help='feature')
 parser.add_argument('--seed', type=int, default=24771)
 parser.add_argument('--batch_size', type=int, default=128)
 parser.add_argument('--num_pool_patch', type=int, default=256)
+parser.add_argument('--lst_stat', type=str, nargs='+', default=['max']) # pooling statistics: max, min, mean, std, topk
+parser.add_argument('--topk', type=int, default=10) # k of the topk statistic
 parser.add_argument('--model_name', type=str, default='ResNet18') # architecture name
 parser.add_argument('--ssl_name', type=str, default='barlowtwins') # ssl architecture name
 parser.add_argument('--model_path', type=str, default='')
@@ -77,19 +80,13 @@ class Dataset_Patch(torch.utils.data.Dataset):
                 out_data = t(out_data)
         return out_data
 
-def prepare_dataset_patch(filein:str="", batch_size:int=32, ):
+def prepare_dataset_patch(filein:str="", batch_size:int=32, DEVICE="cpu", ):
     """
     data preparation
-    
+    uint8 patches are loaded, CenterCrop((224,224)) + ToTensor + normalize run once per batch on DEVICE
+    returns data_loader, batch_transform (see Featurize.featurize)
     """
-    # normalization
-    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                        std=[0.229, 0.224, 0.225])
-    data_transform = transforms.Compose([
-        transforms.CenterCrop((224,224)),
-        transforms.ToTensor(),
-        normalize
-    ])
+    data_transform, batch_transform = sslmodel.data_handler.prepare_uint8_transform(crop=(224,224), DEVICE=DEVICE)
     # data
     dataset = Dataset_Patch(
         filein=filein,
@@ -99,23 +96,28 @@ def prepare_dataset_patch(filein:str="", batch_size:int=32, ):
     data_loader = sslmodel.data_handler.prep_dataloader(
         dataset, batch_size, 
         shuffle=False,
-        drop_last=False)
-    return data_loader
+        drop_last=False,
+        collate_fn=sslmodel.data_handler.collate_uint8)
+    return data_loader, batch_transform
 
 def featurize_layer(
     model, model_name="", ssl_name="",
     batch_size=128, lst_filein=list(), 
     folder_name="", result_name="", 
-    DEVICE="cpu", num_pool_patch=200,):
-    """main module"""
+    DEVICE="cpu", num_pool_patch=200, lst_stat=["max"], k=10,):
+    """main module, lst_stat: statistics of the pooling computed in one pass (tggate.aggregator)"""
     extract_class = utils.DICT_MODEL[model_name][2](DEVICE=DEVICE)
     if not os.path.exists(folder_name):
         os.makedirs(folder_name)
     # featurize
     for filein in lst_filein:
-        data_loader=prepare_dataset_patch(filein=filein, batch_size=batch_size)
-        extract_class.featurize(model, data_loader)
-        extract_class.pooling(num_pool_patch=num_pool_patch)
+        data_loader, batch_transform=prepare_dataset_patch(filein=filein, batch_size=batch_size, DEVICE=DEVICE)
+        aggregator = RunningAggregator(
+            num_patch=len(data_loader.dataset), lst_size=extract_class.lst_size,
+            num_pool_patch=num_pool_patch, lst_stat=lst_stat, k=k,
+            )
+        extract_class.featurize(model, data_loader, batch_transform=batch_transform, aggregator=aggregator)
+        extract_class.pooling(aggregator=aggregator)
     extract_class.save_outpool(folder=folder_name, name=result_name)
 
 def main():
@@ -154,7 +156,7 @@ def main():
         model, model_name=args.model_name,
         batch_size=args.batch_size, lst_filein=lst_filein,
         folder_name=args.folder_name, result_name=args.result_name,
-        DEVICE=DEVICE, num_pool_patch=args.num_pool_patch)
+        DEVICE=DEVICE, num_pool_patch=args.num_pool_patch, lst_stat=args.lst_stat, k=args.topk)
     print('elapsed_time: {:.2f} min'.format((time.time() - start)/60))        
 
 if __name__ == '__main__':
@@ -5,6 +5,7 @@
 @author: Katsuhisa MORITA
 """
 import argparse
+import functools
 import time
 import os
 import re
@@ -22,12 +23,19 @@ import torch.nn.functional as F
 import torchvision
 import torchvision.transforms as transforms
 from PIL import Image
-import skimage
+from openslide import OpenSlide
 
 sys.path.append("/workspace/pathology/src/SelfSupervisedLearningPathology")
 import sslmodel
 import sslmodel.sslutils as sslutils
 import tggate.utils as utils
+import tggate.featurestore as featurestore
+import tggate.journal as journal_engine
+from tggate.aggregator import RunningAggregator
+import slide.cache as mask_cache
+from slide.region import read_region_scaled
+from slide.handle import LazySlide
+from slide.tiff import TiffReader
 
 # argument
 parser = argparse.ArgumentParser(description='CLI inference')
@@ -35,15 +43,24 @@ parser.add_argument('--note', type=str, help='feature')
 parser.add_argument('--seed', type=int, default=24771)
 parser.add_argument('--batch_size', type=int, default=128)
 parser.add_argument('--num_pool_patch', type=int, default=None)
+parser.add_argument('--lst_stat', type=str, nargs='+', default=['max']) # pooling statistics: max, min, mean, std, topk
+parser.add_argument('--topk', type=int, default=10) # k of the topk statistic
 parser.add_argument('--num_patch', type=int, default=None)
 parser.add_argument('--patch_size', type=int, default=224)
+parser.add_argument('--pyramid', action='store_true') # read from the pyramid level matching the model input
+parser.add_argument('--num_workers', type=int, default=4) # workers of the multi-slide stream
+parser.add_argument('--cache_size', type=int, default=None) # tile cache (bytes) of each worker handle (OpenSlide with --pyramid, TiffReader otherwise)
 parser.add_argument('--model_name', type=str, default='ResNet18') # architecture name
 parser.add_argument('--ssl_name', type=str, default='barlowtwins') # ssl architecture name
 parser.add_argument('--model_path', type=str, default='')
 parser.add_argument('--dir_result', type=str, default='')
 parser.add_argument('--result_name', type=str, default='foldx_')
 parser.add_argument('--pretrained', action='store_true')
+parser.add_argument('--spec', type=str, nargs=4, action='append', default=None) # model_name ssl_name model_path result_name, repeated: all models on the same decoded patches (ssl_name pretrained: pretrained weights)
 parser.add_argument('--resume', action='store_true')
+parser.add_argument('--journal', action='store_true') # journal {dir_result}/{result names}.journal of the run, continued mid-slide with --resume
+parser.add_argument('--journal_interval', type=int, default=100) # batches between flushes of the slides in progress to the journal (resume mid-slide)
+parser.add_argument('--store', action='store_true') # write to the feature store {dir_result}/{result_name}.fstore instead of .npy files
 parser.add_argument('--tggate_all', action='store_true')
 parser.add_argument('--eisai', action='store_true')
 parser.add_argument('--shionogi', action='store_true')
@@ -61,6 +78,8 @@ class DatasetWSI(torch.utils.data.Dataset):
         transform=None,
         patch_size=224,
         num_patch=None, random_state=24771,
+        pyramid=False,
+        cache_size=None,
         ):
         # set transform
         if type(transform)!=list:
@@ -68,83 +87,177 @@ class DatasetWSI(torch.utils.data.Dataset):
         else:
             self._transform = transform
         # load data
-        self.wsi = skimage.io.imread(filein)
-        self.lst_location=pd.read_pickle(filemask)
+        self.pyramid = pyramid
+        if pyramid:
+            self.slide = LazySlide(filein, cache_size=cache_size) # opened in each worker
+        else:
+            # tiles / strips read on demand, the slide is not loaded
+            self.image = TiffReader(filein, cache_size=cache_size) if cache_size else TiffReader(filein)
+        self.lst_location=mask_cache.load_locations(filemask) # LocationTable (x, y)
         if num_patch:
             random.seed(random_state)
-            self.lst_location=random.sample(self.lst_location, num_patch)
+            self.lst_location=self.lst_location[random.sample(range(len(self.lst_location)), num_patch)]
         self.datanum = len(self.lst_location)
         self.patch_size=patch_size
 
+    @property
+    def wsi(self):
+        return self.slide.image if self.pyramid else self.image
+
+    def close(self):
+        if self.pyramid:
+            self.slide.close()
+        else:
+            self.image.close()
+
     def __len__(self):
         return self.datanum
 
     def __getitem__(self,idx):
-        location=self.lst_location[idx]
-        out_data=self.wsi[location[0]:location[0]+self.patch_size,location[1]:location[1]+self.patch_size,:]
-        out_data = Image.fromarray(out_data).convert("RGB")
+        x, y=self.lst_location[idx]
+        if self.pyramid:
+            out_data = read_region_scaled(
+                self.wsi, location=(x, y), size=(self.patch_size, self.patch_size), out_size=(224, 224),
+                )
+        else:
+            out_data=self.wsi[y:y+self.patch_size,x:x+self.patch_size,:]
+            out_data = Image.fromarray(out_data).convert("RGB")
         if self._transform:
             for t in self._transform:
                 out_data = t(out_data)
         return out_data
 
-def prepare_dataset(filein:str="", filemask:str="", patch_size:int=224, batch_size:int=32, num_patch=None,):
+def prepare_dataset(lst_filein=list(), lst_filemask=list(), patch_size:int=224, batch_size:int=32, num_patch=None, pyramid=False, num_workers:int=4, cache_size=None, lst_skip=None, DEVICE="cpu",):
     """
     data preparation
-    
+    one stream over all slides (one DataLoader, workers read different slides)
+    workers resize to uint8 224x224 patches, ToTensor + normalize run once per batch on DEVICE
+    returns data_loader, batch_transform (see Featurize.featurize_stream)
     """
-    # normalization
-    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                        std=[0.229, 0.224, 0.225])
-    data_transform = transforms.Compose([
-        transforms.Resize((224,224), antialias=True),
-        transforms.ToTensor(),
-        normalize
-    ])
+    data_transform, batch_transform = sslmodel.data_handler.prepare_uint8_transform(resize=(224,224), DEVICE=DEVICE)
     # data
-    dataset = DatasetWSI(
+    lst_kwargs = [dict(
         filein=filein,
         filemask=filemask,
         transform=data_transform,
         num_patch=num_patch,
         patch_size=patch_size,
+        pyramid=pyramid,
+        cache_size=cache_size,
+        ) for filein, filemask in zip(lst_filein, lst_filemask)]
+    dataset = sslmodel.data_handler.MultiSlideDataset(
+        dataset_class=DatasetWSI, lst_kwargs=lst_kwargs, batch_size=batch_size, lst_skip=lst_skip,
         )
     # to loader
-    data_loader = sslmodel.data_handler.prep_dataloader(
-        dataset, batch_size=batch_size, 
-        shuffle=False,
-        drop_last=False)
-    return data_loader
+    data_loader = sslmodel.data_handler.prep_stream_dataloader(dataset, num_workers=num_workers)
+    return data_loader, batch_transform
+
+def list_done(lst_filename=list(), dir_result="", lst_spec=list(), journal=None):
+    """
+    slides featurized by all the models of lst_spec (resume)
+    slides of the journal: all outputs recorded when they finished are complete,
+    others (former runs): in the feature store, or all the layer files are complete
+    """
+    lst_res=[]
+    for spec in lst_spec:
+        lst_name=[f"{spec['result_name']}{i}" for i in lst_filename]
+        if spec["store"]:
+            set_done=set(featurestore.FeatureStore(spec["store"]).names()) if os.path.isdir(spec["store"]) else set()
+            lst_res.append([i in set_done for i in lst_name])
+        else:
+            num_layer=len(utils.DICT_MODEL[spec["model_name"]][2].lst_size)
+            lst_res.append([
+                all([journal_engine.npy_complete(f"{dir_result}/{i}_layer{layer+1}.npy") for layer in range(num_layer)])
+                for i in lst_name
+                ])
+    lst_res=[all(v) for v in zip(*lst_res)]
+    if journal and os.path.isdir(journal):
+        journal=journal_engine.FeaturizeJournal(journal)
+        lst_res=[journal.finished(i) if str(i) in journal.done else v for i, v in zip(lst_filename, lst_res)]
+    return lst_res
 
 def featurize_layer(
     model_name="", ssl_name="", model_path="", pretrained=False,
     lst_filein=list(), lst_filename=list(), lst_filemask=list(), dir_result="",
-    num_pool_patch=None, num_patch=None,
-    batch_size=128, patch_size=224,
-    DEVICE="cpu", ):
-    """featurize module"""
-    # load model
-    model=utils.prepare_model_eval(
-        model_name=model_name, 
-        ssl_name=ssl_name,
-        model_path=model_path,
-        pretrained=pretrained, 
-        DEVICE=DEVICE
-    )
-    extract_class = utils.DICT_MODEL[model_name][2](DEVICE=DEVICE)
+    num_pool_patch=None, num_patch=None, lst_stat=["max"], k=10,
+    batch_size=128, patch_size=224, pyramid=False, num_workers=4, cache_size=None,
+    store=None, lst_spec=None, journal=None, journal_interval:int=100, resume:bool=False, DEVICE="cpu", ):
+    """
+    featurize module
+    store: path of a feature store (tggate.featurestore) written instead of .npy files
+    lst_spec: list of dict(model_name, ssl_name, model_path, pretrained, result_name, store),
+        every model runs on each decoded batch (slides read and normalized once), outputs {result_name}{filename},
+        the model of model_name, ssl_name, model_path, pretrained (and store) if None
+    journal: path of a featurization journal (tggate.journal): slides in progress are flushed every journal_interval batches
+        and continued from there on restart (resume, else a journal of a former run raises FileExistsError),
+        finished slides are recorded with their outputs
+    """
+    if lst_spec is None:
+        lst_spec=[dict(model_name=model_name, ssl_name=ssl_name, model_path=model_path, pretrained=pretrained, result_name="", store=store)]
     # result dir
     if not os.path.exists(dir_result):
         os.makedirs(dir_result)
+    preprocessing={"reader": "masked", "patch_size": patch_size, "pyramid": pyramid, "num_patch": num_patch, "num_pool_patch": num_pool_patch, "lst_stat": lst_stat if num_pool_patch else None, "k": k if num_pool_patch else None}
+    pbar = tqdm(total=len(lst_filein))
+    dict_output=dict() # slide_id: outputs of the models (journal)
+    def prepare_callback(extract_class, result_name="", store=None, progress=False, last=False):
+        def save_slide(slide_id, lst_location):
+            if progress:
+                pbar.update(1) # slides complete for all models in the same batch
+            filename = f"{result_name}{lst_filename[slide_id]}"
+            lst_output = dict_output.setdefault(slide_id, [])
+            if store:
+                lst_output.append({"store": store.folder, "name": filename})
+            if store and filename in store:
+                pass # featurized before (resume)
+            elif num_pool_patch:
+                extract_class.pooling(aggregator=extract_class.aggregator)
+                if store:
+                    extract_class.store_outpool(store, name=filename, locations=lst_location)
+                else:
+                    lst_output += [{"file": f, "shape": v} for f, v in extract_class.save_outpool(folder=dir_result, name=filename, reset=True)]
+            elif store:
+                extract_class.store_outall(store, name=filename, locations=lst_location)
+            else:
+                lst_output += [{"file": f, "shape": v} for f, v in extract_class.save_outall(folder=dir_result, name=filename)]
+            if last and journal is not None:
+                journal.add_done(lst_filename[slide_id], dict_output.pop(slide_id))
+        return save_slide
+    if journal:
+        journal = journal_engine.FeaturizeJournal(
+            journal, lst_name=lst_filename, interval=journal_interval, resume=resume,
+            meta={"lst_spec": [{k: v for k, v in spec.items() if k != "store"} for spec in lst_spec], "preprocessing": preprocessing},
+            )
+    # load models
+    lst_model, lst_extract, lst_callback, lst_aggregator = [], [], [], []
+    for spec in lst_spec:
+        lst_model.append(utils.prepare_model_eval(
+            model_name=spec["model_name"],
+            ssl_name=spec["ssl_name"],
+            model_path=spec["model_path"],
+            pretrained=spec["pretrained"],
+            DEVICE=DEVICE
+        ))
+        extract_class = utils.DICT_MODEL[spec["model_name"]][2](DEVICE=DEVICE)
+        spec_store = featurestore.open_store(
+            spec["store"], model=featurestore.model_meta(spec["model_name"], spec["ssl_name"], spec["model_path"], spec["pretrained"]),
+            preprocessing=preprocessing,
+            ) if spec.get("store") else None
+        lst_extract.append(extract_class)
+        lst_callback.append(prepare_callback(extract_class, result_name=spec.get("result_name", ""), store=spec_store, progress=not lst_callback, last=len(lst_callback)==len(lst_spec)-1))
+        # running pooling statistics of each slide instead of its outputs
+        lst_aggregator.append(functools.partial(
+            RunningAggregator, lst_size=extract_class.lst_size,
+            num_pool_patch=num_pool_patch, lst_stat=lst_stat, k=k,
+            ) if num_pool_patch else None)
     # featurize
-    for filein, filename, filemask in tqdm(zip(lst_filein, lst_filename, lst_filemask)):
-        data_loader=prepare_dataset(filein=filein, filemask=filemask, batch_size=batch_size, patch_size=patch_size, num_patch=num_patch)
-        extract_class.featurize(model, data_loader)
-        if num_pool_patch:
-            extract_class.pooling(num_pool_patch=num_pool_patch)
-            extract_class.save_outpool(folder=dir_result, name=filename)
-        else:
-            extract_class.save_outall(folder=dir_result, name=filename)
-        
+    data_loader, batch_transform=prepare_dataset(lst_filein=lst_filein, lst_filemask=lst_filemask, batch_size=batch_size, patch_size=patch_size, num_patch=num_patch, pyramid=pyramid, num_workers=num_workers, cache_size=cache_size, lst_skip=journal.lst_skip() if journal else None, DEVICE=DEVICE)
+    utils.featurize_stream_multi(
+        lst_model, lst_extract, data_loader,
+        lst_callback=lst_callback, batch_transform=batch_transform, lst_aggregator=lst_aggregator, journal=journal,
+        )
+    pbar.close()
+
 def main():
     # settings
     start = time.time() # for time stamp
@@ -154,12 +267,19 @@ def main():
     if args.tggate_all: 
         df_info=pd.read_csv(f"/workspace/pathology/data/tggate_info_ext.csv")
         lst_filein=df_info["DIR_temp"].tolist()
-        lst_filename=[f"{args.result_name}{i}" for i in list(range(df_info.shape[0]))]
-        lst_filemask=[f"/workspace/HDD3/TGGATEs/mask/{args.patch_size}/{i}_location.pickle" for i in list(range(df_info.shape[0]))]
+        lst_filename=list(range(df_info.shape[0]))
+        lst_filemask=[mask_cache.find_locations(f"/workspace/HDD3/TGGATEs/mask/{args.patch_size}/{i}") for i in list(range(df_info.shape[0]))]
             
+    # models: --spec (several models on the same decoded patches) or --model_name, --ssl_name, --model_path
+    if args.spec:
+        lst_spec=[dict(model_name=v[0], ssl_name=v[1], model_path=v[2], pretrained=v[1]=="pretrained", result_name=v[3]) for v in args.spec]
+    else:
+        lst_spec=[dict(model_name=args.model_name, ssl_name=args.ssl_name, model_path=args.model_path, pretrained=args.pretrained, result_name=args.result_name)]
+    for spec in lst_spec:
+        spec["store"]=featurestore.store_path(args.dir_result, spec["result_name"]) if args.store else None
+    journal=journal_engine.journal_path(args.dir_result, [spec["result_name"] for spec in lst_spec]) if args.journal else None
     if args.resume:
-        lst_fileout=[f"{args.dir_result}/{i}_layer5.npy" for i in lst_filename]
-        lst_tf=[not os.path.isfile(i) for i in lst_fileout]
+        lst_tf=[not v for v in list_done(lst_filename, args.dir_result, lst_spec, journal=journal)]
         lst_filein=[i for i, v in zip(lst_filein, lst_tf) if v]
         lst_filename=[i for i, v in zip(lst_filename, lst_tf) if v]
         lst_filemask=[i for i, v in zip(lst_filemask, lst_tf) if v]
@@ -167,12 +287,13 @@ def main():
 
     # 2. inference & save results
     featurize_layer(
-        model_name=args.model_name, ssl_name=args.ssl_name, 
-        model_path=args.model_path, pretrained=args.pretrained,
+        lst_spec=lst_spec,
         lst_filein=lst_filein, lst_filename=lst_filename, lst_filemask=lst_filemask,
         dir_result=args.dir_result,
-        num_pool_patch=args.num_pool_patch, num_patch=args.num_patch,
+        num_pool_patch=args.num_pool_patch, num_patch=args.num_patch, lst_stat=args.lst_stat, k=args.topk,
         batch_size=args.batch_size, patch_size=args.patch_size,
+        pyramid=args.pyramid, num_workers=args.num_workers, cache_size=args.cache_size,
+        journal=journal, journal_interval=args.journal_interval, resume=args.resume,
         DEVICE=DEVICE)
     print('elapsed_time: {:.2f} min'.format((time.time() - start)/60))        
 
@@ -22,12 +22,13 @@ import torch.nn.functional as F
 import torchvision
 import torchvision.transforms as transforms
 from PIL import Image
-import skimage
 
 sys.path.append("/work/gd43/a97001/src/SelfSupervisedLearningPathology")
 import sslmodel
 import sslmodel.sslutils as sslutils
 import tggate.utils as utils
+import slide.cache as mask_cache
+from slide.tiff import TiffReader
 
 # argument
 parser = argparse.ArgumentParser(description='CLI inference')
@@ -68,11 +69,11 @@ class DatasetWSI(torch.utils.data.Dataset):
         else:
             self._transform = transform
         # load data
-        self.wsi = skimage.io.imread(filein)
-        self.lst_location=pd.read_pickle(filemask)
+        self.wsi = TiffReader(filein) # tiles / strips read on demand, the slide is not loaded
+        self.lst_location=mask_cache.load_locations(filemask) # LocationTable (x, y)
         if num_patch:
             random.seed(random_state)
-            self.lst_location=random.sample(self.lst_location, num_patch)
+            self.lst_location=self.lst_location[random.sample(range(len(self.lst_location)), num_patch)]
         self.datanum = len(self.lst_location)
         self.patch_size=patch_size
 
@@ -80,27 +81,21 @@ class DatasetWSI(torch.utils.data.Dataset):
         return self.datanum
 
     def __getitem__(self,idx):
-        location=self.lst_location[idx]
-        out_data=self.wsi[location[0]:location[0]+self.patch_size,location[1]:location[1]+self.patch_size,:]
+        x, y=self.lst_location[idx]
+        out_data=self.wsi[y:y+self.patch_size,x:x+self.patch_size,:]
         out_data = Image.fromarray(out_data).convert("RGB")
         if self._transform:
             for t in self._transform:
                 out_data = t(out_data)
         return out_data
 
-def prepare_dataset(filein:str="", filemask:str="", patch_size:int=224, batch_size:int=32, num_patch=None,):
+def prepare_dataset(filein:str="", filemask:str="", patch_size:int=224, batch_size:int=32, num_patch=None, DEVICE="cpu",):
     """
     data preparation
-    
+    workers resize to uint8 224x224 patches, ToTensor + normalize run once per batch on DEVICE
+    returns data_loader, batch_transform (see Featurize.featurize)
     """
-    # normalization
-    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                        std=[0.229, 0.224, 0.225])
-    data_transform = transforms.Compose([
-        transforms.Resize((224,224), antialias=True),
-        transforms.ToTensor(),
-        normalize
-    ])
+    data_transform, batch_transform = sslmodel.data_handler.prepare_uint8_transform(resize=(224,224), DEVICE=DEVICE)
     # data
     dataset = DatasetWSI(
         filein=filein,
@@ -113,8 +108,9 @@ def prepare_dataset(filein:str="", filemask:str="", patch_size:int=224, batch_si
     data_loader = sslmodel.data_handler.prep_dataloader(
         dataset, batch_size=batch_size, 
         shuffle=False,
-        drop_last=False)
-    return data_loader
+        drop_last=False,
+        collate_fn=sslmodel.data_handler.collate_uint8)
+    return data_loader, batch_transform
 
 def featurize_layer(
     model_name="", ssl_name="", model_path="", pretrained=False,
@@ -137,8 +133,8 @@ def featurize_layer(
         os.makedirs(dir_result)
     # featurize
     for filein, filename, filemask in tqdm(zip(lst_filein, lst_filename, lst_filemask)):
-        data_loader=prepare_dataset(filein=filein, filemask=filemask, batch_size=batch_size, patch_size=patch_size, num_patch=num_patch)
-        extract_class.featurize(model, data_loader)
+        data_loader, batch_transform=prepare_dataset(filein=filein, filemask=filemask, batch_size=batch_size, patch_size=patch_size, num_patch=num_patch, DEVICE=DEVICE)
+        extract_class.featurize(model, data_loader, batch_transform=batch_transform)
         if num_pool_patch:
             extract_class.pooling(num_pool_patch=num_pool_patch)
             extract_class.save_outpool(folder=dir_result, name=filename)
@@ -155,7 +151,7 @@ def main():
         df_info=pd.read_csv("/work/gd43/a97001/experiments_liver/tggate_info_ext.csv")
         lst_filein=df_info["DIR_wisteria"].tolist()
         lst_filename=[f"{args.result_name}{i}" for i in list(range(df_info.shape[0]))]
-        lst_filemask=[f"/work/gd43/share/tggates/liver/mask/{args.patch_size}/{i}_location.pickle" for i in list(range(df_info.shape[0]))]
+        lst_filemask=[mask_cache.find_locations(f"/work/gd43/share/tggates/liver/mask/{args.patch_size}/{i}") for i in list(range(df_info.shape[0]))]
             
     if args.resume:
         lst_fileout=[f"{args.dir_result}/{i}_layer5.npy" for i in lst_filename]
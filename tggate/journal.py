@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+# featurization journal
+resume of long featurization jobs at the batch level:
+the patches received since the last flush by the slides in progress (index, location, outputs of each model,
+or the rows of the running statistics of the groups they updated) are appended every interval batches,
+finished slides are recorded with their outputs, verified on resume
+
+layout: {name}.journal/meta.json (models and preprocessing of the run),
+    done.jsonl (one line per finished slide: outputs with their shapes),
+    {slide}.partial{k}.npz (k-th flush of a slide in progress, temporary file renamed, removed when the slide is done)
+
+@author: Katsuhisa MORITA
+"""
+import os
+import json
+
+import numpy as np
+
+from tggate.featurestore import FeatureStore
+
+JOURNAL_SUFFIX = ".journal"
+
+def journal_path(folder:str="", lst_result_name=list()):
+    """{folder}/{result names}.journal of a run (e.g. fold0_, fold1_ -> fold0+fold1.journal)"""
+    return f"{folder}/{'+'.join([v.rstrip('_') for v in lst_result_name]) or 'features'}{JOURNAL_SUFFIX}"
+
+def to_ranges(mask):
+    """bool mask to the list of [start, stop) ranges of its True values"""
+    edge = np.flatnonzero(np.diff(np.r_[0, np.asarray(mask, dtype=np.int8), 0]))
+    return edge.reshape(-1, 2).tolist()
+
+def npy_complete(filein:str="", shape=None):
+    """the .npy file exists, its data is complete (memory map of the header shape) and of the shape if given"""
+    try:
+        arr = np.load(filein, mmap_mode="r")
+    except (OSError, ValueError):
+        return False
+    return shape is None or list(arr.shape) == list(shape)
+
+def output_complete(output=dict()):
+    """an output of done.jsonl: {"file", "shape"} (.npy) or {"store", "name"} (tggate.featurestore)"""
+    if "store" in output:
+        try:
+            return output["name"] in FeatureStore(output["store"])
+        except (OSError, ValueError):
+            return False
+    return npy_complete(output["file"], output["shape"])
+
+class FeaturizeJournal:
+    """
+    journal of a featurization run (tggate.utils.featurize_stream_multi)
+    Parameters
+    ----------
+    folder: path of the {name}.journal folder (created if missing)
+    lst_name: slide names of the stream (slide_id: index), for the partial files
+    meta: dict, models / preprocessing of the run, checked against the one of an existing journal
+    interval: int, batches between two flushes of the slides in progress
+    resume: bool, continue the journal, else a journal holding finished slides or slides in progress raises FileExistsError
+    """
+    def __init__(self, folder:str="", lst_name=list(), meta=None, interval:int=100, resume:bool=True):
+        self.folder = folder
+        self.lst_name = [str(v) for v in lst_name]
+        self.interval = interval
+        self._num_batch = 0
+        self._flushed = dict() # name: bool mask of the patches in the partial files
+        self._num_partial = dict() # name: number of partial files
+        os.makedirs(folder, exist_ok=True)
+        if not resume:
+            lst_file = [v for v in os.listdir(folder) if v == "done.jsonl" or ".partial" in v]
+            if lst_file:
+                raise FileExistsError(f"journal of a former run: {folder} ({len(lst_file)} files), resume it or remove it")
+        saved = None
+        if os.path.isfile(f"{folder}/meta.json"):
+            with open(f"{folder}/meta.json") as f:
+                saved = json.load(f)
+        if saved and meta is not None and json.loads(json.dumps(meta)) != saved:
+            raise ValueError(f"the run differs from the one of the journal {folder}: {meta} != {saved}")
+        if not saved and meta is not None:
+            tmp = f"{folder}/meta.json.tmp{os.getpid()}"
+            with open(tmp, "w") as f:
+                json.dump(meta, f, indent=1)
+            os.replace(tmp, f"{folder}/meta.json")
+        self.done = dict() # name: list of outputs
+        if os.path.isfile(f"{folder}/done.jsonl"):
+            with open(f"{folder}/done.jsonl") as f:
+                for line in f:
+                    if line.endswith("\n"): # else interrupted line
+                        entry = json.loads(line)
+                        self.done[entry["name"]] = entry["outputs"]
+
+    def finished(self, name:str=""):
+        """the slide is recorded as finished and all its outputs are complete"""
+        name = str(name)
+        return name in self.done and all([output_complete(v) for v in self.done[name]])
+
+    def add_done(self, name:str="", outputs=list()):
+        """record a finished slide (after its outputs are written) and remove its partial files"""
+        name = str(name)
+        with open(f"{self.folder}/done.jsonl", "a") as f:
+            f.write(json.dumps({"name": name, "outputs": outputs}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.done[name] = outputs
+        self._flushed.pop(name, None)
+        self._num_partial.pop(name, None)
+        for filein in self._lst_partial(name):
+            os.remove(filein)
+
+    def _partial(self, name:str="", k:int=0):
+        return f"{self.folder}/{name}.partial{k:05d}.npz"
+
+    def _lst_partial(self, name:str=""):
+        """partial files of a slide in flush order"""
+        prefix = f"{name}.partial"
+        lst_k = sorted([
+            int(v[len(prefix):-4]) for v in os.listdir(self.folder)
+            if v.startswith(prefix) and v.endswith(".npz") and v[len(prefix):-4].isdigit()
+            ])
+        return [self._partial(name, k) for k in lst_k]
+
+    def _load_partial(self, name:str=""):
+        """states of the flushes of a slide, up to the first unreadable file (the next ones are dropped)"""
+        lst_state = []
+        for k, filein in enumerate(self._lst_partial(name)):
+            if filein != self._partial(name, k):
+                break # missing flush
+            try:
+                with np.load(filein) as npz:
+                    lst_state.append({key: npz[key] for key in npz.files})
+            except (OSError, ValueError):
+                break
+        return lst_state
+
+    def _mask(self, lst_state=list()):
+        mask = np.zeros(int(lst_state[0]["num_patch"]), dtype=bool)
+        for state in lst_state:
+            mask[state["idx"]] = True
+        return mask
+
+    def ranges(self, name:str=""):
+        """[start, stop) ranges of the patches of a slide in progress featurized before, [] if none"""
+        lst_state = self._load_partial(str(name))
+        return to_ranges(self._mask(lst_state)) if lst_state else []
+
+    def lst_skip(self):
+        """ranges of each slide of lst_name (sslmodel.data_handler.MultiSlideDataset lst_skip)"""
+        return [self.ranges(name) for name in self.lst_name]
+
+    def restore(self, lst_aggregator=list()):
+        """buffers of the slides in progress of each model (Featurize._stream_update), from the partial files"""
+        lst_buffer = [dict() for aggregator in lst_aggregator]
+        for slide_id, name in enumerate(self.lst_name):
+            lst_state = self._load_partial(name)
+            for filein in self._lst_partial(name)[len(lst_state):]:
+                os.remove(filein) # after an unreadable flush
+            if not lst_state:
+                continue
+            if int(lst_state[0]["num_model"]) != len(lst_aggregator):
+                raise ValueError(f"{self._partial(name)}: {int(lst_state[0]['num_model'])} models, {len(lst_aggregator)} expected")
+            mask = self._mask(lst_state)
+            xy = np.zeros((len(mask), 2), dtype=np.int32)
+            for state in lst_state:
+                xy[state["idx"]] = state["xy"]
+            for j, aggregator in enumerate(lst_aggregator):
+                buffer = {"count": int(mask.sum()), "xy": xy.copy(), "mask": mask.copy(), "agg": None, "out": None}
+                if aggregator is not None:
+                    buffer["agg"] = aggregator(len(mask))
+                    prefix = f"{j}_agg_"
+                    for state in lst_state:
+                        buffer["agg"].load_state_dict({k[len(prefix):]: v for k, v in state.items() if k.startswith(prefix)})
+                else:
+                    num_out = int(lst_state[0][f"{j}_num_out"])
+                    buffer["out"] = [
+                        np.zeros((len(mask), lst_state[0][f"{j}_out{i}"].shape[1]), dtype=lst_state[0][f"{j}_out{i}"].dtype)
+                        for i in range(num_out)
+                        ]
+                    for state in lst_state:
+                        for i in range(num_out):
+                            buffer["out"][i][state["idx"]] = state[f"{j}_out{i}"]
+                lst_buffer[j][slide_id] = buffer
+            self._flushed[name] = mask
+            self._num_partial[name] = len(lst_state)
+        return lst_buffer
+
+    def step(self, lst_buffer=list()):
+        """after each batch: flush every interval batches"""
+        self._num_batch += 1
+        if self.interval and self._num_batch % self.interval == 0:
+            self.flush(lst_buffer)
+
+    def flush(self, lst_buffer=list()):
+        """
+        append the patches received since the last flush by the slides in progress (one new partial file per slide):
+        their index, location and outputs, or the rows of the running statistics of the groups they updated
+        """
+        for slide_id, buffer in lst_buffer[0].items():
+            name = self.lst_name[slide_id]
+            flushed = self._flushed.setdefault(name, np.zeros(len(buffer["mask"]), dtype=bool))
+            idx = np.flatnonzero(buffer["mask"] & ~flushed)
+            if len(idx) == 0:
+                continue
+            state = {"num_model": np.array(len(lst_buffer)), "num_patch": np.array(len(buffer["mask"])), "idx": idx, "xy": buffer["xy"][idx]}
+            for j, dict_buffer in enumerate(lst_buffer):
+                buffer = dict_buffer[slide_id]
+                if buffer["agg"] is not None:
+                    groups = np.unique(idx // buffer["agg"].num_pool_patch)
+                    for key, value in buffer["agg"].state_dict(groups=groups).items():
+                        state[f"{j}_agg_{key}"] = value
+                else:
+                    state[f"{j}_num_out"] = np.array(len(buffer["out"]))
+                    for i, out in enumerate(buffer["out"]):
+                        state[f"{j}_out{i}"] = out[idx]
+            k = self._num_partial.get(name, 0)
+            fileout = self._partial(name, k)
+            tmp = f"{fileout}.tmp{os.getpid()}"
+            with open(tmp, "wb") as f:
+                np.savez(f, **state)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, fileout)
+            flushed[idx] = True
+            self._num_partial[name] = k + 1
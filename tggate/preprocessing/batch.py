@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+# batch builder for ssl (replaces the list + concatenate of notebook/3_batch_for_training.py)
+slides are extracted by a process pool, each worker writes its patches directly
+into a preallocated memory-mapped shard, so that peak RAM is bounded by the in-flight slides
+
+output (same layout as before, read by tggate/train/train_tggate.py):
+    {folder_out}/index.pickle: INDEX of the slides in the shuffled order
+    {folder_out}/fold{fold}_{v}.npy: uint8 [n_slide*num_patch, patch_size, patch_size, 3], n_slide<=slide_per_shard
+    {folder_out}/fold{fold}_{v}_index.npy: structured [n_slide*num_patch] (slide (INDEX), x, y) for each row
+    {folder_out}/fold{fold}_{v}_failed.json: slides whose extraction failed (INDEX, file, error), their rows are
+        left out of the shard and its index (only written if a slide failed)
+
+@author: Katsuhisa MORITA
+"""
+import argparse
+import time
+import os
+import sys
+import json
+import datetime
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from tqdm import tqdm
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from tggate.utils import make_patch
+
+# argument
+parser = argparse.ArgumentParser(description='CLI batch building')
+parser.add_argument('--file_info', type=str, default="/workspace/tggate/data/tggate_info_ext.csv")
+parser.add_argument('--col_filein', type=str, default="DIR")
+parser.add_argument('--folder_out', type=str, default="/workspace/HDD2/TGGATEs/WSI/Liver/batchext")
+parser.add_argument('--patch_size', type=int, default=256)
+parser.add_argument('--num_patch', type=int, default=256)
+parser.add_argument('--slide_per_shard', type=int, default=256)
+parser.add_argument('--lst_fold', type=int, nargs='+', default=[0, 1, 2, 3, 4])
+parser.add_argument('--seed', type=int, default=24771)
+parser.add_argument('--num_workers', type=int, default=4)
+parser.add_argument('--max_inflight', type=int, default=None) # slides in flight, default: 2 * num_workers
+
+INDEX_DTYPE = [("slide", np.int64), ("x", np.int32), ("y", np.int32)]
+
+def shuffle_info(df_info, seed:int=24771):
+    """slide order of the batches (same shuffling as the former notebook)"""
+    df_info = df_info.sample(frac=1, random_state=seed)
+    return df_info.sort_values(by=["FOLD"])
+
+def _extract(task):
+    """extract the patches of one slide into its rows of the shard, return the locations"""
+    fileshard, row, filein, patch_size, num_patch, seed = task
+    res, _, locations = make_patch(
+        filein=filein, patch_size=patch_size, num_patch=num_patch, random_state=seed, return_location=True,
+        )
+    shard = np.load(fileshard, mmap_mode="r+")
+    shard[row:row+num_patch] = res
+    shard.flush()
+    del shard
+    return row, np.asarray(locations)
+
+def build_shard(
+    fileout:str="", lst_filein=list(), lst_index=list(),
+    patch_size:int=256, num_patch:int=256, seed:int=24771,
+    executor=None, max_inflight:int=8,
+    ):
+    """
+    build one shard (and its row index) of the given slides
+    written to temporary files and renamed when complete
+    a slide whose extraction fails is recorded in {shard}_failed.json and its rows are left out, the others are kept
+    """
+    n_row = len(lst_filein) * num_patch
+    tmp = f"{fileout}.tmp{os.getpid()}.npy"
+    shard = np.lib.format.open_memmap(
+        tmp, mode="w+", dtype=np.uint8, shape=(n_row, patch_size, patch_size, 3),
+        )
+    del shard # header and size are written, rows are filled by the workers
+    index = np.zeros(n_row, dtype=INDEX_DTYPE)
+    index["slide"] = np.repeat(np.asarray(lst_index, dtype=np.int64), num_patch)
+    lst_task = [
+        (tmp, i*num_patch, filein, patch_size, num_patch, seed) for i, filein in enumerate(lst_filein)
+        ]
+    pending, dict_slide, lst_failed = set(), dict(), []
+    pbar = tqdm(total=len(lst_task), desc=os.path.basename(fileout))
+    try:
+        for i, task in enumerate(lst_task + [None]):
+            # bounded window of in-flight slides
+            while pending and (task is None or len(pending) >= max_inflight):
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    slide = dict_slide.pop(future)
+                    try:
+                        row, locations = future.result()
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        lst_failed.append({"slide": slide, "index": int(lst_index[slide]), "filein": lst_filein[slide], "error": f"{type(e).__name__}: {e}"})
+                        print(f"failed: {lst_filein[slide]} ({type(e).__name__}: {e})")
+                    else:
+                        index["x"][row:row+num_patch] = locations[:, 0]
+                        index["y"][row:row+num_patch] = locations[:, 1]
+                    pbar.update(1)
+            if task is not None:
+                future = executor.submit(_extract, task)
+                dict_slide[future] = i
+                pending.add(future)
+        if lst_failed:
+            lst_failed = sorted(lst_failed, key=lambda v: v["slide"])
+            valid = np.ones(len(lst_filein), dtype=bool)
+            valid[[v["slide"] for v in lst_failed]] = False
+            index = index[np.repeat(valid, num_patch)]
+            _compact(tmp, valid, num_patch)
+    except BaseException:
+        for future in pending:
+            future.cancel()
+        os.remove(tmp)
+        raise
+    finally:
+        pbar.close()
+    fileindex = fileout.replace(".npy", "_index.npy")
+    np.save(f"{fileindex}.tmp{os.getpid()}.npy", index)
+    os.replace(f"{fileindex}.tmp{os.getpid()}.npy", fileindex)
+    filefailed = fileout.replace(".npy", "_failed.json")
+    if lst_failed:
+        with open(f"{filefailed}.tmp{os.getpid()}", "w") as f:
+            json.dump([{k: v for k, v in record.items() if k != "slide"} for record in lst_failed], f, indent=1)
+        os.replace(f"{filefailed}.tmp{os.getpid()}", filefailed)
+    elif os.path.isfile(filefailed):
+        os.remove(filefailed) # of a former build of the shard
+    os.replace(tmp, fileout)
+
+def _compact(fileshard:str="", valid=None, num_patch:int=256):
+    """keep the rows of the valid slides of a shard (slide order), through a copy renamed to fileshard"""
+    shard = np.load(fileshard, mmap_mode="r")
+    tmp = f"{fileshard}.compact.npy"
+    res = np.lib.format.open_memmap(tmp, mode="w+", dtype=shard.dtype, shape=(int(valid.sum()) * num_patch, *shard.shape[1:]))
+    for pos, i in enumerate(np.flatnonzero(valid)):
+        res[pos*num_patch:(pos+1)*num_patch] = shard[i*num_patch:(i+1)*num_patch]
+    res.flush()
+    del res, shard
+    os.replace(tmp, fileshard)
+
+def build_batches(
+    df_info, folder_out:str="", col_filein:str="DIR",
+    patch_size:int=256, num_patch:int=256, slide_per_shard:int=256,
+    lst_fold=[0, 1, 2, 3, 4], seed:int=24771,
+    num_workers:int=4, max_inflight:int=None,
+    ):
+    """
+    shards fold{fold}_{v}.npy of slide_per_shard slides for each fold,
+    shards already built are skipped
+    """
+    os.makedirs(folder_out, exist_ok=True)
+    df_all = shuffle_info(df_info, seed=seed)
+    pd.to_pickle(df_all["INDEX"].tolist(), f"{folder_out}/index.pickle")
+    max_inflight = max_inflight if max_inflight else 2 * num_workers
+    with ProcessPoolExecutor(num_workers) as executor:
+        for fold in lst_fold:
+            df_temp = df_all[df_all["FOLD"]==fold]
+            lst_filein = df_temp[col_filein].tolist()
+            lst_index = df_temp["INDEX"].tolist()
+            for v, start in enumerate(range(0, len(lst_filein), slide_per_shard)):
+                fileout = f"{folder_out}/fold{fold}_{v}.npy"
+                if os.path.isfile(fileout):
+                    continue
+                build_shard(
+                    fileout=fileout,
+                    lst_filein=lst_filein[start:start+slide_per_shard],
+                    lst_index=lst_index[start:start+slide_per_shard],
+                    patch_size=patch_size, num_patch=num_patch, seed=seed,
+                    executor=executor, max_inflight=max_inflight,
+                )
+
+def main():
+    args = parser.parse_args()
+    start = time.time()
+    df_info = pd.read_csv(args.file_info)
+    build_batches(
+        df_info, folder_out=args.folder_out, col_filein=args.col_filein,
+        patch_size=args.patch_size, num_patch=args.num_patch, slide_per_shard=args.slide_per_shard,
+        lst_fold=args.lst_fold, seed=args.seed,
+        num_workers=args.num_workers, max_inflight=args.max_inflight,
+    )
+    print(f"{datetime.datetime.now()}: elapsed_time: {(time.time() - start)/60:.2f} min")
+
+if __name__ == '__main__':
+    main()
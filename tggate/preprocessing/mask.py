@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+# batch mask extraction (inside patch locations of WSIs)
+slides are processed by a process pool, one slide read for all patch sizes
+one manifest (jsonl) line per output with its key (slide path / size / mtime, output file, mask parameters),
+status, time and patch count, re-running skips a slide only when all its outputs match a done entry
+and exist with the recorded patch count
+
+output: {dir_result}/{patch_size}/{index}_location.npy, int32 [n_patch, (x, y)]
+
+@author: Katsuhisa MORITA
+"""
+import argparse
+import time
+import os
+import sys
+import json
+import datetime
+import multiprocessing
+
+from tqdm import tqdm
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import slide.cache as mask_cache
+from slide import mask as mask_engine
+from tggate.journal import npy_complete
+
+# argument
+parser = argparse.ArgumentParser(description='CLI mask extraction')
+parser.add_argument('--file_info', type=str, default="/workspace/tggate/data/tggate_info_ext.csv")
+parser.add_argument('--col_filein', type=str, default="DIR_temp") # column of slide paths
+parser.add_argument('--dir_result', type=str, default="/workspace/HDD3/TGGATEs/mask")
+parser.add_argument('--manifest', type=str, default=None) # default: {dir_result}/manifest.jsonl
+parser.add_argument('--cache_dir', type=str, default=None) # default: MASK_CACHE_DIR, no mask cache if not set
+parser.add_argument('--lst_patch_size', type=int, nargs='+', default=[224, 448])
+parser.add_argument('--lst_min', type=int, nargs='+', default=[1000, 100]) # slice_min_patch for each patch size
+parser.add_argument('--num_workers', type=int, default=4)
+parser.add_argument('--retry_failed', action='store_true')
+
+def slide_stat(filein:str=""):
+    """identity of the slide file: absolute path, size, modification time (None if missing)"""
+    try:
+        stat = os.stat(filein)
+    except OSError:
+        return {"path": os.path.abspath(filein), "size": None, "mtime_ns": None}
+    return {"path": os.path.abspath(filein), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def mask_params(patch_size:int=224, slice_min_patch:int=1000, base_patch_size:int=None):
+    """parameters of the inside mask of a patch size (as slide.cache.MaskCache.key)"""
+    params = {
+        "version": mask_cache.CACHE_VERSION,
+        "patch_size": int(patch_size),
+        "slice_min_patch": int(slice_min_patch),
+        "adjacent_cells_slice": [list(map(int, adj)) for adj in mask_engine.ADJACENT_CELLS_SLICE],
+        "adjacent_cells_inside": [list(map(int, adj)) for adj in mask_engine.ADJACENT_CELLS_INSIDE],
+    }
+    if base_patch_size is not None and int(base_patch_size) != int(patch_size):
+        # grid derived from the one of the finest patch size of the run
+        params["base_patch_size"] = int(base_patch_size)
+    return params
+
+def manifest_key(slide=dict(), fileout:str="", params=dict()):
+    return json.dumps({"slide": slide, "fileout": os.path.abspath(fileout), "params": params}, sort_keys=True)
+
+def load_manifest(filein:str=""):
+    """{key: last entry} (a truncated last line of an interrupted run and entries of the former format are ignored)"""
+    dict_record = dict()
+    if not os.path.isfile(filein):
+        return dict_record
+    with open(filein) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "key" in record:
+                dict_record[record["key"]] = record
+    return dict_record
+
+def output_done(record=None, fileout:str=""):
+    """the entry is done and its output exists with the recorded patch count"""
+    return record is not None and record["status"] == "done" and npy_complete(fileout) and \
+        len(mask_cache.load_locations(fileout)) == record["n_patch"]
+
+def _init_worker(cache_dir):
+    global _cache
+    _cache = mask_cache.MaskCache(cache_dir) if cache_dir else mask_cache.get_default_cache()
+
+def _process(task):
+    """extract and save the locations of one slide, return the manifest entries (one per output)"""
+    index, filein, lst_fileout, lst_key, lst_patch_size, lst_min = task
+    lst_record = [{"key": key, "index": index, "filein": filein, "fileout": fileout} for key, fileout in zip(lst_key, lst_fileout)]
+    start = time.time()
+    try:
+        dict_res = mask_cache.get_mask_inside_multi(
+            filein, lst_patch_size=lst_patch_size, lst_slice_min_patch=lst_min, cache=_cache,
+        )
+        for patch_size, record in zip(lst_patch_size, lst_record):
+            mask_cache.save_locations(dict_res[patch_size][1], record["fileout"])
+            record["status"] = "done"
+            record["n_patch"] = int(len(dict_res[patch_size][1]))
+    except Exception as e:
+        for record in lst_record:
+            record["status"] = "failed"
+            record["error"] = f"{type(e).__name__}: {e}"
+    for record in lst_record:
+        record["time"] = round(time.time() - start, 3)
+    return lst_record
+
+def main():
+    args = parser.parse_args()
+    if len(args.lst_patch_size) != len(args.lst_min):
+        raise ValueError("lst_patch_size and lst_min must have the same length")
+    for patch_size in args.lst_patch_size:
+        os.makedirs(f"{args.dir_result}/{patch_size}", exist_ok=True)
+    file_manifest = args.manifest if args.manifest else f"{args.dir_result}/manifest.jsonl"
+    dict_record = load_manifest(file_manifest)
+    # tasks
+    lst_filein = pd.read_csv(args.file_info)[args.col_filein].tolist()
+    lst_task = []
+    base_patch_size = min(args.lst_patch_size)
+    lst_params = [mask_params(patch_size, slice_min_patch, base_patch_size) for patch_size, slice_min_patch in zip(args.lst_patch_size, args.lst_min)]
+    for index, filein in enumerate(lst_filein):
+        slide = slide_stat(filein)
+        lst_fileout = [f"{args.dir_result}/{patch_size}/{index}_location.npy" for patch_size in args.lst_patch_size]
+        lst_key = [manifest_key(slide, fileout, params) for fileout, params in zip(lst_fileout, lst_params)]
+        lst_record = [dict_record.get(key) for key in lst_key]
+        if all([output_done(record, fileout) for record, fileout in zip(lst_record, lst_fileout)]):
+            continue
+        if not args.retry_failed and any([record is not None and record["status"] == "failed" for record in lst_record]):
+            continue
+        # all the patch sizes of the slide are computed together (grids derived from the finest one)
+        lst_task.append((index, filein, lst_fileout, lst_key, args.lst_patch_size, args.lst_min))
+    print(f"{len(lst_filein)-len(lst_task)}/{len(lst_filein)} slides already processed")
+    if len(lst_task) == 0:
+        return
+    # run
+    n_done, n_failed = 0, 0
+    start = time.time()
+    if os.path.isfile(file_manifest) and os.path.getsize(file_manifest) > 0:
+        with open(file_manifest, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            truncated = f.read(1) != b"\n"
+        if truncated:
+            # terminate the truncated last line of an interrupted run (ignored when loaded)
+            with open(file_manifest, "a") as f:
+                f.write("\n")
+    with open(file_manifest, "a") as f, multiprocessing.Pool(
+        args.num_workers, initializer=_init_worker, initargs=(args.cache_dir,)
+        ) as pool:
+        pbar = tqdm(pool.imap_unordered(_process, lst_task), total=len(lst_task))
+        for lst_record in pbar:
+            for record in lst_record:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            if lst_record[0]["status"] == "done":
+                n_done += 1
+            else:
+                n_failed += 1
+                print(f"failed: {lst_record[0]['filein']} ({lst_record[0]['error']})")
+            pbar.set_postfix(slides_per_min=f"{(n_done+n_failed)/(time.time()-start)*60:.1f}")
+    elapsed = time.time() - start
+    print(f"{datetime.datetime.now()}: {n_done} done, {n_failed} failed in {elapsed:.1f} s ({(n_done+n_failed)/elapsed*60:.1f} slides/min)")
+
+if __name__ == '__main__':
+    main()
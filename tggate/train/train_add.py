@@ -91,8 +91,7 @@ class Dataset_Batch(torch.utils.data.Dataset):
             filein="/work/gd43/share/pharm/eisai/batch/batch.npy"
         elif args.shionogi_dataset:
             filein="/work/gd43/share/pharm/shionogi/batch/batch.npy"
-        with open(filein, 'rb') as f:
-            self.data = np.load(f)
+        self.data = sslmodel.patchstore.load_patches(filein) # raw .npy or compressed patch store
         self.datanum = len(self.data)
         gc.collect()
 
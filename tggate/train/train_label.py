@@ -35,6 +35,7 @@ import sslmodel
 from sslmodel import data_handler as dh
 import sslmodel.sslutils as sslutils
 import tggate.utils as utils
+from slide.sampling import WSIPatchDataset
 
 # argument
 parser = argparse.ArgumentParser(description='CLI learning')
@@ -44,7 +45,21 @@ parser.add_argument('--seed', type=int, default=0)
 # data settings
 parser.add_argument('--fold', type=int, default=0) # number of fold
 parser.add_argument('--fold2', type=int, default=0) # number of fold2
+parser.add_argument('--shuffle_mode', type=str, default='global', choices=['global', 'block', 'shard']) # block / shard: page-cache friendly
+parser.add_argument('--block_size', type=int, default=256) # rows per block for block shuffling
 parser.add_argument('--dir_result', type=str, help='result')
+# on-the-fly sampling from the slides instead of the batch shards
+parser.add_argument('--wsi_sampling', action='store_true') # patches read from the slides each epoch, off by default (slower than the .npy shards, see benchmark/bench_wsi_sampling.py)
+parser.add_argument('--file_info', type=str, default="/workspace/tggate/data/tggate_info_ext.csv")
+parser.add_argument('--col_filein', type=str, default="DIR")
+parser.add_argument('--lst_col_label', type=str, nargs='+', default=None) # finding columns of file_info, weak label of each patch of the slide
+parser.add_argument('--patch_size', type=int, default=256)
+parser.add_argument('--num_sample', type=int, default=65536) # patches per epoch
+parser.add_argument('--sampling_mode', type=str, default='round_robin', choices=['round_robin', 'weighted'])
+parser.add_argument('--patch_per_visit', type=int, default=4)
+parser.add_argument('--slide_reader', type=str, default='auto', choices=['auto', 'openslide', 'tiff']) # tiff: tifffile tiles, faster than openslide
+parser.add_argument('--max_open', type=int, default=64) # slides kept open by each worker
+parser.add_argument('--num_workers', type=int, default=4)
 # model/learning settings
 parser.add_argument('--model_name', type=str, default='ResNet18') # model architecture name
 parser.add_argument('--num_epoch', type=int, default=50) # epoch
@@ -64,74 +79,69 @@ args = parser.parse_args()
 sslmodel.utils.fix_seed(seed=args.seed, fix_gpu=True) # for seed control
 
 # prepare data
-class Dataset_Batch(torch.utils.data.Dataset):
-    """ load for each version """
-    def __init__(self,
-                fold:int=None,
-                fold2:int=None,
-                batch:int=None,
-                transform=None,
-                ):
-        # set transform
-        if type(transform)!=list:
-            self._transform = [transform]
-        else:
-            self._transform = transform
-        # load data
-        if batch==3:
-            self.data=np.concatenate([
-                np.load(f"/work/gd43/share/tggates/liver/finding_fold/batch/fold{fold}_fold2{fold2}_batch3.npy"),
-                np.load(f"/work/gd43/share/tggates/liver/finding_fold/batch/fold{fold}_fold2{fold2}_batch4.npy"),
-            ],axis=0)
-            self.label=np.concatenate([
-                np.load(f"/work/gd43/share/tggates/liver/finding_fold/label/fold{fold}_fold2{fold2}_batch3.npy"),
-                np.load(f"/work/gd43/share/tggates/liver/finding_fold/label/fold{fold}_fold2{fold2}_batch4.npy"),
-            ],axis=0)
-        else:
-            self.data=np.load(f"/work/gd43/share/tggates/liver/finding_fold/batch/fold{fold}_fold2{fold2}_batch{batch}.npy")
-            self.label=np.load(f"/work/gd43/share/tggates/liver/finding_fold/label/fold{fold}_fold2{fold2}_batch{batch}.npy")
-        self.datanum = len(self.data)
-        gc.collect()
+def _shard_files(fold:int=None, lst_fold2=list()):
+    """ patch shards (raw .npy or {name}.pstore) and labels, batch3 and batch4 are one batch """
+    lst_name=[f"fold{fold}_fold2{fold2}_batch{batch}.npy" for fold2 in lst_fold2 for batch in range(5)]
+    lst_filein=[f"/work/gd43/share/tggates/liver/finding_fold/batch/{name}" for name in lst_name]
+    lst_filelabel=[f"/work/gd43/share/tggates/liver/finding_fold/label/{name}" for name in lst_name]
+    return lst_filein, lst_filelabel
 
-    def __len__(self):
-        return self.datanum
-
-    def __getitem__(self,idx):
-        # images
-        out_data = self.data[idx]
-        out_data = Image.fromarray(out_data).convert("RGB")
-        if self._transform:
-            for t in self._transform:
-                out_data = t(out_data)
-        # labels
-        out_label = self.label[idx]
-        out_label = torch.Tensor(out_label)
-        return out_data, out_label
-
-def prepare_data(fold:int=None, fold2:int=None, batch:int=0, batch_size:int=32):
+def prepare_data(fold:int=None, lst_fold2=list(), batch_size:int=32):
     """
     data preparation
-    
+    all shards of the training folds as one memory-mapped dataset, shuffled globally at each epoch
+
     """
     # normalization
     train_transform = wsl.prepare_transform(
         color_plob=args.color_plob, blur_plob=args.blur_plob, solar_plob=args.solar_plob,
     )
+    if args.wsi_sampling:
+        return prepare_data_wsi(train_transform, batch_size=batch_size)
     # data
-    train_dataset = Dataset_Batch(
-        fold=fold,
-        fold2=fold2,
-        batch=batch,
+    lst_filein, lst_filelabel = _shard_files(fold=fold, lst_fold2=lst_fold2)
+    train_dataset = dh.ShardDataset(
+        lst_filein=lst_filein,
+        lst_filelabel=lst_filelabel,
         transform=train_transform,
         )
     # resize for test
     if args.resize:
         train_dataset = dh.resize_dataset(train_dataset, size=128)
     # to loader
-    train_loader = dh.prep_dataloader(train_dataset, batch_size)
+    train_loader = dh.prep_shard_dataloader(
+        train_dataset, batch_size,
+        mode=args.shuffle_mode, block_size=args.block_size, seed=args.seed,
+        )
     return train_loader
 
-def prepare_valdata(fold:int=None, fold2:int=None, batch:int=0, batch_size:int=32):
+def prepare_data_wsi(train_transform, batch_size:int=32):
+    """
+    data preparation
+    random tissue patches sampled from the slides of the training folds at each epoch, labeled with the findings of their slide
+
+    """
+    df_info = pd.read_csv(args.file_info)
+    df_info = df_info[(df_info["FOLD"]==args.fold) & (df_info["FOLD2"]!=args.fold2)]
+    train_dataset = WSIPatchDataset(
+        lst_filein=df_info[args.col_filein].tolist(),
+        lst_label=df_info[args.lst_col_label].values.astype(np.float32),
+        patch_size=args.patch_size,
+        num_sample=128 if args.resize else args.num_sample,
+        transform=train_transform,
+        mode=args.sampling_mode,
+        patch_per_visit=args.patch_per_visit,
+        max_open=args.max_open,
+        reader=args.slide_reader,
+        seed=args.seed,
+        )
+    train_loader = dh.prep_dataloader(
+        train_dataset, batch_size, shuffle=False, num_workers=args.num_workers,
+        persistent_workers=args.num_workers > 0,
+        )
+    return dh.TimedLoader(train_loader)
+
+def prepare_valdata(fold:int=None, fold2:int=None, batch_size:int=32):
     """
     data preparation
     
@@ -145,19 +155,19 @@ def prepare_valdata(fold:int=None, fold2:int=None, batch:int=0, batch_size:int=3
         normalize
     ])
     # data
-    dataset = Dataset_Batch(
-        fold=fold,
-        fold2=fold2,
-        batch=batch,
+    lst_filein, lst_filelabel = _shard_files(fold=fold, lst_fold2=[fold2])
+    dataset = dh.ShardDataset(
+        lst_filein=lst_filein,
+        lst_filelabel=lst_filelabel,
         transform=data_transform,
         )
     # resize for test
     if args.resize:
         dataset = dh.resize_dataset(dataset, size=128)
     # to loader
-    data_loader = dh.prep_dataloader(
-        dataset, batch_size, 
-        shuffle=False,
+    data_loader = dh.prep_shard_dataloader(
+        dataset, batch_size,
+        mode="none",
         drop_last=False
         )
     return data_loader
@@ -253,7 +263,7 @@ def load_model(model_name:str='ResNet18', patience:int=7, delta:float=0, lr:floa
     return model, criterion, optimizer, scheduler, early_stopping, train_loss, val_loss, epoch
 
 # train epoch
-def train_epoch(model, criterion, optimizer, epoch):
+def train_epoch(model, criterion, optimizer, epoch, train_loader, val_loader):
     """
     train for epoch
     with minibatch
@@ -261,52 +271,26 @@ def train_epoch(model, criterion, optimizer, epoch):
     model.train() # training
     train_epoch_loss = []
     val_epoch_loss = []
-    # define loader
-    lst_fold2=list(range(5))
-    lst_fold2.remove(args.fold2)
-    minibatch_lst=[[fold2,batch] for fold2 in lst_fold2 for batch in range(4)]
-    # shuffle order of batch
-    random.seed(args.seed+epoch)
-    random.shuffle(minibatch_lst)
-    random.seed(args.seed)
     # training
+    train_loader.set_epoch(epoch) # permutation of this epoch
     model.train()
-    for fold2, batch in minibatch_lst:
-        # prep data
-        train_loader=prepare_data(
-            fold=args.fold,
-            fold2=fold2,
-            batch=batch, 
-            batch_size=args.batch_size, 
-            )
-        # train
-        for data, label in train_loader:
-            loss = wsl.calc_loss(
-                model, data, label, criterion,
-            )
-            train_epoch_loss.append(loss.item())
-            optimizer.zero_grad() # reset gradients
-            loss.backward() # backpropagation
-            optimizer.step() # update parameters
-        del train_loader
-        gc.collect()
+    for data, label in train_loader:
+        loss = wsl.calc_loss(
+            model, data, label, criterion,
+        )
+        train_epoch_loss.append(loss.item())
+        optimizer.zero_grad() # reset gradients
+        loss.backward() # backpropagation
+        optimizer.step() # update parameters
+    LOGGER.logger.info(train_loader.summary())
     # validation
     model.eval()
     with torch.inference_mode():
-        for batch in range(4):
-            val_loader=prepare_valdata(
-                fold=args.fold,
-                fold2=args.fold2,
-                batch=batch,
-                batch_size=args.batch_size,
+        for data, label in val_loader:
+            loss = wsl.calc_loss(
+            model, data, label, criterion,
             )
-            for data, label in val_loader:
-                loss = wsl.calc_loss(
-                model, data, label, criterion,
-                )
-                val_epoch_loss.append(loss.item())
-            del val_loader
-            gc.collect()
+            val_epoch_loss.append(loss.item())
     return model, np.mean(train_epoch_loss), np.mean(val_epoch_loss)
 
 # train
@@ -314,40 +298,48 @@ def train(model, criterion, optimizer, scheduler, early_stopping, num_epoch:int=
     """ train ssl model """
     # settings
     start = time.time() # for time stamp
-    for epoch in range(epoch_start, num_epoch):
-        # train
-        model, train_epoch_loss, val_epoch_loss = train_epoch(model, criterion, optimizer, epoch)
-        scheduler.step()
-        train_loss.append(train_epoch_loss)
-        val_loss.append(val_epoch_loss)
-        LOGGER.logger.info(
-            f'Epoch: {epoch + 1}, train_loss: {train_epoch_loss:.4f}, val_loss: {val_epoch_loss:.4f}'
-            )
-        LOGGER.logger.info('elapsed_time: {:.2f} min'.format((time.time() - start)/60))
-        # save model
-        state = {
-            "epoch":epoch,
-            "model_state_dict":model.state_dict(),
-            "optimizer_state_dict": optimizer.state_dict(),
-            "scheduler_state_dict": scheduler.state_dict(),
-            "criterion":criterion,
-            "early_stopping":early_stopping,
-            "train_loss":train_loss,
-            "val_loss":val_loss,
-        }
-        torch.save(state, f'{DIR_NAME}/state.pt')
-        LOGGER.save_logger(fileout=file_log)
-        # state check
-        ## early stopping
-        early_stopping(val_epoch_loss, model)
-        if early_stopping.early_stop:
-            LOGGER.logger.info(f'Early Stopping with Epoch: {epoch}')
-            model.load_state_dict(torch.load(early_stopping.path))        
-            return model, train_loss, val_loss, True
-        ## time limit
-        if epoch==epoch_start+args.resume_epoch-1:
-            return None, None, None, False
-    return model, train_loss, val_loss, True
+    # loaders are built once, the training set is reshuffled each epoch
+    lst_fold2=list(range(5))
+    lst_fold2.remove(args.fold2)
+    train_loader = prepare_data(fold=args.fold, lst_fold2=lst_fold2, batch_size=args.batch_size)
+    val_loader = prepare_valdata(fold=args.fold, fold2=args.fold2, batch_size=args.batch_size)
+    try:
+        for epoch in range(epoch_start, num_epoch):
+            # train
+            model, train_epoch_loss, val_epoch_loss = train_epoch(model, criterion, optimizer, epoch, train_loader, val_loader)
+            scheduler.step()
+            train_loss.append(train_epoch_loss)
+            val_loss.append(val_epoch_loss)
+            LOGGER.logger.info(
+                f'Epoch: {epoch + 1}, train_loss: {train_epoch_loss:.4f}, val_loss: {val_epoch_loss:.4f}'
+                )
+            LOGGER.logger.info('elapsed_time: {:.2f} min'.format((time.time() - start)/60))
+            # save model
+            state = {
+                "epoch":epoch,
+                "model_state_dict":model.state_dict(),
+                "optimizer_state_dict": optimizer.state_dict(),
+                "scheduler_state_dict": scheduler.state_dict(),
+                "criterion":criterion,
+                "early_stopping":early_stopping,
+                "train_loss":train_loss,
+                "val_loss":val_loss,
+            }
+            torch.save(state, f'{DIR_NAME}/state.pt')
+            LOGGER.save_logger(fileout=file_log)
+            # state check
+            ## early stopping
+            early_stopping(val_epoch_loss, model)
+            if early_stopping.early_stop:
+                LOGGER.logger.info(f'Early Stopping with Epoch: {epoch}')
+                model.load_state_dict(torch.load(early_stopping.path))        
+                return model, train_loss, val_loss, True
+            ## time limit
+            if epoch==epoch_start+args.resume_epoch-1:
+                return None, None, None, False
+        return model, train_loss, val_loss, True
+    finally:
+        train_loader.close() # background shard decoding stopped
 
 def main(resume=False):
     # 1. Preparing
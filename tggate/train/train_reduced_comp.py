@@ -37,6 +37,7 @@ import sslmodel
 from sslmodel import data_handler as dh
 import sslmodel.sslutils as sslutils
 import tggate.utils as utils
+from slide.sampling import WSIPatchDataset
 
 # argument
 parser = argparse.ArgumentParser(description='CLI learning')
@@ -46,7 +47,21 @@ parser.add_argument('--seed', type=int, default=0)
 # data settings
 parser.add_argument('--fold', type=int, default=0) # number of fold
 parser.add_argument('--num_comp', type=int, default=100) # number of WSI
+parser.add_argument('--shuffle_mode', type=str, default='global', choices=['global', 'block', 'shard']) # block / shard: page-cache friendly
+parser.add_argument('--block_size', type=int, default=256) # rows per block for block shuffling
 parser.add_argument('--dir_result', type=str, help='result')
+# on-the-fly sampling from the slides instead of the batch shards
+parser.add_argument('--wsi_sampling', action='store_true') # patches read from the slides each epoch, off by default (slower than the .npy shards, see benchmark/bench_wsi_sampling.py)
+parser.add_argument('--file_info', type=str, default="/workspace/tggate/data/tggate_info_ext.csv")
+parser.add_argument('--col_filein', type=str, default="DIR")
+parser.add_argument('--col_comp', type=str, default="COMPOUND_NAME")
+parser.add_argument('--patch_size', type=int, default=256)
+parser.add_argument('--num_sample', type=int, default=65536) # patches per epoch
+parser.add_argument('--sampling_mode', type=str, default='round_robin', choices=['round_robin', 'weighted'])
+parser.add_argument('--patch_per_visit', type=int, default=4)
+parser.add_argument('--slide_reader', type=str, default='auto', choices=['auto', 'openslide', 'tiff']) # tiff: tifffile tiles, faster than openslide
+parser.add_argument('--max_open', type=int, default=64) # slides kept open by each worker
+parser.add_argument('--num_workers', type=int, default=4)
 # model/learning settings
 parser.add_argument('--model_name', type=str, default='ResNet18') # model architecture name
 parser.add_argument('--ssl_name', type=str, default='barlowtwins') # ssl architecture name
@@ -67,92 +82,89 @@ args = parser.parse_args()
 sslmodel.utils.fix_seed(seed=args.seed, fix_gpu=True) # for seed control
 
 # prepare data
-class Dataset_Batch(torch.utils.data.Dataset):
-    """ load for each version """
-    def __init__(self,
-                batch_number:int=None,
-                transform=None,
-                num_comp="",
-                fold:int=None,
-                ):
-        # set transform
-        if type(transform)!=list:
-            self._transform = [transform]
-        else:
-            self._transform = transform
-        # load data
-        with open(f"/workspace/HDD3/TGGATEs/batch_comp/fold{fold}_n{num_comp}_{batch_number}.npy", 'rb') as f:
-            self.data = np.load(f)
-        self.datanum = len(self.data)
-        gc.collect()
-
-    def __len__(self):
-        return self.datanum
-
-    def __getitem__(self,idx):
-        out_data = self.data[idx]
-        out_data = Image.fromarray(out_data).convert("RGB")
-        if self._transform:
-            for t in self._transform:
-                out_data = t(out_data)
-        return out_data
-
-def prepare_data(batch_number:int=0, num_comp:int=0, batch_size:int=32, fold:int=0):
+def prepare_data(batch_size:int=32):
     """
     data preparation
-    
+    all shards as one memory-mapped dataset, shuffled globally at each epoch
+
     """
     # normalization
     train_transform = ssl_class.prepare_transform(
         color_plob=args.color_plob, blur_plob=args.blur_plob, solar_plob=args.solar_plob,
     )
+    if args.wsi_sampling:
+        return prepare_data_wsi(train_transform, batch_size=batch_size)
     # data
-    train_dataset = Dataset_Batch(
-        batch_number=batch_number,
-        num_comp=num_comp,
+    dict_batch={
+        5:1,
+        10:2,
+        15:3,
+        20:4,
+    }
+    # raw .npy or compressed patch store ({name}.pstore)
+    lst_filein=[
+        f"/workspace/HDD3/TGGATEs/batch_comp/fold{args.fold}_n{args.num_comp}_{batch_number}.npy"
+        for batch_number in range(dict_batch[args.num_comp])
+        ]
+    train_dataset = dh.ShardDataset(
+        lst_filein=lst_filein,
         transform=train_transform,
-        fold=fold,
         )
     # resize for test
     if args.resize:
         train_dataset = dh.resize_dataset(train_dataset, size=128)
     # to loader
-    train_loader = dh.prep_dataloader(train_dataset, batch_size)
+    train_loader = dh.prep_shard_dataloader(
+        train_dataset, batch_size,
+        mode=args.shuffle_mode, block_size=args.block_size, seed=args.seed,
+        )
     return train_loader
 
+def prepare_data_wsi(train_transform, batch_size:int=32):
+    """
+    data preparation
+    random tissue patches sampled at each epoch from the slides of num_comp compounds of the fold (seeded)
+
+    """
+    df_info = pd.read_csv(args.file_info)
+    df_info = df_info[df_info["FOLD"]==args.fold]
+    lst_comp = np.random.default_rng(args.seed).permutation(sorted(df_info[args.col_comp].unique()))[:args.num_comp]
+    df_info = df_info[df_info[args.col_comp].isin(lst_comp)]
+    train_dataset = WSIPatchDataset(
+        lst_filein=df_info[args.col_filein].tolist(),
+        patch_size=args.patch_size,
+        num_sample=128 if args.resize else args.num_sample,
+        transform=train_transform,
+        mode=args.sampling_mode,
+        patch_per_visit=args.patch_per_visit,
+        max_open=args.max_open,
+        reader=args.slide_reader,
+        seed=args.seed,
+        )
+    train_loader = dh.prep_dataloader(
+        train_dataset, batch_size, shuffle=False, num_workers=args.num_workers,
+        persistent_workers=args.num_workers > 0,
+        )
+    return dh.TimedLoader(train_loader)
+
 # train epoch
-def train_epoch(model, criterion, optimizer, epoch):
+def train_epoch(model, criterion, optimizer, epoch, train_loader):
     """
     train for epoch
     with minibatch
     """
     model.train() # training
     train_batch_loss = []
-    # define loader
-    dict_batch={
-        5:1,
-        10:2,
-        15:3,
-        20:4,
-    }
-    lst_minibatch=list(range(dict_batch[args.num_comp]))
-    random.seed(args.seed+epoch)
-    random.shuffle(lst_minibatch)
-    random.seed(args.seed)
-    for batch_number in lst_minibatch:
-        # prep data
-        train_loader=prepare_data(batch_number=batch_number, num_comp=args.num_comp, batch_size=args.batch_size, fold=args.fold)
-        # train
-        for data in train_loader:
-            loss = ssl_class.calc_loss(
-                model, data, criterion,
-            )
-            train_batch_loss.append(loss.item())
-            optimizer.zero_grad() # reset gradients
-            loss.backward() # backpropagation
-            optimizer.step() # update parameters
-        del train_loader
-        gc.collect()
+    train_loader.set_epoch(epoch) # permutation of this epoch
+    for data in train_loader:
+        loss = ssl_class.calc_loss(
+            model, data, criterion,
+        )
+        train_batch_loss.append(loss.item())
+        optimizer.zero_grad() # reset gradients
+        loss.backward() # backpropagation
+        optimizer.step() # update parameters
+    LOGGER.logger.info(train_loader.summary())
     return model, np.mean(train_batch_loss)
 
 # train
@@ -160,38 +172,42 @@ def train(model, criterion, optimizer, scheduler, early_stopping, num_epoch:int=
     """ train ssl model """
     # settings
     start = time.time() # for time stamp
-    for epoch in range(epoch_start, num_epoch):
-        # train
-        model, train_epoch_loss = train_epoch(model, criterion, optimizer, epoch)
-        scheduler.step()
-        train_loss.append(train_epoch_loss)
-        LOGGER.logger.info(
-            f'Epoch: {epoch + 1}, train_loss: {train_epoch_loss:.4f}'
-            )
-        LOGGER.logger.info('elapsed_time: {:.2f} min'.format((time.time() - start)/60))
-        # save model
-        state = {
-            "epoch":epoch,
-            "model_state_dict":model.state_dict(),
-            "optimizer_state_dict": optimizer.state_dict(),
-            "scheduler_state_dict": scheduler.state_dict(),
-            "criterion":criterion,
-            "early_stopping":early_stopping,
-            "train_loss":train_loss
-        }
-        torch.save(state, f'{DIR_NAME}/state.pt')
-        LOGGER.save_logger(fileout=file_log)
-        # state check
-        ## early stopping
-        early_stopping(train_epoch_loss, model)
-        if early_stopping.early_stop:
-            LOGGER.logger.info(f'Early Stopping with Epoch: {epoch}')
-            model.load_state_dict(torch.load(early_stopping.path))        
-            return model, train_loss, True
-        ## time limit
-        if epoch==epoch_start+args.resume_epoch-1:
-            return None, None, False
-    return model, train_loss, True
+    train_loader = prepare_data(batch_size=args.batch_size) # built once, reshuffled each epoch
+    try:
+        for epoch in range(epoch_start, num_epoch):
+            # train
+            model, train_epoch_loss = train_epoch(model, criterion, optimizer, epoch, train_loader)
+            scheduler.step()
+            train_loss.append(train_epoch_loss)
+            LOGGER.logger.info(
+                f'Epoch: {epoch + 1}, train_loss: {train_epoch_loss:.4f}'
+                )
+            LOGGER.logger.info('elapsed_time: {:.2f} min'.format((time.time() - start)/60))
+            # save model
+            state = {
+                "epoch":epoch,
+                "model_state_dict":model.state_dict(),
+                "optimizer_state_dict": optimizer.state_dict(),
+                "scheduler_state_dict": scheduler.state_dict(),
+                "criterion":criterion,
+                "early_stopping":early_stopping,
+                "train_loss":train_loss
+            }
+            torch.save(state, f'{DIR_NAME}/state.pt')
+            LOGGER.save_logger(fileout=file_log)
+            # state check
+            ## early stopping
+            early_stopping(train_epoch_loss, model)
+            if early_stopping.early_stop:
+                LOGGER.logger.info(f'Early Stopping with Epoch: {epoch}')
+                model.load_state_dict(torch.load(early_stopping.path))        
+                return model, train_loss, True
+            ## time limit
+            if epoch==epoch_start+args.resume_epoch-1:
+                return None, None, False
+        return model, train_loss, True
+    finally:
+        train_loader.close() # background shard decoding stopped
 
 def main(resume=False):
     # 1. Preparing
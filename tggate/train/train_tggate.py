@@ -37,6 +37,7 @@ import sslmodel
 from sslmodel import data_handler as dh
 import sslmodel.sslutils as sslutils
 from tggate import utils
+from slide.sampling import WSIPatchDataset
 
 # argument
 parser = argparse.ArgumentParser(description='CLI learning')
@@ -47,6 +48,19 @@ parser.add_argument('--seed', type=int, default=0)
 parser.add_argument('--fold', type=int, default=0) # number of fold
 parser.add_argument('--dir_result', type=str, help='result')
 parser.add_argument('--batch_folder', type=str, default="/work/gd43/share/tggates/liver/batchext")
+parser.add_argument('--shuffle_mode', type=str, default='global', choices=['global', 'block', 'shard']) # block / shard: page-cache friendly
+parser.add_argument('--block_size', type=int, default=256) # rows per block for block shuffling
+# on-the-fly sampling from the slides instead of the batch shards
+parser.add_argument('--wsi_sampling', action='store_true') # patches read from the slides each epoch, off by default (slower than the .npy shards, see benchmark/bench_wsi_sampling.py)
+parser.add_argument('--file_info', type=str, default="/workspace/tggate/data/tggate_info_ext.csv")
+parser.add_argument('--col_filein', type=str, default="DIR")
+parser.add_argument('--patch_size', type=int, default=256)
+parser.add_argument('--num_sample', type=int, default=262144) # patches per epoch
+parser.add_argument('--sampling_mode', type=str, default='round_robin', choices=['round_robin', 'weighted'])
+parser.add_argument('--patch_per_visit', type=int, default=4)
+parser.add_argument('--slide_reader', type=str, default='auto', choices=['auto', 'openslide', 'tiff']) # tiff: tifffile tiles, faster than openslide
+parser.add_argument('--max_open', type=int, default=64) # slides kept open by each worker
+parser.add_argument('--num_workers', type=int, default=4)
 # model/learning settings
 parser.add_argument('--model_name', type=str, default='ResNet18') # model architecture name
 parser.add_argument('--ssl_name', type=str, default='barlowtwins') # ssl architecture name
@@ -62,93 +76,102 @@ parser.add_argument('--resume', action='store_true') # resuming or not
 parser.add_argument('--color_plob', type=float, default=0.8)
 parser.add_argument('--blur_plob', type=float, default=0.4)
 parser.add_argument('--solar_plob', type=float, default=0.)
+parser.add_argument('--batch_aug', action='store_true') # augment whole uint8 batches on the GPU (sslmodel.augment), ignored on cpu
 
 args = parser.parse_args()
 sslmodel.utils.fix_seed(seed=args.seed, fix_gpu=True) # for seed control
 
 # prepare data
-class Dataset_Batch(torch.utils.data.Dataset):
-    """ load for each version """
-    def __init__(self,
-                batch:int=None,
-                fold:int=None,
-                transform=None,
-                ):
-        # set transform
-        if type(transform)!=list:
-            self._transform = [transform]
-        else:
-            self._transform = transform
-        # load data
-        with open(f"{args.batch_folder}/fold{fold}_{batch}.npy", 'rb') as f:
-            self.data = np.load(f)
-        self.datanum = len(self.data)
-        gc.collect()
-
-    def __len__(self):
-        return self.datanum
-
-    def __getitem__(self,idx):
-        out_data = self.data[idx]
-        out_data = Image.fromarray(out_data).convert("RGB")
-        if self._transform:
-            for t in self._transform:
-                out_data = t(out_data)
-        return out_data
-
-def prepare_data(batch:int=0, batch_size:int=32, fold:int=0):
+def prepare_data(batch_size:int=32):
     """
     data preparation
-    
+    all shards of the training folds as one memory-mapped dataset, shuffled globally at each epoch
+    returns train_loader, batch_transform (None: augmented in the workers)
+
     """
     # normalization
-    train_transform = ssl_class.prepare_transform(
-        color_plob=args.color_plob, blur_plob=args.blur_plob, solar_plob=args.solar_plob,
-    )
+    if args.batch_aug and torch.device(DEVICE).type == "cpu":
+        # on cpu the batched augmentation is slower per image than PIL and runs in the main process instead of the workers
+        LOGGER.logger.warning("--batch_aug is GPU only: augmented with PIL in the workers on cpu")
+    if args.batch_aug and torch.device(DEVICE).type != "cpu":
+        # workers only decode, the batches are augmented on the GPU
+        train_transform, collate_fn = dh.ToUInt8(), dh.collate_uint8
+        batch_transform = ssl_class.prepare_batch_transform(
+            color_plob=args.color_plob, blur_plob=args.blur_plob, solar_plob=args.solar_plob,
+        )
+    else:
+        train_transform = ssl_class.prepare_transform(
+            color_plob=args.color_plob, blur_plob=args.blur_plob, solar_plob=args.solar_plob,
+        )
+        collate_fn, batch_transform = None, None
+    if args.wsi_sampling:
+        return prepare_data_wsi(train_transform, batch_size=batch_size, collate_fn=collate_fn), batch_transform
     # data
-    train_dataset = Dataset_Batch(
-        batch=batch,
+    lst_fold=list(range(5))
+    lst_fold.remove(args.fold)
+    # raw .npy or compressed patch store (fold{fold}_{batch}.pstore)
+    lst_filein=[f"{args.batch_folder}/fold{fold}_{batch}.npy" for fold in lst_fold for batch in range(7)]
+    train_dataset = dh.ShardDataset(
+        lst_filein=lst_filein,
         transform=train_transform,
-        fold=fold,
         )
     # resize for test
     if args.resize:
         train_dataset = dh.resize_dataset(train_dataset, size=128)
     # to loader
-    train_loader = dh.prep_dataloader(train_dataset, batch_size)
-    return train_loader
+    train_loader = dh.prep_shard_dataloader(
+        train_dataset, batch_size,
+        mode=args.shuffle_mode, block_size=args.block_size, seed=args.seed,
+        collate_fn=collate_fn,
+        )
+    return train_loader, batch_transform
+
+def prepare_data_wsi(train_transform, batch_size:int=32, collate_fn=None):
+    """
+    data preparation
+    random tissue patches sampled from the slides of the training folds at each epoch
+
+    """
+    df_info = pd.read_csv(args.file_info)
+    df_info = df_info[df_info["FOLD"]!=args.fold]
+    train_dataset = WSIPatchDataset(
+        lst_filein=df_info[args.col_filein].tolist(),
+        patch_size=args.patch_size,
+        num_sample=128 if args.resize else args.num_sample,
+        transform=train_transform,
+        mode=args.sampling_mode,
+        patch_per_visit=args.patch_per_visit,
+        max_open=args.max_open,
+        reader=args.slide_reader,
+        seed=args.seed,
+        )
+    train_loader = dh.prep_dataloader(
+        train_dataset, batch_size, shuffle=False, num_workers=args.num_workers,
+        persistent_workers=args.num_workers > 0, collate_fn=collate_fn,
+        )
+    return dh.TimedLoader(train_loader)
 
 # train epoch
-def train_epoch(model, criterion, optimizer, epoch):
+def train_epoch(model, criterion, optimizer, epoch, train_loader, batch_transform=None):
     """
     train for epoch
     with minibatch
+    batch_transform: augmentation of the uint8 batches (--batch_aug)
     """
     model.train() # training
     train_batch_loss = []
-    # define loader
-    lst_fold=list(range(5))
-    lst_fold.remove(args.fold)
-    lst_minibatch=[[i,v] for i in lst_fold for v in range(7)]
-    if args.resize:
-        lst_minibatch=[lst_minibatch[0]]
-    random.seed(args.seed+epoch)
-    random.shuffle(lst_minibatch)
-    random.seed(args.seed)
-    for fold, batch in lst_minibatch:
-        # prep data
-        train_loader=prepare_data(batch=batch, fold=fold, batch_size=args.batch_size)
-        # train
-        for data in train_loader:
-            loss = ssl_class.calc_loss(
-                model, data, criterion,
-            )
-            train_batch_loss.append(loss.item())
-            optimizer.zero_grad() # reset gradients
-            loss.backward() # backpropagation
-            optimizer.step() # update parameters
-        del train_loader
-        gc.collect()
+    train_loader.set_epoch(epoch) # permutation of this epoch
+    for data in train_loader:
+        if batch_transform is not None:
+            data = batch_transform(data)
+        loss = ssl_class.calc_loss(
+            model, data, criterion,
+        )
+        train_batch_loss.append(loss.item())
+        optimizer.zero_grad() # reset gradients
+        loss.backward() # backpropagation
+        optimizer.step() # update parameters
+    LOGGER.logger.info(train_loader.summary())
     return model, np.mean(train_batch_loss)
 
 # train
@@ -156,38 +179,42 @@ def train(model, criterion, optimizer, scheduler, early_stopping, num_epoch:int=
     """ train ssl model """
     # settings
     start = time.time() # for time stamp
-    for epoch in range(epoch_start, num_epoch):
-        # train
-        model, train_epoch_loss = train_epoch(model, criterion, optimizer, epoch)
-        scheduler.step()
-        train_loss.append(train_epoch_loss)
-        LOGGER.logger.info(
-            f'Epoch: {epoch + 1}, train_loss: {train_epoch_loss:.4f}'
-            )
-        LOGGER.logger.info('elapsed_time: {:.2f} min'.format((time.time() - start)/60))
-        # save model
-        state = {
-            "epoch":epoch,
-            "model_state_dict":model.state_dict(),
-            "optimizer_state_dict": optimizer.state_dict(),
-            "scheduler_state_dict": scheduler.state_dict(),
-            "criterion":criterion,
-            "early_stopping":early_stopping,
-            "train_loss":train_loss
-        }
-        torch.save(state, f'{DIR_NAME}/state.pt')
-        LOGGER.save_logger(fileout=file_log)
-        # state check
-        ## early stopping
-        early_stopping(train_epoch_loss, model)
-        if early_stopping.early_stop:
-            LOGGER.logger.info(f'Early Stopping with Epoch: {epoch}')
-            model.load_state_dict(torch.load(early_stopping.path))        
-            return model, train_loss, True
-        ## time limit
-        if epoch==epoch_start+args.resume_epoch-1:
-            return None, None, False
-    return model, train_loss, True
+    train_loader, batch_transform = prepare_data(batch_size=args.batch_size) # built once, reshuffled each epoch
+    try:
+        for epoch in range(epoch_start, num_epoch):
+            # train
+            model, train_epoch_loss = train_epoch(model, criterion, optimizer, epoch, train_loader, batch_transform=batch_transform)
+            scheduler.step()
+            train_loss.append(train_epoch_loss)
+            LOGGER.logger.info(
+                f'Epoch: {epoch + 1}, train_loss: {train_epoch_loss:.4f}'
+                )
+            LOGGER.logger.info('elapsed_time: {:.2f} min'.format((time.time() - start)/60))
+            # save model
+            state = {
+                "epoch":epoch,
+                "model_state_dict":model.state_dict(),
+                "optimizer_state_dict": optimizer.state_dict(),
+                "scheduler_state_dict": scheduler.state_dict(),
+                "criterion":criterion,
+                "early_stopping":early_stopping,
+                "train_loss":train_loss
+            }
+            torch.save(state, f'{DIR_NAME}/state.pt')
+            LOGGER.save_logger(fileout=file_log)
+            # state check
+            ## early stopping
+            early_stopping(train_epoch_loss, model)
+            if early_stopping.early_stop:
+                LOGGER.logger.info(f'Early Stopping with Epoch: {epoch}')
+                model.load_state_dict(torch.load(early_stopping.path))        
+                return model, train_loss, True
+            ## time limit
+            if epoch==epoch_start+args.resume_epoch-1:
+                return None, None, False
+        return model, train_loss, True
+    finally:
+        train_loader.close() # background shard decoding stopped
 
 def main(resume=False):
     # 1. Preparing
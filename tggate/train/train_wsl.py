@@ -85,7 +85,7 @@ class Dataset_WSL(torch.utils.data.Dataset):
         else:
             self._transform = transform
         # load data
-        self.data=np.load(f"/work/gd43/share/tggates/liver/finding_fold/wslbatch/fold{fold}_{name}_batch0.npy")
+        self.data=sslmodel.patchstore.load_patches(f"/work/gd43/share/tggates/liver/finding_fold/wslbatch/fold{fold}_{name}_batch0.npy")
         self.label=np.load(f"/work/gd43/share/tggates/liver/finding_fold/wsllabel/fold{fold}_{name}_batch0.npy")
         self.datanum = len(self.data)
         gc.collect()
@@ -10,6 +10,7 @@ import re
 import sys
 import datetime
 import random
+import functools
 from typing import List, Tuple, Union, Sequence
 
 import numpy as np
@@ -30,6 +31,10 @@ except:
 
 import sslmodel
 import sslmodel.sslutils as sslutils
+import slide.mask as mask_engine
+import slide.cache as mask_cache
+from slide.region import read_patches
+from slide.location import LocationTable
 
 # Featurize Class
 class Featurize:
@@ -37,174 +42,315 @@ class Featurize:
         self.DEVICE=DEVICE
         self.lst_size=lst_size
         self.out_all=[[] for size in self.lst_size]
-        self.out_all_pool=[[] for size in self.lst_size]
+        self.out_all_pool=dict() # statistic: list of pooled outputs per layer
+        self.aggregator=None # RunningAggregator of the last slide (featurize_stream)
 
     def extraction():
         return None
 
-    def featurize(self, model, data_loader, ):
+    def featurize(self, model, data_loader, batch_transform=None, aggregator=None):
+        """
+        batch_transform: applied to each batch instead of .to(DEVICE) (e.g. BatchNormalize of uint8 batches)
+        aggregator: tggate.aggregator.RunningAggregator updated with each batch instead of keeping the outputs
+            (then pooling(aggregator=aggregator)), else outputs are written to arrays of len(dataset)
+        """
+        num_patch = len(data_loader.dataset)
+        lst_buffer, pos = None, 0
         # featurize
         with torch.inference_mode():
             for data in data_loader:
-                data = data.to(self.DEVICE)
+                data = batch_transform(data) if batch_transform is not None else data.to(self.DEVICE)
                 outs = self.extraction(model, data)
+                if aggregator is not None:
+                    aggregator.update(outs)
+                    continue
+                if lst_buffer is None:
+                    lst_buffer = [np.empty((num_patch, out.shape[1]), dtype=out.dtype) for out in outs]
+                for buffer, out in zip(lst_buffer, outs):
+                    buffer[pos:pos + len(out)] = out
+                pos += len(outs[0])
+        if lst_buffer is not None:
+            for i, buffer in enumerate(lst_buffer):
+                self.out_all[i].append(buffer[:pos])
+
+    def featurize_stream(self, model, data_loader, callback=None, batch_transform=None, aggregator=None):
+        """
+        featurize a multi-slide stream (sslmodel.data_handler.MultiSlideDataset)
+        outputs are written to arrays of the slide length, when all patches of a slide are received
+        self.out_all is set to its outputs (patch order) and callback(slide_id, locations) is called
+        (e.g. pooling / save_outall, as after featurize for one slide), with zero-row outputs for a slide without patches
+        batch_transform: as featurize
+        aggregator: function of the slide length returning a RunningAggregator (e.g. functools.partial),
+            updated instead of keeping the outputs, self.aggregator is the one of the completed slide
+        returns the slide_ids without patches
+        """
+        dict_buffer, lst_empty = dict(), []
+        with torch.inference_mode():
+            for data, slide_id, patch_idx, slide_len, xy in data_loader:
+                if data is None:
+                    lst_empty += slide_id.tolist()
+                    self._stream_empty(dict_buffer, slide_id.numpy(), callback=callback, aggregator=aggregator)
+                    continue
+                data = batch_transform(data) if batch_transform is not None else data.to(self.DEVICE)
+                outs = self.extraction(model, data)
+                self._stream_update(
+                    dict_buffer, outs, slide_id.numpy(), patch_idx.numpy(), slide_len.numpy(), xy.numpy(),
+                    callback=callback, aggregator=aggregator,
+                    )
+        if dict_buffer:
+            raise ValueError(f"incomplete slides in the stream: {sorted(dict_buffer)}")
+        if lst_empty:
+            print(f"slides without patches (zero-row outputs): {sorted(lst_empty)}")
+        return lst_empty
+
+    def _stream_buffer(self, num_patch:int=0, lst_out=list(), aggregator=None):
+        """buffer of a slide of num_patch patches, lst_out: outputs of a batch (shapes / dtypes of the arrays)"""
+        return {
+            "count": 0, "xy": np.empty((num_patch, 2), dtype=np.int32), "mask": np.zeros(num_patch, dtype=bool),
+            "agg": aggregator(num_patch) if aggregator is not None else None,
+            "out": None if aggregator is not None else [
+                np.empty((num_patch, out.shape[1]), dtype=out.dtype) for out in lst_out
+                ],
+            }
+
+    def _stream_update(self, dict_buffer, outs, slide_id, patch_idx, slide_len, xy, callback=None, aggregator=None):
+        """outputs of one batch of the stream to the buffers of their slides (featurize_stream)"""
+        for sid in np.unique(slide_id):
+            sel = slide_id==sid
+            if int(sid) not in dict_buffer:
+                dict_buffer[int(sid)] = self._stream_buffer(int(slide_len[sel][0]), outs, aggregator)
+            buffer = dict_buffer[int(sid)]
+            idx = patch_idx[sel]
+            buffer["count"] += len(idx)
+            buffer["xy"][idx] = xy[sel]
+            buffer["mask"][idx] = True # received patches (tggate.journal)
+            if buffer["agg"] is not None:
+                buffer["agg"].update([out[sel] for out in outs], patch_idx=idx)
+            else:
                 for i, out in enumerate(outs):
-                    self.out_all[i].append(out)
+                    buffer["out"][i][idx] = out[sel]
+            if buffer["count"] == len(buffer["xy"]):
+                self._stream_complete(dict_buffer, int(sid), callback)
 
-    def pooling(self, num_pool_patch:int=200):
-        """max pooling"""
-        for i, out in enumerate(self.out_all):
-            self.out_all_pool[i].append(
-                np.max(np.concatenate(out).reshape(-1, num_pool_patch, self.lst_size[i]),axis=1)
-                )
+    def _stream_empty(self, dict_buffer, slide_id, callback=None, aggregator=None):
+        """empty-slide records of the stream: zero-row outputs (float32 [0, size]), callback called"""
+        lst_out = [np.zeros((0, size), dtype=np.float32) for size in self.lst_size]
+        for sid in slide_id:
+            dict_buffer[int(sid)] = self._stream_buffer(0, lst_out, aggregator)
+            self._stream_complete(dict_buffer, int(sid), callback)
+
+    def _stream_complete(self, dict_buffer, sid:int=0, callback=None):
+        buffer = dict_buffer.pop(sid)
+        if buffer["agg"] is not None:
+            self.aggregator = buffer["agg"]
+            self.out_all = [[] for size in self.lst_size]
+        else:
+            self.out_all = [[out] for out in buffer["out"]]
+        if callback is not None:
+            callback(sid, LocationTable(buffer["xy"]))
+
+    def pooling(self, num_pool_patch:int=200, aggregator=None):
+        """max pooling, or the statistics of a RunningAggregator (num_pool_patch is then the one of the aggregator)"""
+        if aggregator is not None:
+            for stat, lst_out in aggregator.result().items():
+                lst_pool = self.out_all_pool.setdefault(stat, [[] for size in self.lst_size])
+                for i, out in enumerate(lst_out):
+                    lst_pool[i].append(out)
+        else:
+            lst_pool = self.out_all_pool.setdefault("max", [[] for size in self.lst_size])
+            for i, out in enumerate(self.out_all):
+                lst_pool[i].append(
+                    np.max(np.concatenate(out).reshape(-1, num_pool_patch, self.lst_size[i]),axis=1)
+                    )
         # reset output list
         self.out_all=[[] for size in self.lst_size]
 
     def save_outall(self, folder="", name=""):
+        """returns the list of (file, shape) written"""
+        lst_res=[]
         for i, out in enumerate(self.out_all):
             out=np.concatenate(out).astype(np.float32)
-            np.save(f"{folder}/{name}_layer{i+1}.npy", out)
+            lst_res.append(_save_npy(f"{folder}/{name}_layer{i+1}.npy", out))
         self.out_all=[[] for size in self.lst_size]
+        return lst_res
 
-    def save_outpool(self, folder="", name=""):
-        for i, out in enumerate(self.out_all_pool):
-            out=np.concatenate(out).astype(np.float32)
-            np.save(f"{folder}/{name}_layer{i+1}.npy", out)
+    def save_outpool(self, folder="", name="", reset=False):
+        """
+        {name}_layer{i}.npy for max, {name}_layer{i}_{stat}.npy for the other statistics
+        reset: clear the pooled outputs after saving (one slide per file)
+        returns the list of (file, shape) written
+        """
+        lst_res=[]
+        for stat, lst_pool in self.out_all_pool.items():
+            suffix = "" if stat == "max" else f"_{stat}"
+            for i, out in enumerate(lst_pool):
+                out=np.concatenate(out).astype(np.float32)
+                lst_res.append(_save_npy(f"{folder}/{name}_layer{i+1}{suffix}.npy", out))
+        if reset:
+            self.out_all_pool=dict()
+        return lst_res
 
-class ResNet18Featurize(Featurize):
-    def __init__(self, DEVICE="cpu"):
-        super().__init__(
-            DEVICE=DEVICE, 
-            lst_size=[64,64,128,256,512],
-            )
-    def extraction(self, model, x):
-        x = model[0](x)# conv1
-        x = model[1](x)# bn
-        x = model[2](x)# relu
-        x = model[3](x)# maxpool
-        x1 = torch.flatten(model[8](x), 1).detach().cpu().numpy().reshape(-1,64)
-        x = model[4](x)# layer1
-        x2 = torch.flatten(model[8](x), 1).detach().cpu().numpy().reshape(-1,64)
-        x = model[5](x)# layer2
-        x3 = torch.flatten(model[8](x), 1).detach().cpu().numpy().reshape(-1,128)
-        x = model[6](x)# layer3
-        x4 = torch.flatten(model[8](x), 1).detach().cpu().numpy().reshape(-1,256)
-        x = model[7](x)# layer4
-        x5 = torch.flatten(model[8](x), 1).detach().cpu().numpy().reshape(-1,512)
-        return x1, x2, x3, x4, x5
-
-class DenseNet121Featurize(Featurize):
-    def __init__(self, DEVICE="cpu"):
-        super().__init__(
-            DEVICE=DEVICE, 
-            lst_size=[64,128,256,512,1024],
-            )
-    def extraction(self, model, x):
-        x = model[0][0](x)
-        x = model[0][1](x)
-        x = model[0][2](x)
-        x = model[0][3](x)
-        x1 = torch.flatten(model[2](model[1](x)), 1).detach().cpu().numpy().reshape(-1,64)
-        x = model[0][4](x)
-        x = model[0][5](x)
-        x2 = torch.flatten(model[2](model[1](x)), 1).detach().cpu().numpy().reshape(-1,128)
-        x = model[0][6](x)
-        x = model[0][7](x)
-        x3 = torch.flatten(model[2](model[1](x)), 1).detach().cpu().numpy().reshape(-1,256)
-        x = model[0][8](x)
-        x = model[0][9](x)
-        x4 = torch.flatten(model[2](model[1](x)), 1).detach().cpu().numpy().reshape(-1,512)
-        x = model[0][10](x)
-        x = model[0][11](x)
-        x5 = torch.flatten(model[2](model[1](x)), 1).detach().cpu().numpy().reshape(-1,1024)
-        return x1, x2, x3, x4, x5
-
-class EfficientNetB3Featurize(Featurize):
-    def __init__(self, DEVICE="cpu"):
-        super().__init__(
-            DEVICE=DEVICE, 
-            lst_size=[24,32,48,136,1536],
+    def store_outall(self, store, name="", locations=None):
+        """outputs of one slide appended to a tggate.featurestore.FeatureStore (keys layer{i})"""
+        store.append(
+            name, {f"layer{i+1}": np.concatenate(out) for i, out in enumerate(self.out_all)},
+            locations=locations,
             )
-    def extraction(self, model, x):
-        x = model[0][0](x)
-        x = model[0][1](x)
-        x1 = torch.flatten(model[1](x), 1).detach().cpu().numpy().reshape(-1,24)
-        x = model[0][2](x)
-        x2 = torch.flatten(model[1](x), 1).detach().cpu().numpy().reshape(-1,32)
-        x = model[0][3](x)
-        x3 = torch.flatten(model[1](x), 1).detach().cpu().numpy().reshape(-1,48)
-        x = model[0][4](x)
-        x = model[0][5](x)
-        x4 = torch.flatten(model[1](x), 1).detach().cpu().numpy().reshape(-1,136)
-        x = model[0][6](x)
-        x = model[0][7](x)
-        x = model[0][8](x)
-        x5 = torch.flatten(model[1](x), 1).detach().cpu().numpy().reshape(-1,1536)
-        return x1, x2, x3, x4, x5
-
-class ConvNextTinyFeaturize(Featurize):
-    def __init__(self, DEVICE="cpu"):
-        super().__init__(
-            DEVICE=DEVICE, 
-            lst_size=[96,192,384,768],
-            )
-    def extraction(self, model, x):
-        x = model[0][0](x)
-        x = model[0][1](x)
-        x1 = torch.flatten(model[1](x), 1).detach().cpu().numpy().reshape(-1,96)
-        x = model[0][2](x)
-        x = model[0][3](x)
-        x2 = torch.flatten(model[1](x), 1).detach().cpu().numpy().reshape(-1,192)
-        x = model[0][4](x)
-        x = model[0][5](x)
-        x3 = torch.flatten(model[1](x), 1).detach().cpu().numpy().reshape(-1,384)
-        x = model[0][6](x)
-        x = model[0][7](x)
-        x4 = torch.flatten(model[1](x), 1).detach().cpu().numpy().reshape(-1,768)
-        return x1, x2, x3, x4
-
-class ConvNextTinyFeaturize(Featurize):
-    def __init__(self, DEVICE="cpu"):
-        super().__init__(
-            DEVICE=DEVICE, 
-            lst_size=[96,192,384,768],
-            )
-    def extraction(self, model, x):
-        x = model[0][0](x)
-        x = model[0][1](x)
-        x1 = torch.flatten(model[1](x), 1).detach().cpu().numpy().reshape(-1,96)
-        x = model[0][2](x)
-        x = model[0][3](x)
-        x2 = torch.flatten(model[1](x), 1).detach().cpu().numpy().reshape(-1,192)
-        x = model[0][4](x)
-        x = model[0][5](x)
-        x3 = torch.flatten(model[1](x), 1).detach().cpu().numpy().reshape(-1,384)
-        x = model[0][6](x)
-        x = model[0][7](x)
-        x4 = torch.flatten(model[1](x), 1).detach().cpu().numpy().reshape(-1,768)
-        return x1, x2, x3, x4
-
-class RegNetY16gfFeaturize(Featurize):
-    def __init__(self, DEVICE="cpu"):
+        self.out_all=[[] for size in self.lst_size]
+
+    def store_outpool(self, store, name="", locations=None):
+        """pooled outputs of one slide appended to a tggate.featurestore.FeatureStore (keys as save_outpool), then cleared"""
+        dict_out = dict()
+        for stat, lst_pool in self.out_all_pool.items():
+            suffix = "" if stat == "max" else f"_{stat}"
+            for i, out in enumerate(lst_pool):
+                dict_out[f"layer{i+1}{suffix}"] = np.concatenate(out)
+        store.append(name, dict_out, locations=locations)
+        self.out_all_pool=dict()
+
+def _save_npy(fileout:str="", arr=None):
+    """atomic np.save (temporary file renamed), returns (fileout, shape)"""
+    tmp = f"{fileout}.tmp{os.getpid()}.npy"
+    np.save(tmp, arr)
+    os.replace(tmp, fileout)
+    return fileout, list(arr.shape)
+
+def featurize_stream_multi(lst_model=list(), lst_extract=list(), data_loader=None, lst_callback=list(), batch_transform=None, lst_aggregator=None, journal=None):
+    """
+    Featurize.featurize_stream of several models on one stream:
+    each batch is read, decoded and normalized once, then run through every model
+    Parameters
+    ----------
+    lst_model: list of models (prepare_model_eval), on the same DEVICE
+    lst_extract: list of Featurize (one per model)
+    lst_callback: list of callback(slide_id, locations) (one per model, e.g. pooling / save of its outputs)
+    batch_transform: as Featurize.featurize
+    lst_aggregator: list of aggregator factories (one per model) or None, as Featurize.featurize_stream
+    journal: tggate.journal.FeaturizeJournal, the slides in progress are restored from it
+        and flushed to it every journal.interval batches (the stream skips the patches featurized before)
+    returns the slide_ids without patches (zero-row outputs, as Featurize.featurize_stream)
+    """
+    lst_aggregator = lst_aggregator if lst_aggregator is not None else [None for model in lst_model]
+    lst_buffer = journal.restore(lst_aggregator) if journal is not None else [dict() for model in lst_model]
+    lst_empty = []
+    with torch.inference_mode():
+        for data, slide_id, patch_idx, slide_len, xy in data_loader:
+            if data is None:
+                lst_empty += slide_id.tolist()
+                for extract_class, dict_buffer, callback, aggregator in zip(lst_extract, lst_buffer, lst_callback, lst_aggregator):
+                    extract_class._stream_empty(dict_buffer, slide_id.numpy(), callback=callback, aggregator=aggregator)
+                continue
+            data = batch_transform(data) if batch_transform is not None else data.to(lst_extract[0].DEVICE)
+            slide_id, patch_idx, slide_len, xy = slide_id.numpy(), patch_idx.numpy(), slide_len.numpy(), xy.numpy()
+            for model, extract_class, dict_buffer, callback, aggregator in zip(lst_model, lst_extract, lst_buffer, lst_callback, lst_aggregator):
+                outs = extract_class.extraction(model, data)
+                extract_class._stream_update(
+                    dict_buffer, outs, slide_id, patch_idx, slide_len, xy,
+                    callback=callback, aggregator=aggregator,
+                    )
+            if journal is not None:
+                journal.step(lst_buffer)
+    for dict_buffer in lst_buffer:
+        if dict_buffer:
+            raise ValueError(f"incomplete slides in the stream: {sorted(dict_buffer)}")
+    if lst_empty:
+        print(f"slides without patches (zero-row outputs): {sorted(lst_empty)}")
+    return lst_empty
+
+class _StopForward(Exception):
+    """raised by the hook of the last tapped layer, the rest of the backbone is skipped"""
+
+class LayerFeaturize(Featurize):
+    """
+    features of tapped layers of a backbone (nn.Sequential of prepare_model_eval), read with forward hooks
+    each tapped output is global average pooled on the device, the pooled layers are concatenated
+    and copied to the host once per batch
+    Parameters
+    ----------
+    DEVICE: device
+    lst_layer: list of module paths in the backbone, in forward order ("0.11": model[0][11], names also accepted)
+    lst_size: list of channels of the tapped layers
+    relu: bool, in-place ReLU on each tapped output before pooling,
+        the ReLU output is also the input of the next layer (DenseNet121 backbone, as model[1](x))
+    """
+    lst_layer = []
+    lst_size = []
+    relu = False
+
+    def __init__(self, DEVICE="cpu", lst_layer=None, lst_size=None, relu=None):
+        if lst_layer is not None:
+            self.lst_layer = lst_layer
+        if lst_size is not None:
+            self.lst_size = lst_size
+        if relu is not None:
+            self.relu = relu
         super().__init__(
-            DEVICE=DEVICE, 
-            lst_size=[32,48,120,336,888],
+            DEVICE=DEVICE,
+            lst_size=self.lst_size,
             )
+
+    @classmethod
+    def spec(cls, lst_layer=list(), lst_size=list(), relu=False):
+        """Featurize_Class of DICT_MODEL from a layer spec: spec(...)(DEVICE=DEVICE)"""
+        return functools.partial(cls, lst_layer=lst_layer, lst_size=lst_size, relu=relu)
+
+    @staticmethod
+    def _get_module(model, name:str=""):
+        module = model
+        for key in name.split("."):
+            module = module[int(key)] if key.isdigit() else getattr(module, key)
+        return module
+
     def extraction(self, model, x):
-        x = model[0](x)
-        x1 = torch.flatten(model[2](x), 1).detach().cpu().numpy().reshape(-1,32)
-        x = model[1][0](x)
-        x2 = torch.flatten(model[2](x), 1).detach().cpu().numpy().reshape(-1,48)
-        x = model[1][1](x)
-        x3 = torch.flatten(model[2](x), 1).detach().cpu().numpy().reshape(-1,120)
-        x = model[1][2](x)
-        x4 = torch.flatten(model[2](x), 1).detach().cpu().numpy().reshape(-1,336)
-        x = model[1][3](x)
-        x5 = torch.flatten(model[2](x), 1).detach().cpu().numpy().reshape(-1,888)
-        return x1, x2, x3, x4, x5
+        lst_out = [None] * len(self.lst_layer)
+        def make_hook(i):
+            def hook(module, inputs, output):
+                if self.relu:
+                    output = F.relu(output, inplace=True)
+                lst_out[i] = torch.flatten(F.adaptive_avg_pool2d(output, (1, 1)), 1)
+                if i == len(self.lst_layer) - 1:
+                    raise _StopForward
+                return output
+            return hook
+        lst_handle = [
+            self._get_module(model, name).register_forward_hook(make_hook(i)) for i, name in enumerate(self.lst_layer)
+            ]
+        try:
+            model(x)
+        except _StopForward:
+            pass
+        finally:
+            for handle in lst_handle:
+                handle.remove()
+        out = torch.cat(lst_out, dim=1).detach().cpu().numpy()
+        return np.split(out, np.cumsum(self.lst_size)[:-1], axis=1)
+
+# backbones of prepare_model_eval: nn.Sequential(*children[:-1])
+class ResNet18Featurize(LayerFeaturize):
+    lst_layer = ["3", "4", "5", "6", "7"] # maxpool, layer1-4
+    lst_size = [64,64,128,256,512]
+
+class DenseNet121Featurize(LayerFeaturize):
+    lst_layer = ["0.3", "0.5", "0.7", "0.9", "0.11"] # pool0, transition1-3, norm5 (denseblock4 + norm, as the former extraction)
+    lst_size = [64,128,256,512,1024]
+    relu = True
+
+class EfficientNetB3Featurize(LayerFeaturize):
+    lst_layer = ["0.1", "0.2", "0.3", "0.5", "0.8"]
+    lst_size = [24,32,48,136,1536]
+
+class ConvNextTinyFeaturize(LayerFeaturize):
+    lst_layer = ["0.1", "0.3", "0.5", "0.7"]
+    lst_size = [96,192,384,768]
+
+class RegNetY16gfFeaturize(LayerFeaturize):
+    lst_layer = ["0", "1.0", "1.1", "1.2", "1.3"] # stem, trunk_output blocks
+    lst_size = [32,48,120,336,888]
 
 ## Featurize Methods
 # name: [Model_Class, last_layer_size, Featurize_Class]
+# other torchvision backbones: Featurize_Class=LayerFeaturize.spec(lst_layer=[...], lst_size=[...]), e.g.
+# "ResNet50": [torchvision.models.resnet50, 2048, LayerFeaturize.spec(["3", "4", "5", "6", "7"], [64,256,512,1024,2048])],
 DICT_MODEL = {
     "EfficientNetB3": [torchvision.models.efficientnet_b3, 1536, EfficientNetB3Featurize],
     "ConvNextTiny": [torchvision.models.convnext_tiny, 768, ConvNextTinyFeaturize],
@@ -385,31 +531,42 @@ def load_model_train(
     return model, criterion, optimizer, scheduler, early_stopping, train_loss, epoch
 
 # patch
-def make_patch(filein:str="", patch_size:int=256, num_patch:int=512, random_state:int=24771, inside=True,):
-    """extract patch from WSI"""
+def make_patch(filein:str="", patch_size:int=256, num_patch:int=512, random_state:int=24771, inside=True, strip_length:int=None, return_location=False,):
+    """
+    extract patch from WSI
+    strip_length: if set, adjacent sampled patches are read as strips (same output)
+    return_location: also return the LocationTable (level 0 (x, y)) of the patches
+    """
     # set seed
     random.seed(random_state)
     # load
     wsi = OpenSlide(filein)
     # get patch mask
     if inside:
-        mask=get_mask_inside(wsi, patch_size=patch_size, )
+        mask=get_mask_inside(filein, patch_size=patch_size, )
     else:
         mask = get_patch_mask(wsi, patch_size=patch_size)
     mask_shape=mask.shape
     # extract / append
     lst_number=np.array(range(len(mask.flatten())))[mask.flatten()]
     lst_number=random.sample(list(lst_number), num_patch)
-    res = []
-    ap = res.append
-    for number in lst_number:
-        v_h, v_w = divmod(number, mask_shape[1])
-        patch_image=wsi.read_region(
-            location=(int(v_w*patch_size), int(v_h*patch_size)),
-            level=0,
-            size=(patch_size, patch_size))
-        ap(np.array(patch_image, np.uint8)[:,:,:3])
-    res=np.stack(res).astype(np.uint8)
+    v_h, v_w = np.divmod(np.array(lst_number, dtype=np.int64), mask_shape[1])
+    locations = LocationTable(np.stack([v_w*patch_size, v_h*patch_size], axis=1))
+    if strip_length:
+        res = read_patches(wsi, locations, patch_size=patch_size, strip_length=strip_length)
+    else:
+        res = []
+        ap = res.append
+        for number in lst_number:
+            v_h, v_w = divmod(number, mask_shape[1])
+            patch_image=wsi.read_region(
+                location=(int(v_w*patch_size), int(v_h*patch_size)),
+                level=0,
+                size=(patch_size, patch_size))
+            ap(np.array(patch_image, np.uint8)[:,:,:3])
+        res=np.stack(res).astype(np.uint8)
+    if return_location:
+        return res, lst_number, locations
     return res, lst_number
 
 def get_patch_mask(image, patch_size, threshold=None,):
@@ -423,18 +580,8 @@ def get_patch_mask(image, patch_size, threshold=None,):
     -------
     mask: np.array(int)[wsi_height, wsi_width]
     """
-    level = image.get_best_level_for_downsample(patch_size)
-    downsample = image.level_downsamples[level]
-    ratio = patch_size / downsample
-    whole = image.read_region(location=(0,0), level=level,
-        size = image.level_dimensions[level]).convert('HSV')
-    whole = whole.resize((int(whole.width / ratio), int(whole.height / ratio)))
-    whole = np.array(whole, dtype=np.uint8)
-    saturation = whole[:,:,1]
-    if threshold is None:
-        threshold, _ = cv2.threshold(saturation, 0, 255, cv2.THRESH_OTSU)
-    mask = saturation > threshold
-    return mask
+    saturation = mask_engine.read_saturation(image, patch_size=patch_size)
+    return mask_engine.otsu_mask(saturation, threshold=threshold)
 
 def get_mask_inside(
     image, 
@@ -443,53 +590,18 @@ def get_mask_inside(
     adjacent_cells_slice=[(-1,0),(1,0),(0,-1),(0,1),],
     adjacent_cells_inside=[(-1,0),(1,0),(0,-1),(0,1),(1,1),(1,-1),(-1,1),(-1,-1)],
     ):
-    # load
-    level = image.get_best_level_for_downsample(patch_size)
-    downsample = image.level_downsamples[level]
-    ratio = patch_size / downsample
-    whole = image.read_region(location=(0,0), level=level,
-        size = image.level_dimensions[level]).convert('HSV')
-    whole = whole.resize((int(whole.width / ratio), int(whole.height / ratio)))
-    whole = np.array(whole, dtype=np.uint8)
-    # get mask
-    saturation = whole[:,:,1] #saturation
-    threshold, _ = cv2.threshold(saturation, 0, 255, cv2.THRESH_OTSU)
-    mask = saturation > threshold
-    # get slices > slice_min_patch
-    left_mask = np.full((mask.shape[0]+1, mask.shape[1]+1), fill_value=False, dtype=bool)
-    left_mask[:-1, :-1] = mask
-    n_left_mask = np.sum(left_mask)
-    slice_idx = np.full_like(mask, fill_value=-1, dtype=int)
-    i_slice = 0
-    while n_left_mask > 0:
-        mask_i = np.where(left_mask)
-        slice_left_indices = [(mask_i[0][0], mask_i[1][0])]
-        while len(slice_left_indices) > 0:
-            i, j = slice_left_indices.pop()
-            if left_mask[i, j]:
-                slice_idx[i, j] = i_slice
-                for adj_i, adj_j in adjacent_cells_slice:
-                    if left_mask[i+adj_i, j+adj_j]:
-                        slice_left_indices.append((i+adj_i, j+adj_j))
-                left_mask[i, j] = False
-                n_left_mask -= 1
-        slice_mask = slice_idx == i_slice
-        if np.sum(slice_mask) < slice_min_patch:
-            slice_idx[slice_mask] = -1
-        else:
-            i_slice += 1
-    # re-difinition mask
-    mask=slice_idx>-1
-    # get inside mask
-    mask_inside=np.zeros(mask.shape, dtype=bool)
-    for i in range(1,mask.shape[0]-1):
-        for v in range(1,mask.shape[1]-1):
-            tf = mask[i][v]
-            if tf:
-                for adj in adjacent_cells_inside:
-                    tf&=mask[i+adj[0]][v+adj[1]]
-            mask_inside[i][v]=tf
-    return mask_inside
+    """
+    image: path of the slide or OpenSlide object
+    results are stored in the mask cache (slide.cache)
+    """
+    mask, _ = mask_cache.get_mask_inside(
+        image,
+        patch_size=patch_size,
+        slice_min_patch=slice_min_patch,
+        adjacent_cells_slice=adjacent_cells_slice,
+        adjacent_cells_inside=adjacent_cells_inside,
+    )
+    return mask
 
 def sampling_patch_from_wsi(patch_number:int=200, all_number:int=2000, len_df:int=0, seed:int=None):
     if seed is not None: